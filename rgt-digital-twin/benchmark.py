@@ -0,0 +1,504 @@
+#
+# Copyright [Aug 20, 2024] [Jacqueline Lammert, Maximilian Tschochohei]
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# This script benchmarks the local extraction model so we can see whether
+# a change makes extraction faster or slower
+#
+# Usage: python rgt-digital-twin/benchmark.py [batching|prefix|stopping|draft] [number of chunks]
+#
+# The pipeline benchmark runs every stage of both pipelines on a made up corpus
+# (see synthetic_corpus.py): document ingestion, extraction, export and the
+# literature requests. The LLMs are deterministic fakes, or a tiny random model
+# on CPU, so we measure our own code and not the model. Run it on two commits
+# and compare the results:
+#
+# Usage: python rgt-digital-twin/benchmark.py pipeline [number of patients] [fake|tiny]
+#        python rgt-digital-twin/benchmark.py compare benchmark_old.json benchmark_pipeline.json
+#
+# The presets benchmark loads the model once per prepared weights (see
+# model_artifacts.py) and local-gemma preset that fits into memory, each in a
+# fresh process, and reports load time, peak memory and tokens/s:
+#
+# Usage: python rgt-digital-twin/benchmark.py presets [number of chunks] [int8 int4 exact memory memory_extreme]
+#
+
+import os
+import sys
+import time
+import json
+import random
+import asyncio
+import tempfile
+import subprocess
+import config
+import instrumentation
+import synthetic_corpus
+from fakes import FakeGemini, FakeSession
+from local_model import ExtractionSession, prompt_prefix, prompt_suffix
+
+# Words we use to make up patient records, no real patient data in here
+_VOCABULARY = [
+    "Patientin", "Diagnose", "Karzinosarkom", "Uterus", "HER2", "PD-L1", "TMB", "Chemotherapie",
+    "Carboplatin", "Paclitaxel", "Progress", "Befund", "Arztbrief", "Entlassung", "Labor", "CPS",
+    "Pembrolizumab", "Lenvatinib", "Staging", "FIGO", "Metastasen", "Lunge", "Leber", "Monate",
+]
+
+
+def synthetic_records(
+    n: int,
+    words: int = 400,
+    seed: int = 0,
+) -> list:
+    """
+    Make up n deterministic patient records with the given number of words
+    """
+    rng = random.Random(seed)
+    records = []
+    for i in range(n):
+        # Vary the length so that batches actually need padding
+        length = words - rng.randint(0, words // 2)
+        records.append(" ".join(rng.choice(_VOCABULARY) for _ in range(length)))
+    return records
+
+
+def benchmark_batching(
+    session: ExtractionSession,
+    prompts: list,
+    prefix: str,
+    max_new_tokens: int,
+    batch_sizes: list,
+) -> dict:
+    """
+    Generate the same prompts with every batch size and report tokens/s
+    The answers of every batch size are compared with the sequential (batch size 1) answers
+    """
+    results = {}
+    reference = None
+    for batch_size in batch_sizes:
+        session.batch_size = batch_size
+        tokens = session.generated_tokens
+        start = time.perf_counter()
+        answers = session.generate_batch(prompts, max_new_tokens, prefix)
+        seconds = time.perf_counter() - start
+        tokens = session.generated_tokens - tokens
+
+        if reference is None:
+            reference = answers
+        results[batch_size] = {
+            "seconds": round(seconds, 3),
+            "tokens": tokens,
+            "tokens_per_second": round(tokens / max(seconds, 1e-9), 2),
+            "identical_to_sequential": answers == reference,
+        }
+        print(f"Batch size {batch_size}: {results[batch_size]}")
+    return results
+
+
+def benchmark_prefix_cache(
+    session: ExtractionSession,
+    prompts: list,
+    prefix: str,
+) -> dict:
+    """
+    Measure the time to first token with and without the cached prompt prefix
+    We generate exactly one token per prompt, so the time is almost all prefill
+    """
+    results = {}
+    reference = None
+    session.batch_size = 1
+    for caching in [False, True]:
+        session.prefix_caching = caching
+        session.prefix_caches = {}
+        prefill = session.prefill_seconds
+
+        seconds = []
+        answers = []
+        for prompt in prompts:
+            start = time.perf_counter()
+            answers.extend(session.generate_batch([prompt], 1, prefix))
+            seconds.append(time.perf_counter() - start)
+
+        if reference is None:
+            reference = answers
+        # The session falls back to the full prompt when the model cannot reuse the cache
+        label = "fallback" if caching and not session.prefix_caching else "cached" if caching else "uncached"
+        results[label] = {
+            "one_time_prefill_seconds": round(session.prefill_seconds - prefill, 3),
+            "mean_time_to_first_token_seconds": round(sum(seconds) / len(seconds), 4),
+            # The first call pays for the prefill of the prefix, the others reuse it
+            "mean_time_to_first_token_after_first_seconds": round(sum(seconds[1:]) / max(len(seconds) - 1, 1), 4),
+            "identical_to_uncached": answers == reference,
+        }
+        print(f"Prefix caching {label}: {results[label]}")
+    return results
+
+
+def benchmark_stopping(
+    session: ExtractionSession,
+    prompts: list,
+    prefix: str,
+    max_new_tokens: int,
+) -> dict:
+    """
+    Generate the same prompts with and without stopping once the answer is complete
+    With stopping, every answer has to be the start of the answer without stopping
+    """
+    results = {}
+    reference = None
+    for stop in [False, True]:
+        session.stop_on_answer = stop
+        tokens = session.generated_tokens
+        start = time.perf_counter()
+        answers = session.generate_batch(prompts, max_new_tokens, prefix)
+        seconds = time.perf_counter() - start
+        tokens = session.generated_tokens - tokens
+
+        if reference is None:
+            reference = answers
+        results["stopped" if stop else "full"] = {
+            "seconds": round(seconds, 3),
+            "tokens": tokens,
+            "tokens_per_chunk": round(tokens / len(prompts), 1),
+            "prefix_of_full_answer": all(a is not None and r is not None and r.startswith(a)
+                                         for a, r in zip(answers, reference)),
+        }
+        print(f"Stopping {stop}: {results['stopped' if stop else 'full']}")
+    return results
+
+
+def benchmark_draft(
+    session: ExtractionSession,
+    prompts: list,
+    prefix: str,
+    max_new_tokens: int,
+) -> dict:
+    """
+    Generate the same prompts without and with the draft model of the session
+    With the draft, every answer has to be identical to the greedy answer without it
+    """
+    draft = session.draft_model
+    results = {}
+    reference = None
+    for assisted in [False, True]:
+        session.use_draft(draft if assisted else None)
+        tokens = session.generated_tokens
+        drafted = session.draft_tokens
+        accepted = session.accepted_tokens
+        start = time.perf_counter()
+        answers = session.generate_batch(prompts, max_new_tokens, prefix)
+        seconds = time.perf_counter() - start
+        tokens = session.generated_tokens - tokens
+
+        if reference is None:
+            reference = answers
+        results["assisted" if assisted else "greedy"] = {
+            "seconds": round(seconds, 3),
+            "tokens": tokens,
+            "tokens_per_second": round(tokens / max(seconds, 1e-9), 2),
+            "draft_tokens": session.draft_tokens - drafted,
+            "acceptance_rate": round((session.accepted_tokens - accepted) / max(session.draft_tokens - drafted, 1), 3),
+            "identical_to_greedy": answers == reference,
+        }
+        print(f"Draft model {assisted}: {results['assisted' if assisted else 'greedy']}")
+    return results
+
+
+def corpus_tokenizer():
+    """
+    A small BPE tokenizer trained on our prompts and the synthetic corpus, so the benchmarks need no download
+    """
+    from tokenizers import Tokenizer, decoders, models, pre_tokenizers, trainers
+    from transformers import PreTrainedTokenizerFast
+
+    tokenizer = Tokenizer(models.BPE(unk_token="<unk>"))
+    tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokenizer.decoder = decoders.ByteLevel()
+    trainer = trainers.BpeTrainer(vocab_size=2000, special_tokens=["<pad>", "<eos>", "<unk>", "<bos>"],
+                                  initial_alphabet=pre_tokenizers.ByteLevel.alphabet())
+    rng = random.Random(0)
+    texts = [config.local_extraction_prompt, config.local_summary_prompt]
+    texts += [synthetic_corpus.letter_pages(rng, synthetic_corpus.patient_profile(rng), 1)[0] for _ in range(50)]
+    tokenizer.train_from_iterator(texts, trainer)
+    # Like the gemma-2 tokenizer, without token_type_ids that generate() would refuse
+    return PreTrainedTokenizerFast(tokenizer_object=tokenizer, pad_token="<pad>", eos_token="<eos>",
+                                   unk_token="<unk>", bos_token="<bos>",
+                                   model_input_names=["input_ids", "attention_mask"])
+
+
+def tiny_session(
+    tokenizer,
+) -> ExtractionSession:
+    """
+    An ExtractionSession with a tiny random Llama model, to measure the generation code on CPU
+    Its answers are nonsense, so most patients fail in the reduce step
+    Random weights never finish an answer, so benchmark_pipeline keeps its answers short
+    """
+    import torch
+    from transformers import LlamaConfig, LlamaForCausalLM
+
+    torch.manual_seed(0)
+    model = LlamaForCausalLM(LlamaConfig(
+        vocab_size=len(tokenizer), hidden_size=64, intermediate_size=128, num_hidden_layers=2,
+        num_attention_heads=4, num_key_value_heads=4, max_position_embeddings=4096,
+        pad_token_id=tokenizer.pad_token_id, eos_token_id=tokenizer.eos_token_id,
+        bos_token_id=tokenizer.bos_token_id,
+    )).eval()
+    return ExtractionSession(model_name="tiny", model=model, tokenizer=tokenizer)
+
+
+def benchmark_pipeline(
+    folder: str,
+    patients: int,
+    model: str = "fake",
+    export_records: int = 10000,
+    studies: int = 20,
+) -> dict:
+    """
+    Make up a corpus of patients in folder and run every stage of both pipelines on it
+    Returns {stage: measurements} with the wall time, throughput and peak memory of every stage
+    """
+    import ehr_extraction
+
+    results = {}
+    start = time.perf_counter()
+    synthetic_corpus.write_corpus(f"{folder}/ehr", patients)
+    docs = synthetic_corpus.write_literature(f"{folder}/literature", studies)
+    results["corpus"] = {"patients": patients, "docs": len(os.listdir(f"{folder}/ehr")), "studies": studies,
+                         "seconds": round(time.perf_counter() - start, 3)}
+
+    # Ingestion, without the document cache so every doc is read and OCRed
+    start = time.perf_counter()
+    documents = ehr_extraction.process_docs(f"{folder}/ehr")
+    seconds = time.perf_counter() - start
+    pages = sum(len(document[doc]) for document in documents.values() for doc in document)
+    extracted = sum(len(document) for document in documents.values())
+    results["ingestion"] = _measure(seconds, {
+        "docs": extracted,
+        "failed_docs": results["corpus"]["docs"] - extracted,
+        "pages": pages,
+        "docs_per_second": extracted / max(seconds, 1e-9),
+        "pages_per_second": pages / max(seconds, 1e-9),
+    })
+
+    # Extraction, map and reduce over all patients
+    tokenizer = corpus_tokenizer()
+    session = tiny_session(tokenizer) if model == "tiny" else FakeSession(tokenizer)
+    input_tokens = sum(session.count_tokens(page) for document in documents.values()
+                       for doc in document for page in document[doc] if page)
+    generated = session.generated_tokens
+    budgets = config.local_extraction_max_new_tokens, config.local_summary_max_new_tokens
+    if model == "tiny":
+        # Only for this run, the budgets are read from config.py by ehr_extraction and the later benchmarks
+        config.local_extraction_max_new_tokens = config.local_summary_max_new_tokens = 32
+    start = time.perf_counter()
+    try:
+        summaries = ehr_extraction.extract_attributes(documents, session)
+    finally:
+        config.local_extraction_max_new_tokens, config.local_summary_max_new_tokens = budgets
+    seconds = time.perf_counter() - start
+    generated = session.generated_tokens - generated
+    results["extraction"] = _measure(seconds, {
+        "patients": len(documents),
+        "failed_patients": len(documents) - len(summaries),
+        "input_tokens": input_tokens,
+        "generated_tokens": generated,
+        "input_tokens_per_second": input_tokens / max(seconds, 1e-9),
+        "generated_tokens_per_second": generated / max(seconds, 1e-9),
+        "patients_per_second": len(summaries) / max(seconds, 1e-9),
+    })
+
+    # Export, with the summaries repeated so the csv has a realistic size
+    names = list(summaries)
+    repeated = {f"{names[n % len(names)]}-{n}": summaries[names[n % len(names)]]
+                for n in range(export_records if names else 0)}
+    start = time.perf_counter()
+    records = ehr_extraction.export_records(repeated)
+    records.write_csv(f"{folder}/ehr_extracted.csv", '|')
+    seconds = time.perf_counter() - start
+    results["export"] = _measure(seconds, {
+        "records": len(records),
+        "bytes": os.path.getsize(f"{folder}/ehr_extracted.csv"),
+        "records_per_second": len(records) / max(seconds, 1e-9),
+    })
+
+    # Literature, study summaries and cohort matching against a fake Gemini
+    import literature_engine
+    import treatment_matching
+
+    ehr_extraction.export_records(summaries).write_csv(f"{folder}/cohort.csv", '|')
+    gemini = FakeGemini(diagnoses=synthetic_corpus.DIAGNOSES, biomarkers=synthetic_corpus.BIOMARKERS,
+                        treatments=synthetic_corpus.TREATMENTS)
+    engine = literature_engine.LiteratureEngine(model=gemini, rate_per_minute=1e9)
+    start = time.perf_counter()
+    study_summaries = asyncio.run(engine.process_docs(f"{folder}/literature", docs,
+                                                      {"summary": config.literature_extraction_prompt}))["summary"]
+    cohort = treatment_matching.load_cohort(f"{folder}/cohort.csv")
+    matches = treatment_matching.match_cohort(cohort, study_summaries, engine=engine)
+    seconds = time.perf_counter() - start
+    results["literature"] = _measure(seconds, {
+        "studies": len(docs),
+        "patients": len(matches),
+        "requests": engine.requests,
+        "failed_requests": engine.failures,
+        "requests_per_second": engine.requests / max(seconds, 1e-9),
+    })
+    return results
+
+
+def benchmark_load(
+    candidate: str,
+    n: int,
+) -> dict:
+    """
+    Load the model with prepared weights (int8, int4) or a local-gemma preset and generate n synthetic chunks
+    Run every candidate in its own process (see benchmark_presets), otherwise the peak memory adds up
+    """
+    weights = candidate if candidate in ("int8", "int4") else None
+    session = ExtractionSession(preset=candidate, weights=weights)
+    prompts = [prompt_suffix(record) for record in synthetic_records(n)]
+    session.generate_batch(prompts, config.local_extraction_max_new_tokens, prompt_prefix(config.local_extraction_prompt))
+    return _measure(session.load_seconds, {
+        "load_seconds": session.load_seconds,
+        "generated_tokens": session.generated_tokens,
+        "tokens_per_second": session.generated_tokens / max(session.generation_seconds, 1e-9),
+    })
+
+
+def benchmark_presets(
+    candidates: list,
+    n: int,
+) -> dict:
+    """
+    Load time, peak memory and tokens/s of every candidate, each in a fresh process
+    """
+    results = {}
+    for candidate in candidates:
+        process = subprocess.run([sys.executable, os.path.abspath(__file__), "load", candidate, str(n)],
+                                 capture_output=True, text=True)
+        lines = process.stdout.strip().splitlines()
+        if process.returncode == 0 and lines:
+            results[candidate] = json.loads(lines[-1])
+        else:
+            # e.g. the process was killed because the candidate did not fit into memory after all
+            results[candidate] = {"error": (process.stderr.strip().splitlines() or [f"exit code {process.returncode}"])[-1]}
+        print(f"{candidate}: {results[candidate]}")
+    return results
+
+
+def compare(
+    old: dict,
+    new: dict,
+) -> str:
+    """
+    Put the measurements of two pipeline benchmarks side by side, e.g. of two commits
+    """
+    lines = [f"{old.get('commit', 'old')[:10]} -> {new.get('commit', 'new')[:10]}"]
+    for stage in new.get("stages", {}):
+        for key, value in new["stages"][stage].items():
+            before = old.get("stages", {}).get(stage, {}).get(key)
+            if not isinstance(value, (int, float)) or not isinstance(before, (int, float)):
+                continue
+            change = f"{(value - before) / before:+.1%}" if before else ""
+            lines.append(f"{stage:>12} {key:<30} {before:>14.3f} {value:>14.3f} {change:>8}")
+    return "\n".join(lines)
+
+
+def _measure(
+    seconds: float,
+    measurements: dict,
+) -> dict:
+    """
+    Round the measurements of a stage and add its wall time and the peak memory so far
+    """
+    result = {key: round(value, 3) if isinstance(value, float) else value for key, value in measurements.items()}
+    result["seconds"] = round(seconds, 3)
+    # Peak RSS of this process and of the largest ingestion worker
+    result["peak_rss_mb"] = round(instrumentation.peak_rss_mb(), 1)
+    result["peak_worker_rss_mb"] = round(instrumentation.peak_rss_mb(children=True), 1)
+    return result
+
+
+def _commit() -> str:
+    """
+    The commit we benchmark, so results of different commits can be told apart
+    """
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        return ""
+
+
+def main():
+    benchmark = sys.argv[1] if len(sys.argv) > 1 else "batching"
+    if benchmark == "compare":
+        with open(sys.argv[2]) as old, open(sys.argv[3]) as new:
+            print(compare(json.load(old), json.load(new)))
+        return
+    if benchmark == "pipeline":
+        n = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+        model = sys.argv[3] if len(sys.argv) > 3 else "fake"
+        with tempfile.TemporaryDirectory() as folder:
+            stages = benchmark_pipeline(folder, n, model)
+        results = {"commit": _commit(), "model": model, "patients": n, "stages": stages}
+        with open("benchmark_pipeline.json", "w") as file:
+            json.dump(results, file, indent=2)
+        for stage in stages:
+            print(f"{stage}: {stages[stage]}")
+        return
+
+    if benchmark == "load":
+        # One candidate of the presets benchmark, the result is the last line of the output
+        print(json.dumps(benchmark_load(sys.argv[2], int(sys.argv[3]))))
+        return
+    if benchmark == "presets":
+        import model_artifacts
+
+        n = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+        candidates = sys.argv[3:] or model_artifacts.prepared(config.local_extraction_model) \
+            + model_artifacts.fitting_presets(config.local_extraction_model)
+        results = {"commit": _commit(), "chunks": n,
+                   "candidates": benchmark_presets(candidates, n)}
+        with open("benchmark_presets.json", "w") as file:
+            json.dump(results, file, indent=2)
+        return
+
+    n = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+
+    session = ExtractionSession()
+    prompts = [prompt_suffix(record) for record in synthetic_records(n)]
+    prefix = prompt_prefix(config.local_extraction_prompt)
+    if benchmark == "batching":
+        results = benchmark_batching(session, prompts, prefix, config.local_extraction_max_new_tokens,
+                                     sorted({1, config.local_extraction_batch_size}))
+    elif benchmark == "prefix":
+        results = benchmark_prefix_cache(session, prompts, prefix)
+    elif benchmark == "stopping":
+        results = benchmark_stopping(session, prompts, prefix, config.local_extraction_max_new_tokens)
+    elif benchmark == "draft":
+        if session.draft_model is None:
+            print("Set local_extraction_draft_model in config.py to a model with the same tokenizer")
+            exit()
+        results = benchmark_draft(session, prompts, prefix, config.local_extraction_max_new_tokens)
+    else:
+        print(f"Unknown benchmark {benchmark}")
+        exit()
+
+    with open(f"benchmark_{benchmark}.json", "w") as file:
+        json.dump(results, file, indent=2)
+    print(session.report())
+
+if __name__ == '__main__':
+    main()
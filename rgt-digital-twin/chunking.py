@@ -0,0 +1,191 @@
+#
+# Copyright [Aug 20, 2024] [Jacqueline Lammert, Maximilian Tschochohei]
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# This module splits the records of a patient into chunks that fit into the
+# context of the local model
+#
+# Chunks are measured in tokens of the model's tokenizer, not in characters.
+# We fill every chunk as far as the context allows and prefer to cut between
+# documents, pages and paragraphs over cutting in the middle of a sentence.
+#
+
+
+def flatten_pages(
+    document: dict,
+) -> list:
+    """
+    Turn the {doc: [pages]} dict of a patient into a list of page texts
+    The first page of every document starts with its name so the model knows where it comes from
+    """
+    pages = []
+    for doc in document:
+        header = f"[{doc}]\n"
+        for page in document[doc]:
+            if page and page.strip():
+                pages.append(f"{header}{page.strip()}")
+                header = ""
+    return pages
+
+
+def chunk_pages(
+    pages: list,
+    tokenizer,
+    budget: int,
+    overlap: int,
+) -> list:
+    """
+    Pack pages into chunks of at most budget tokens
+    Consecutive chunks share the last overlap tokens of the previous chunk
+    """
+    if budget <= overlap:
+        raise ValueError(f"Chunk budget of {budget} tokens leaves no room next to an overlap of {overlap} tokens")
+
+    separator = "\n\n"
+    separator_length = _count_tokens(tokenizer, separator)
+
+    chunks = []
+    current = []
+    current_length = 0
+    # Number of units in the current chunk that are not just the overlap of the last chunk
+    fresh = 0
+    for unit, length in _split_units(pages, tokenizer, max(1, budget - overlap - separator_length)):
+        room = budget - current_length - separator_length
+        if fresh and length > room:
+            # Cutting at the page is nice, but not worth an almost empty chunk
+            # In that case we fill the chunk with the first paragraphs or lines of the page
+            if room >= budget // 4:
+                head, rest = _split_head(unit, tokenizer, room)
+                if head:
+                    current.append(head)
+                    unit, length = rest, _count_tokens(tokenizer, rest)
+            chunks.append(separator.join(current))
+            # Start the next chunk with the end of the last one so we don't lose context at the cut
+            tail = _tail(tokenizer, chunks[-1], overlap)
+            current = [tail] if tail else []
+            current_length = _count_tokens(tokenizer, tail) if tail else 0
+            fresh = 0
+        if current:
+            current_length += separator_length
+        current.append(unit)
+        current_length += length
+        fresh += 1
+    if fresh:
+        chunks.append(separator.join(current))
+    return chunks
+
+
+def chunk_patient(
+    document: dict,
+    tokenizer,
+    budget: int,
+    overlap: int,
+) -> list:
+    """
+    Split all records of a patient into overlapping chunks of at most budget tokens
+    """
+    return chunk_pages(flatten_pages(document), tokenizer, budget, overlap)
+
+
+def _split_units(
+    pages: list,
+    tokenizer,
+    limit: int,
+):
+    """
+    Yield (text, tokens) units of at most limit tokens
+    Pages are kept whole if they fit, otherwise we fall back to paragraphs, lines and finally raw tokens
+    """
+    for page in pages:
+        yield from _split_text(page, tokenizer, limit, ["\n\n", "\n"])
+
+
+def _split_text(
+    text: str,
+    tokenizer,
+    limit: int,
+    separators: list,
+):
+    """
+    Split a text at the first separator that makes the pieces fit into limit tokens
+    """
+    length = _count_tokens(tokenizer, text)
+    if length <= limit:
+        yield text, length
+        return
+
+    if not separators:
+        # No natural boundary left, so we cut the token ids
+        ids = tokenizer(text, add_special_tokens=False)["input_ids"]
+        for start in range(0, len(ids), limit):
+            piece = tokenizer.decode(ids[start:start + limit])
+            yield piece, len(ids[start:start + limit])
+        return
+
+    # Merge neighbouring paragraphs again as long as they fit, so we don't make tiny units
+    merged = ""
+    for part in text.split(separators[0]):
+        if not part.strip():
+            continue
+        candidate = f"{merged}{separators[0]}{part}" if merged else part
+        if merged and _count_tokens(tokenizer, candidate) > limit:
+            yield from _split_text(merged, tokenizer, limit, separators[1:])
+            merged = part
+        else:
+            merged = candidate
+    if merged:
+        yield from _split_text(merged, tokenizer, limit, separators[1:])
+
+
+def _split_head(
+    text: str,
+    tokenizer,
+    limit: int,
+) -> tuple:
+    """
+    Split a text into a head of at most limit tokens and the rest, at a paragraph or line boundary
+    Returns an empty head if not even the first line fits
+    """
+    for separator in ["\n\n", "\n"]:
+        parts = text.split(separator)
+        head = 0
+        while head < len(parts) - 1 and _count_tokens(tokenizer, separator.join(parts[:head + 1])) <= limit:
+            head += 1
+        if head:
+            return separator.join(parts[:head]), separator.join(parts[head:])
+    return "", text
+
+
+def _tail(
+    tokenizer,
+    text: str,
+    overlap: int,
+) -> str:
+    """
+    Return the last overlap tokens of a text
+    """
+    if overlap <= 0:
+        return ""
+    ids = tokenizer(text, add_special_tokens=False)["input_ids"]
+    return tokenizer.decode(ids[-overlap:])
+
+
+def _count_tokens(
+    tokenizer,
+    text: str,
+) -> int:
+    """
+    Count the tokens of a text without special tokens
+    """
+    return len(tokenizer(text, add_special_tokens=False)["input_ids"])
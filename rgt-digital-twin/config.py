@@ -2,9 +2,45 @@
 ### Config for EHR Extraction #####################
 ###################################################
 patient_identifier = 'Patient' # We expect Patient records to be in format "patient_identifier-###_"
+ocr_language = 'deu' # Tesseract language for scanned documents
+ocr_dpi = 300 # Resolution for rasterizing scanned PDF pages before OCR
+ocr_min_text_chars = 20 # PDF pages with less text than this are treated as scans and OCRed
+ocr_pages_per_raster = 4 # Scanned PDF pages we rasterize at a time, bounds the memory for bitmaps
+ingestion_workers = None # Processes that extract text from documents in parallel. None uses all cores
+ingestion_pages_per_task = 8 # PDF pages each ingestion process extracts at a time
+document_cache_dir = '.cache/documents' # Extracted document text is cached here, it contains patient data!
+document_cache_max_mb = 2048 # Least recently used entries are evicted above this size
 local_extraction_model = 'google/gemma-27-2b-it'
-local_extraction_chunk_size = 5000
-local_extraction_overlap = 100
+local_extraction_context_length = None # Tokens per model call (prompt, records and answer). None uses the context length of the model
+local_extraction_max_new_tokens = 1024 # Tokens the model may generate for the answer to one chunk, we keep them free in the context
+local_summary_max_new_tokens = 1024 # Tokens the model may generate for the summary of a patient
+local_reduce_group_size = 8 # Chunk answers the model merges in one call, longer histories are merged over several levels
+local_extraction_stop_on_answer = True # Stop generating as soon as the answer holds a complete dictionary
+local_extraction_constrained = False # Only let the model generate a dictionary of the fields listed in the prompts, so every answer can be parsed
+local_extraction_overlap = 100 # Tokens that consecutive chunks share
+dedup_threshold = 0.8 # Pages and paragraphs of a patient this similar to an earlier one are dropped before inference (share of word shingles), None keeps everything
+dedup_shingle_words = 3 # Words per shingle, fewer words tolerate more OCR errors
+dedup_min_words = 8 # Shorter pages and paragraphs are always kept
+dedup_permutations = 128 # MinHash permutations, more estimate the similarity more precisely
+local_extraction_preset = 'auto' # local-gemma preset: exact, memory (4-bit weights) or memory_extreme (offloads to CPU). auto takes the fastest one that fits into memory
+local_extraction_weights = 'auto' # Load weights prepared with model_artifacts.py (int8 or int4) instead of local-gemma. auto takes the most precise prepared weights that fit into memory, None always uses local-gemma
+model_artifact_dir = '.cache/models' # Quantized copies of the model from python rgt-digital-twin/model_artifacts.py prepare
+model_memory_headroom = 1.2 # Memory we need per byte of weights, the rest holds activations and key/value caches
+local_extraction_batch_size = 4 # Chunks per generate call, halved automatically when we run out of memory. 1 generates sequentially
+local_extraction_prefix_cache = True # Prefill the static prompts once and reuse their key/value cache for every chunk (needs ~0.5GB per prompt for gemma-2-27b)
+local_extraction_draft_model = None # A small model with the same tokenizer, e.g. 'google/gemma-2-2b-it', drafts tokens that the model verifies several at a time (assisted generation). Answers stay identical, chunks are then generated one at a time
+inference_server_host = '127.0.0.1' # The inference server (inference_server.py) keeps the model loaded between runs. Prompts hold patient data, keep it on this machine
+inference_server_port = 8765
+inference_server_batch_wait = 0.05 # Seconds the server waits for more requests before it starts a batch
+inference_client_connections = 4 # Requests ehr_extraction.py --server keeps in flight at the same time
+inference_client_timeout = 3600 # Seconds we wait for the server to answer one request
+pipeline_queue_depth = 4 # Patients that wait between document processing and the model, bounds the memory of a run
+pipeline_patients_per_batch = 4 # Patients we extract together so their chunks can share batches
+journal_path = 'ehr_extraction.journal.jsonl' # Every chunk and patient result is appended here, so we can resume after a crash
+manifest_path = 'ehr_extraction.manifest.json' # Files and summaries of the last extraction of every patient, for incremental runs
+metrics_spans_path = '{pipeline}.spans.jsonl' # Duration, tokens, OCR pages, retries and memory of every patient, document, chunk and request. None keeps them in memory only
+metrics_prometheus_path = '{pipeline}.prom' # Totals per kind of span in the Prometheus text format, e.g. for the textfile collector of node_exporter. None writes no file
+export_parquet = False # Also write the results of both scripts as .parquet next to the .csv (needs pyarrow)
 
 ###################################################
 ### Config for Literature Extraction ##############
@@ -23,7 +59,8 @@ gcp_project_id = os.environ.get("GCP_PROJECT_ID")
 gcp_region = os.environ.get("GCP_REGION")
 
 # Define the generative model
-literature_model = GenerativeModel("gemini-1.5-pro-001")
+literature_model_name = "gemini-1.5-pro-001"
+literature_model = GenerativeModel(literature_model_name)
 
 # Set model parameters
 generation_config = GenerationConfig(
@@ -34,6 +71,47 @@ generation_config = GenerationConfig(
     max_output_tokens=8192,
 )
 
+# Limits for the requests to Gemini, match them to your Vertex AI quota
+literature_concurrency = 8 # Requests in flight at the same time
+literature_requests_per_minute = 60 # Requests we send per minute on average
+literature_max_retries = 5 # Retries for requests that fail with a quota, overload or timeout error
+literature_backoff_seconds = 2 # First retry waits about this long, every further retry twice as long
+literature_context_cache = True # Upload every PDF once into a Vertex AI context cache and run all prompts against it
+literature_context_cache_minutes = 30 # Lifetime of a context cache, we delete it as soon as all prompts for the PDF are done
+literature_response_cache = True # Keep the answers of Gemini on disk, so unchanged studies are not sent again
+literature_cache_dir = '.cache/literature' # Where we keep the answers
+literature_cache_ttl_days = 90 # Answers older than this are requested again
+literature_cache_max_mb = 512 # Least recently used answers are evicted above this size
+
+# Batch treatment matching of a cohort (literature_extraction.py --cohort ehr_extracted.csv)
+# Only these columns of the cohort are sent to Gemini, everything else (names, dates, age, race) stays local
+cohort_fields = [
+    "diagnosis",
+    "biomarkers",
+    "number_of_systemic_treatment_lines_no_surgery_or_radiotherapy_without_systemic_treatment",
+    "description_of_previous_systemic_treatment_lines",
+    "immune_checkpoint_inhibitor_treatment",
+]
+
+# Local index of the study summaries, only the best matching studies of every patient are sent to Gemini
+study_index_top_k = 10 # Studies per patient, 0 sends every study
+study_index_weights = {"diagnosis": 2.0, "biomarkers": 1.0, "treatment": 0.5} # Weight of a matching term by field of the summary
+study_index_synonyms = { # Terms that mean the same, after lower case and removing dashes, never map opposite statuses together
+    "erbb2": "her2",
+    "cd274": "pdl1",
+    "dmmr": "mmr_deficient",
+    "mmrdeficient": "mmr_deficient",
+    "pmmr": "mmr_proficient",
+    "mmrproficient": "mmr_proficient",
+    "msih": "msi_high",
+    "msihigh": "msi_high",
+    "msistable": "mss",
+    "brca1": "brca",
+    "brca2": "brca",
+    "ucs": "carcinosarcoma",
+    "mmmt": "carcinosarcoma",
+}
+
 # Set safety settings
 safety_settings = {
     HarmCategory.HARM_CATEGORY_HARASSMENT: HarmBlockThreshold.BLOCK_ONLY_HIGH,
@@ -260,4 +338,10 @@ Your output should be a well-organized JSON object capturing essential study det
 
 **Patient Data:**
 {patient}
-"""
\ No newline at end of file
+"""
+
+# Treatment matching against a study summary instead of the study itself
+treatment_matching_prompt = treatment_prompt + """
+**Study Summary:**
+{study}
+"""
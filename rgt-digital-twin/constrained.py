@@ -0,0 +1,288 @@
+#
+# Copyright [Aug 20, 2024] [Jacqueline Lammert, Maximilian Tschochohei]
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# This module restricts the local model to the fields of our prompts
+#
+# The prompts list the fields we want (`gender` (string ...), `age` (integer or
+# "N/A"), ...). From that list we build a small grammar: a dictionary with only
+# these keys, each at most once, and values of their type or a string. While the
+# model generates, every token that would leave the grammar is masked, so each
+# answer is a dictionary we can parse and the model spends no tokens on prose.
+#
+# Checking every token of the vocabulary at every step would be slow, so we
+# group the tokens by their first character and remember the allowed tokens of
+# every state of the grammar. Inside a string almost every token is allowed,
+# there we only check the tokens with a quote, a backslash or a line break.
+#
+
+import re
+
+# Kinds of values, every kind also accepts a string such as "N/A"
+STRING = "string"
+INTEGER = "integer"
+NUMBER = "number"
+LIST = "list"
+
+# Whitespace we allow in a row between the parts of the dictionary
+_MAX_WHITESPACE = 8
+
+
+def prompt_schema(
+    prompt: str,
+) -> dict:
+    """
+    Read the fields of a prompt from its list of data points, e.g. * `age` (integer or "N/A")
+    Returns {field: kind}
+    """
+    schema = {}
+    for field, description in re.findall(r"^\s*\*\s*`(\w+)`\s*\((.*)\)\s*$", prompt, re.MULTILINE):
+        description = description.lower()
+        if description.startswith("list"):
+            schema[field] = LIST
+        elif description.startswith("integer"):
+            schema[field] = INTEGER
+        elif description.startswith("numerical"):
+            schema[field] = NUMBER
+        else:
+            schema[field] = STRING
+    if not schema:
+        raise ValueError("The prompt does not list any fields like * `name` (type)")
+    return schema
+
+
+class Grammar:
+    """
+    Character by character grammar of a dictionary with the fields of a schema
+    States are tuples (mode, used fields, key or kind, context, whitespace) so we can cache by state
+    """
+
+    def __init__(
+        self,
+        schema: dict,
+    ):
+        self.schema = schema
+        self.start = ("start", frozenset(), "", "", 0)
+
+    def step(
+        self,
+        state: tuple,
+        c: str,
+    ):
+        """
+        The state after reading c, or None if c is not allowed here
+        """
+        mode, used, key, context, ws = state
+
+        if mode == "string":
+            if context.endswith("\\"):
+                return None if c == "\n" else (mode, used, key, context[:-1], 0)
+            if c == "\\":
+                return (mode, used, key, context + "\\", 0)
+            if c == '"':
+                return ("after_value" if context == "value" else "after_item", used, "", "", 0)
+            if c == "\n" or c < " ":
+                return None
+            return state
+
+        if mode == "key":
+            if c == '"':
+                if key in self.schema and key not in used:
+                    return ("colon", used | {key}, key, "", 0)
+                return None
+            prefix = key + c
+            if any(field.startswith(prefix) for field in self.schema if field not in used):
+                return ("key", used, prefix, "", 0)
+            return None
+
+        if mode == "number":
+            if c.isdigit() and len(context) < 12:
+                return (mode, used, key, context + c, 0)
+            if c == "." and key == NUMBER and "." not in context and context:
+                return (mode, used, key, context + c, 0)
+            if not context or context.endswith("."):
+                return None
+            return self.step(("after_value", used, "", "", 0), c)
+
+        if c in " \n":
+            return (mode, used, key, context, ws + 1) if ws < _MAX_WHITESPACE else None
+
+        if mode == "start":
+            return ("object", used, "", "", 0) if c == "{" else None
+        if mode == "object":
+            if c == "}":
+                return ("done", used, "", "", 0)
+            return ("key", used, "", "", 0) if c == '"' else None
+        if mode == "next_key":
+            return ("key", used, "", "", 0) if c == '"' else None
+        if mode == "colon":
+            return ("value", used, self.schema[key], "", 0) if c == ":" else None
+        if mode == "value":
+            if c == '"':
+                return ("string", used, "", "value", 0)
+            if c.isdigit() and key in (INTEGER, NUMBER):
+                return ("number", used, key, c, 0)
+            if c == "[" and key == LIST:
+                return ("list", used, "", "", 0)
+            return None
+        if mode == "list":
+            if c == "]":
+                return ("after_value", used, "", "", 0)
+            return ("string", used, "", "item", 0) if c == '"' else None
+        if mode == "next_item":
+            return ("string", used, "", "item", 0) if c == '"' else None
+        if mode == "after_item":
+            if c == ",":
+                return ("next_item", used, "", "", 0)
+            return ("after_value", used, "", "", 0) if c == "]" else None
+        if mode == "after_value":
+            if c == "}":
+                return ("done", used, "", "", 0)
+            if c == "," and len(used) < len(self.schema):
+                return ("next_key", used, "", "", 0)
+            return None
+        return None
+
+    def feed(
+        self,
+        state: tuple,
+        text: str,
+    ):
+        """
+        The state after reading text, or None if text leaves the grammar
+        """
+        for c in text:
+            state = self.step(state, c)
+            if state is None:
+                return None
+        return state
+
+
+class Vocabulary:
+    """
+    The text of every token of a tokenizer, grouped by first character
+    Built once per session, it takes a few seconds for a large vocabulary
+    """
+
+    def __init__(
+        self,
+        tokenizer,
+        eos_token_ids: set,
+    ):
+        special = set(tokenizer.all_special_ids)
+        tokens = tokenizer.convert_ids_to_tokens(list(range(len(tokenizer))))
+        self.size = len(tokens)
+        self.eos_token_ids = sorted(eos_token_ids)
+        self.texts = {}
+        self.by_first = {}
+        # Tokens that can go anywhere inside a string, and the ones that need a closer look there
+        self.plain = []
+        self.string_special = []
+        for id, token in enumerate(tokens):
+            if id in special or token is None:
+                continue
+            text = tokenizer.convert_tokens_to_string([token])
+            # SentencePiece drops the space of a word at the start of a text
+            if token.startswith("▁") and not text.startswith(" "):
+                text = " " + text
+            # Pieces of a multi-byte character have no text of their own
+            if not text or "�" in text:
+                continue
+            self.texts[id] = text
+            self.by_first.setdefault(text[0], []).append((id, text))
+            if '"' in text or "\\" in text or any(c < " " for c in text):
+                self.string_special.append((id, text))
+            else:
+                self.plain.append(id)
+
+
+class SchemaConstraint:
+    """
+    Logits processor for model.generate that masks every token that leaves the grammar of a schema
+    Every row of the batch has its own state, the answer starts after prompt_length tokens
+    """
+
+    def __init__(
+        self,
+        vocabulary: Vocabulary,
+        schema: dict,
+        prompt_length: int,
+        rows: int,
+        cache: dict = None,
+    ):
+        self.vocabulary = vocabulary
+        self.grammar = Grammar(schema)
+        self.prompt_length = prompt_length
+        self.states = [self.grammar.start] * rows
+        # {state: allowed token ids}, shared between calls with the same schema
+        self.cache = {} if cache is None else cache
+
+    def __call__(
+        self,
+        input_ids,
+        scores,
+    ):
+        import torch
+
+        if input_ids.shape[1] > self.prompt_length:
+            for i, token in enumerate(input_ids[:, -1].tolist()):
+                if self.states[i] is not None:
+                    self.states[i] = self._advance(self.states[i], token)
+
+        for i, state in enumerate(self.states):
+            if state is None:
+                # The row already ended, e.g. with EOS, what it generates now is thrown away
+                continue
+            mask = torch.full((scores.shape[-1],), float("-inf"), device=scores.device, dtype=scores.dtype)
+            allowed = self._allowed(state)
+            mask[allowed[allowed < scores.shape[-1]].to(scores.device)] = 0
+            scores[i] = scores[i] + mask
+        return scores
+
+    def _advance(
+        self,
+        state: tuple,
+        token: int,
+    ):
+        if state[0] == "done":
+            return None
+        text = self.vocabulary.texts.get(token)
+        return None if text is None else self.grammar.feed(state, text)
+
+    def _allowed(
+        self,
+        state: tuple,
+    ):
+        """
+        Token ids that keep a state within the grammar, as a tensor
+        """
+        import torch
+
+        if state in self.cache:
+            return self.cache[state]
+
+        if state[0] == "done":
+            allowed = list(self.vocabulary.eos_token_ids)
+        elif state[0] == "string" and not state[3].endswith("\\"):
+            allowed = list(self.vocabulary.plain)
+            allowed += [id for id, text in self.vocabulary.string_special
+                        if self.grammar.feed(state, text) is not None]
+        else:
+            allowed = []
+            for first, tokens in self.vocabulary.by_first.items():
+                if self.grammar.step(state, first) is None:
+                    continue
+                allowed += [id for id, text in tokens if self.grammar.feed(state, text) is not None]
+        self.cache[state] = torch.tensor(allowed, dtype=torch.long)
+        return self.cache[state]
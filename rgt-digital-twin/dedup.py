@@ -0,0 +1,144 @@
+#
+# Copyright [Aug 20, 2024] [Jacqueline Lammert, Maximilian Tschochohei]
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# This module drops near-duplicate pages and paragraphs of a patient
+#
+# The EHR holds the same letter many times: faxed copies, PDF and DOCX versions,
+# forwarded letters with the same header block. We describe every page and
+# paragraph by the set of its word shingles, estimate the similarity of two
+# texts with MinHash and find candidate pairs with locality sensitive hashing,
+# so we never compare every page with every other page. The first occurrence is
+# kept, every later text that is at least `dedup_threshold` similar and has the
+# same numbers is dropped. Lab tables and reports that differ in a single value
+# (HER2 1+ and HER2 3+) are similar in almost every shingle, so the numbers have
+# to match as well.
+#
+
+import re
+import zlib
+import numpy as np
+import config
+
+# Mersenne prime for the hash permutations, small enough that a * x never overflows 64 bits
+_PRIME = (1 << 31) - 1
+
+
+class MinHasher:
+    """
+    MinHash signatures of texts, and an LSH index of the texts we kept so far
+    """
+
+    def __init__(
+        self,
+        threshold: float = config.dedup_threshold,
+        shingle_words: int = config.dedup_shingle_words,
+        permutations: int = config.dedup_permutations,
+        seed: int = 0,
+    ):
+        self.threshold = threshold
+        self.shingle_words = shingle_words
+        rng = np.random.default_rng(seed)
+        self.a = rng.integers(1, _PRIME, size=permutations, dtype=np.uint64)
+        self.b = rng.integers(0, _PRIME, size=permutations, dtype=np.uint64)
+        # Few rows per band find pairs well below the threshold, we check them against the threshold afterwards
+        self.rows = 4
+        self.bands = permutations // self.rows
+        self.buckets = {}
+        self.signatures = []
+        self.numbers = []
+
+    def signature(
+        self,
+        text: str,
+    ):
+        """
+        MinHash signature of the word shingles of a text, or None if it has no words
+        """
+        words = re.findall(r"\w+", text.lower())
+        if not words:
+            return None
+        n = min(self.shingle_words, len(words))
+        shingles = {" ".join(words[i:i + n]) for i in range(len(words) - n + 1)}
+        hashes = np.array([zlib.crc32(shingle.encode()) for shingle in shingles], dtype=np.uint64)
+        # (a * x + b) mod p for every permutation and shingle
+        permuted = (self.a[:, None] * hashes[None, :] + self.b[:, None]) % _PRIME
+        return permuted.min(axis=1)
+
+    def seen(
+        self,
+        text: str,
+    ) -> bool:
+        """
+        Check if a text is a near duplicate of one we added before, and add it if not
+        """
+        signature = self.signature(text)
+        if signature is None:
+            return False
+        numbers = _numbers(text)
+        keys = [(band, signature[band * self.rows:(band + 1) * self.rows].tobytes()) for band in range(self.bands)]
+        candidates = set()
+        for key in keys:
+            candidates.update(self.buckets.get(key, ()))
+        for candidate in candidates:
+            if self.numbers[candidate] == numbers and np.mean(self.signatures[candidate] == signature) >= self.threshold:
+                return True
+        for key in keys:
+            self.buckets.setdefault(key, []).append(len(self.signatures))
+        self.signatures.append(signature)
+        self.numbers.append(numbers)
+        return False
+
+
+def deduplicate(
+    document: dict,
+    threshold: float = config.dedup_threshold,
+    min_words: int = config.dedup_min_words,
+) -> tuple:
+    """
+    Drop pages and paragraphs of a patient ({doc: [pages]}) that are near duplicates of earlier ones
+    Returns the document with the same docs and pages (dropped pages are empty) and the list of dropped texts
+    """
+    pages = MinHasher(threshold)
+    paragraphs = MinHasher(threshold)
+    removed = []
+    deduplicated = {}
+    for doc in document:
+        deduplicated[doc] = []
+        for page in document[doc]:
+            if not page or len(re.findall(r"\w+", page)) < min_words:
+                deduplicated[doc].append(page)
+                continue
+            if pages.seen(page):
+                removed.append(page)
+                deduplicated[doc].append("")
+                continue
+            # A new page can still repeat the letter head or a lab table we already have
+            kept = []
+            for paragraph in re.split(r"\n\s*\n", page):
+                if len(re.findall(r"\w+", paragraph)) >= min_words and paragraphs.seen(paragraph):
+                    removed.append(paragraph)
+                else:
+                    kept.append(paragraph)
+            deduplicated[doc].append("\n\n".join(kept))
+    return deduplicated, removed
+
+
+def _numbers(
+    text: str,
+) -> list:
+    """
+    The numbers of a text in order, e.g. ["12.03.2024", "1+", "10"]
+    """
+    return re.findall(r"\d+(?:[.,:/]\d+)*\+*", text)
@@ -0,0 +1,90 @@
+#
+# Copyright [Aug 20, 2024] [Jacqueline Lammert, Maximilian Tschochohei]
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# This class holds an on-disk cache for the text we extract from EHR documents
+#
+# Entries are keyed by the hash of the file contents and the extractor that
+# produced the text (including its version and the OCR language), so a changed
+# file or a new Tesseract never returns stale text. Every entry is a gzipped
+# JSON list of pages in a FileCache, which evicts the entries that were used
+# least recently when the cache grows beyond its size cap.
+#
+# The cache holds patient data, so keep it on the same secure machine as the EHR.
+#
+
+import config
+from file_cache import FileCache, file_digest
+
+
+class DocumentCache(FileCache):
+    """
+    Content-addressed cache for the pages of extracted documents
+    """
+
+    def __init__(
+        self,
+        directory: str = config.document_cache_dir,
+        max_bytes: int = config.document_cache_max_mb * 1024 * 1024,
+    ):
+        super().__init__(directory, max_bytes)
+        self._extractors = {}
+
+    def key(
+        self,
+        path: str,
+        kind: str,
+    ) -> str:
+        """
+        Hash the file contents together with the extractor for this kind of document
+        """
+        digest = file_digest(path)
+        digest.update(self.extractor(kind).encode())
+        return digest.hexdigest()
+
+    def extractor(
+        self,
+        kind: str,
+    ) -> str:
+        """
+        Name and version of the extractor for a kind of document, e.g. image:tesseract-5.3.0:deu
+        """
+        if kind not in self._extractors:
+            from importlib.metadata import version
+
+            if kind == "pdf":
+                # Scanned pages of a pdf go through Tesseract, so its settings are part of the key
+                name = (f"pdf:PyPDF2-{version('PyPDF2')}:{_tesseract()}:{config.ocr_language}:"
+                        f"{config.ocr_dpi}dpi:{config.ocr_min_text_chars}")
+            elif kind == "docx":
+                name = f"docx:python-docx-{version('python-docx')}"
+            else:
+                name = f"image:{_tesseract()}:{config.ocr_language}"
+            self._extractors[kind] = name
+        return self._extractors[kind]
+
+    def report(self) -> str:
+        return f"Document cache: {self.hits} hits, {self.misses} misses"
+
+
+def _tesseract() -> str:
+    """
+    Name and version of the installed Tesseract
+    """
+    import pytesseract
+
+    try:
+        return f"tesseract-{pytesseract.get_tesseract_version()}"
+    except Exception:
+        return "tesseract-missing"
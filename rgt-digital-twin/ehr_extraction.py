@@ -28,25 +28,45 @@
 
 import os
 import sys
-import pytesseract
-import docx
-import pandas as pd
-import ast
 import logging
-import warnings
 import time
-import json
 import config
+import argparse
+import queue
+import threading
+import chunking
+import ingestion
+import constrained
+import merging
+import dedup
+import instrumentation
+from doc_cache import DocumentCache
+from journal import Journal
+from manifest import Manifest
+from export import Records, add_records
+from inference_server import InferenceClient
+from local_model import ExtractionSession, build_prompt, prompt_prefix, prompt_suffix
 #from typing import dict
-from pdf2image import convert_from_path
-from PyPDF2 import PdfReader
 
 
 def process_docs(
     filepath: str,
+    cache: DocumentCache = None,
 ) -> dict:
     """
     Process docs from a filepath and return the output as a dict
+    Docs that are in the cache are not extracted again
+    """
+    patients = {}
+    for patient, document in stream_docs(filepath, cache):
+        patients[patient] = document
+    return patients
+
+def group_docs(
+    filepath: str,
+) -> dict:
+    """
+    List the docs in a filepath and group them by patient as {patient: [docs]}
     """
 
     # First check if the directory exists
@@ -63,173 +83,292 @@ def process_docs(
     for doc in docs:
         if config.patient_identifier.lower() in doc.split('_')[0].lower():
             patient = doc.split('_')[0]
-            patients[patient] = {}
+            patients.setdefault(patient, []).append(doc)
+        else:
+            print(f"Sorry, I could not process {doc}. Exception: it does not belong to a {config.patient_identifier}")
+    return patients
+
+def stream_docs(
+    filepath: str,
+    cache: DocumentCache = None,
+    patients: dict = None,
+):
+    """
+    Process docs from a filepath and yield (patient, {doc: [pages]}) as soon as a patient is complete
+    If patients ({patient: [docs]}) is given, we only process those docs
+    """
+    if patients is None:
+        patients = group_docs(filepath)
 
     print(f"Processing {len(patients)} patients!")
 
-    # Iterate through document links and process the doc
-    for doc in docs:
+    # Extract the text of all docs in parallel and hand out the patients one by one
+    yield from ingestion.ingest_patients(filepath, patients, cache=cache)
 
-        patient = doc.split('_')[0]
-        print(f"Processing {doc}, wish me luck!")
-        try:
-            # If the doc is a pdf we use PyPDF2 reader (fast and accurate)
-            if "pdf" in doc.lower():
-                pages = []
-                reader = PdfReader(f"{filepath}/{doc}")
-                for page in reader.pages:
-                    pages.append(page.extract_text())
-                patients[patient][doc] = pages
-
-            # If the doc is a docx we use python-docx
-            elif "docx" in doc.lower():
-                pages = []
-                docsux = docx.Document(f"{filepath}/{doc}")
-                for para in docsux.paragraphs:
-                    pages.append(para.text)
-                patients[patient][doc] = pages
-
-            # If the doc is a jpg or image we use pytesseract (slow)
-            elif "jpg" in doc.lower() or "png" in doc.lower():
-                patients[patient][doc] = [pytesseract.image_to_string(f"{filepath}/{doc}",lang='deu')]
+def run_pipeline(
+    filepath: str,
+    session: ExtractionSession,
+    cache: DocumentCache = None,
+    journal: Journal = None,
+    patients: dict = None,
+) -> dict:
+    """
+    Extract the docs and the attributes of all patients at the same time
+    Ingestion puts every finished patient on a bounded queue and the model takes them off as they arrive,
+    so OCR and inference overlap and only a few patients are in memory at any time
+    """
+    ready = queue.Queue(maxsize=config.pipeline_queue_depth)
 
-            else:
-                raise Exception(f"{doc} did not match document type .pdf, .docx, .jpg, .png")
+    def produce():
+        try:
+            for patient, document in stream_docs(filepath, cache, patients):
+                ready.put((patient, document))
         except Exception as e:
-            print(f"Sorry, I could not process {doc}. Exception: {e}")
-    return patients
+            print(f"My apologies, processing the documents failed: Exception: {e}")
+        finally:
+            ready.put(None)
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+
+    patient_summaries = {}
+    finished = False
+    while not finished:
+        # Wait for the next patient and take whoever else is ready, so we can fill a batch
+        batch = {}
+        item = ready.get()
+        while item is not None:
+            batch[item[0]] = item[1]
+            if len(batch) >= config.pipeline_patients_per_batch:
+                break
+            try:
+                item = ready.get_nowait()
+            except queue.Empty:
+                break
+        finished = item is None
+        if batch:
+            patient_summaries.update(extract_attributes(batch, session, journal))
+
+    producer.join()
+    return patient_summaries
 
 def extract_attributes(
           patients: dict,
+          session: ExtractionSession,
+          journal: Journal = None,
 ) -> dict:
     """
     Process parsed document input from a dict using a LLM and return a dict with summaries
+    Chunks of all patients are generated together so the model always works on full batches
+    Every chunk and patient is written to the journal as soon as it is done
     """
-    
-    patient_summaries = {}
-    for patient in patients:
-        try:
-            print(f"Processing {patient}. This may take a while.")
-            patient_summaries[patient] = process_document(patients[patient])
-        except Exception as e:
-            print(f"My apologies, extraction for patient {patient} failed: Exception: {e}")
+    print(f"Processing {len(patients)} patients. This may take a while.")
+    start = time.perf_counter()
+    stuffs = map_chunks(patients, session, journal)
+    summaries = reduce_chunks(stuffs, session, journal)
 
-    return patient_summaries
+    # The patients of a batch share the model, every patient gets its share of the time
+    seconds = time.perf_counter() - start
+    for patient in patients:
+        instrumentation.record("patient", patient, seconds / len(patients), batch_seconds=round(seconds, 3),
+                               batch_patients=len(patients), chunks=len(stuffs.get(patient, [])),
+                               error=None if patient in summaries else "extraction failed")
+    return summaries
 
-def process_document(
-          document: str,
-) -> str:
+def map_chunks(
+          patients: dict,
+          session: ExtractionSession,
+          journal: Journal = None,
+) -> dict:
     """
-    Process one document (via a string) and return a string with the summary
-    Since most documents are too long, we need to potentially map-reduce
+    Chunk the documents of all patients and extract data points from every chunk
+    Returns a dict with the list of chunk responses (the stuff) for each patient
+    Chunks that are in the journal already are not generated again, patients with a failed chunk are left out
     """
-    
-    # Review https://github.com/huggingface/local-gemma for gemma-2 local usage instructions
-    # Make sure that you load an "instruction-tuned" (it) version of gemma-2
-    
     log = logging.getLogger(__name__)
 
-    from local_gemma import LocalGemma2ForCausalLM
-    from transformers import AutoTokenizer
+    # Every chunk has to fit into the context next to the prompt and the answer
+    context_length = session.context_length()
+    budget = (context_length - session.count_tokens(build_prompt(config.local_extraction_prompt, ""))
+              - config.local_extraction_max_new_tokens)
 
-    # Initialize the model with memory_extreme for CPU offloading because our local machine is 🐌
-    model = LocalGemma2ForCausalLM.from_pretrained(config.local_extraction_model, preset="memory_extreme")
-    tokenizer = AutoTokenizer.from_pretrained(config.local_extraction_model)
+    # Collect the chunks of all patients so that a batch can span several patients
+    chunks = []
+    stuffs = {}
+    for patient in patients:
+        try:
+            document = patients[patient]
+            if config.dedup_threshold:
+                # Copies of the same letter only cost inference time
+                document, removed = dedup.deduplicate(document)
+                if removed:
+                    tokens = sum(session.count_tokens(text) for text in removed)
+                    print(f"Removed {len(removed)} duplicate pages and paragraphs ({tokens} tokens) of {patient}")
+                    log.info(f"Deduplication removed {tokens} tokens of {patient}")
+            patient_chunks = chunking.chunk_patient(document, session.tokenizer, budget, config.local_extraction_overlap)
+            print(f"Split the records of {patient} into {len(patient_chunks)} chunks of at most {budget} tokens")
+            for chunk in patient_chunks:
+                chunks.append((patient, chunk))
+            stuffs[patient] = []
+        except Exception as e:
+            print(f"My apologies, chunking for patient {patient} failed: Exception: {e}")
+            if journal is not None:
+                journal.record_failure(patient, f"chunking failed: {e}")
 
-    # Array for the stuffed document
-    stuff = []
+    prefix = prompt_prefix(config.local_extraction_prompt)
+    prompts = [prompt_suffix(chunk) for patient, chunk in chunks]
 
-    # We initialize i and j for a mini-chunker since the combined patient files are too large for a single model
-    i = 0
-    j = config.local_extraction_chunk_size
+    # Take the answers of earlier runs from the journal and only generate the rest
+    responses = [None] * len(chunks)
+    todo = list(range(len(chunks)))
+    if journal is not None:
+        keys = [journal.chunk_key(prefix + prompt) for prompt in prompts]
+        responses = [journal.chunks.get(key) for key in keys]
+        todo = [n for n in todo if responses[n] is None]
+        if len(todo) < len(chunks):
+            print(f"Taking {len(chunks) - len(todo)} chunks from the journal")
 
-    while i < len(document)-1:
-        try:
-            prompt = f"""user: "{config.local_extraction_prompt}
-                <|start_header_id|>PATIENT RECORDS:<|end_header_id|>\n 
-                {document[i:j]}<|end_of_text|> assistant:"""
-            model_inputs = tokenizer(prompt, return_attention_mask=True, return_tensors="pt")
-            generated_ids = model.generate(**model_inputs.to(model.device), max_length = config.local_extraction_chunk_size)
-
-            response = tokenizer.batch_decode(generated_ids)
-            log.info(response)
-            stuff.append(response)
-        except Exception as e:
-            print(f"My apologies, extraction for chunk {j/config.local_extraction_chunk_size} failed: Exception: {e}")
+    def record(n, response):
+        if journal is not None and response is not None:
+            journal.record_chunk(chunks[todo[n]][0], keys[todo[n]], response)
 
-        # If we chunk, leave overlap between chunks so we don't cut words in the middle
-        i = j - config.local_extraction_overlap
+    answers = session.generate_batch([prompts[n] for n in todo], max_new_tokens = config.local_extraction_max_new_tokens,
+                                     prefix = prefix, callback = record, stage = "chunk",
+                                     schema = constrained.prompt_schema(config.local_extraction_prompt)
+                                              if config.local_extraction_constrained else None)
+    for n, answer in zip(todo, answers):
+        responses[n] = answer
 
-        # Make sure that our chunk wouldn't be longer than the rest of the doc 
-        # So we don't end up out of bounds
-        if j + config.local_extraction_chunk_size - config.local_extraction_overlap > len(document):
-            j = len(document)-1
-        else:
-            j = j + config.local_extraction_chunk_size - config.local_extraction_overlap   
-    
-    # Now we summarize the extracted stuffs
-    try:
-            prompt = f"""user: "{config.local_summary_prompt}
-                <|start_header_id|>PATIENT RECORDS:<|end_header_id|>\n 
-                {str(stuff)}<|end_of_text|> assistant:"""
-            model_inputs = tokenizer(prompt, return_attention_mask=True, return_tensors="pt")
-            generated_ids = model.generate(**model_inputs.to(model.device), max_length = 10000)
-
-            summary = tokenizer.batch_decode(generated_ids)
-            log.info(summary)
-    except Exception as e:
-        print(f"My apologies, summarization failed: Exception: {e}")
+    failed = {}
+    for (patient, chunk), response in zip(chunks, responses):
+        if response is None:
+            failed[patient] = failed.get(patient, 0) + 1
+            continue
+        log.info(response)
+        stuffs[patient].append(response)
+
+    # A summary without these chunks would silently miss what they say, --retry-failed generates them again
+    for patient in failed:
+        print(f"My apologies, extraction failed for {failed[patient]} chunks of patient {patient}")
+        del stuffs[patient]
+        if journal is not None:
+            journal.record_failure(patient, f"extraction failed for {failed[patient]} chunks")
+    return stuffs
+
+def reduce_chunks(
+          stuffs: dict,
+          session: ExtractionSession,
+          journal: Journal = None,
+) -> dict:
+    """
+    Summarize the extracted stuffs of each patient into a single answer
+    The answers are merged in groups over several levels, so a long history never overflows the context
+    Groups whose fields agree are merged without the model, the others of all patients are generated as one batch
+    """
+    log = logging.getLogger(__name__)
+    prefix = prompt_prefix(config.local_summary_prompt)
+    schema = constrained.prompt_schema(config.local_summary_prompt) if config.local_extraction_constrained else None
+    budget = (session.context_length() - session.count_tokens(build_prompt(config.local_summary_prompt, ""))
+              - config.local_summary_max_new_tokens)
+
+    # Only the dictionaries of the chunk answers go upwards, not the text around them
+    answers = {patient: [merging.compact(stuff) for stuff in stuffs[patient]] for patient in stuffs}
+    patient_summaries = {}
+    level = 0
+    while answers:
+        level += 1
+        merged = {}
+        todo = []
+        for patient in answers:
+            groups = merging.group(answers[patient], budget, config.local_reduce_group_size, session.count_tokens)
+            merged[patient] = [None] * len(groups)
+            for n, answer_group in enumerate(groups):
+                fields = merging.merge(answer_group)
+                if fields is not None:
+                    merged[patient][n] = merging.format_answer(fields)
+                else:
+                    todo.append((patient, n, prompt_suffix(merging.join(answer_group))))
+        print(f"Reduce level {level}: {sum(len(groups) for groups in merged.values())} groups, "
+              f"{len(todo)} of them need the model")
 
-    return summary
+        summaries = session.generate_batch([prompt for patient, n, prompt in todo],
+                                           max_new_tokens = config.local_summary_max_new_tokens,
+                                           prefix = prefix, schema = schema, stage = "summary")
+        for (patient, n, prompt), summary in zip(todo, summaries):
+            merged[patient][n] = merging.compact(summary) if summary is not None else None
 
+        answers = {}
+        for patient in merged:
+            if not merged[patient] or None in merged[patient]:
+                print(f"My apologies, summarization for patient {patient} failed")
+                if journal is not None:
+                    journal.record_failure(patient, "summarization failed")
+            elif len(merged[patient]) > 1:
+                answers[patient] = merged[patient]
+            else:
+                summary = merged[patient][0]
+                log.info(summary)
+                patient_summaries[patient] = summary
+                if journal is not None:
+                    journal.record_patient(patient, summary)
+    return patient_summaries
 
 
-def export_csv(
+
+def export_records(
     patient_summaries: dict,
-    sep: str,
+) -> Records:
+    """
+    Parse the dictionaries generated by LLMs (this contains errors!) into one record per patient
+    That can be exported to Excel/Sheets for processing by clinicians
+    """
+    return add_records(Records(), patient_summaries, "Patient")
+
+def update_manifest(
+    manifest: Manifest,
+    fingerprints: dict,
+    tried: list,
+    extracted: dict,
+    incremental: bool = False,
 ) -> dict:
     """
-    Process a dataframe consisting of dictionaries generated by LLMs (this contains errors!)
-    To a csv that can be exported to Excel/Sheets for processing by clinicians 
-    """ 
-    df = pd.DataFrame()
-    log = logging.getLogger(__name__)
-    # Iterate over patients 
-    for patient in patient_summaries:
-        success = False
-        try:
-            # Using ast.literal_eval is inherently unsafe, but we can trust the input here
-            results = ast.literal_eval(patient_summaries[patient].split("python")[1].split("```")[0])
-            results["Patient"] = patient
-            results = pd.DataFrame([results])
-            df = pd.concat([df, results], ignore_index=True)
-        except Exception as e:
-            try:
-                # Sometimes the model writes 'json' instead of 'python' 🤷
-                results = ast.literal_eval(patient_summaries[patient].split("json")[1].split("```")[0])
-                results["Patient"] = patient
-                results = pd.DataFrame([results])
-                df = pd.concat([df, results], ignore_index=True)
-                success = True
-            except Exception as f:
-                try:
-                    # And sometimes we receive nothing at all
-                    results = ast.literal_eval(patient_summaries[patient])
-                    results["Patient"] = patient
-                    results = pd.DataFrame([results])
-                    df = pd.concat([df, results], ignore_index=True)
-                    success = True
-                except Exception as g:
-                    print(f"Could not parse record for patient {patient}; Exception: {g}")
-                    log.info(patient_summaries[patient])
-
-            if not success:
-                print(f"Could not parse record for patient {patient}; Exception: {f}")
-                log.info(patient_summaries[patient])
-        if not success:
-            print(f"Could not parse record for patient {patient}; Exception: {e}")
-            log.info(patient_summaries[patient])
-    return df.to_csv(sep = sep)
+    Remember the summaries we extracted and forget those of the patients we tried and failed
+    Returns the summaries to export, incremental runs add the unchanged patients of the folder from the manifest
+    """
+    for patient in tried:
+        if patient not in extracted:
+            # Its documents changed, the summary of the old ones would be exported as if it was current
+            manifest.forget(patient)
+    for patient in extracted:
+        if patient in fingerprints:
+            manifest.update(patient, fingerprints[patient], extracted[patient])
+    if not incremental:
+        return extracted
+    # Patients that are no longer in the folder stay in the manifest, but not in the export
+    unchanged = {patient: summary for patient, summary in manifest.summaries().items() if patient in fingerprints}
+    return {**unchanged, **extracted}
+
+def parse_args(
+    argv: list = None,
+) -> argparse.Namespace:
+    """
+    Parse the command line, e.g. python rgt-digital-twin/ehr_extraction.py ehr
+    """
+    parser = argparse.ArgumentParser(description="Extract structured patient data from EHR with a local LLM")
+    parser.add_argument("folder", help="folder with the EHR documents, e.g. ehr")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="extract the text of every document again instead of using the document cache")
+    parser.add_argument("--clear-cache", action="store_true",
+                        help="delete the document cache before we start")
+    parser.add_argument("--resume", action="store_true",
+                        help="continue an interrupted run from the journal, skipping finished patients and chunks")
+    parser.add_argument("--retry-failed", action="store_true",
+                        help="only process the patients that failed in the last run")
+    parser.add_argument("--incremental", action="store_true",
+                        help="only process patients whose documents changed since the last extraction")
+    parser.add_argument("--server", action="store_true",
+                        help="send the prompts to a running inference_server.py instead of loading the model")
+    return parser.parse_args(argv)
 
 def main():
     import logging
@@ -239,14 +378,68 @@ def main():
                     datefmt='%H:%M:%S',
                     level=logging.INFO)
     
-    # First we process the documents using PyPDF2, Tesseract and python-docx
-    patients = process_docs(sys.argv[1])
-    # Then we extract information from each patient
-    attributes = extract_attributes(patients)
-    # And finally we parse the extraction into a dataframe and export it as csv
-    csv = export_csv(attributes,'|')
-    with open("ehr_extracted.csv", "w") as file:
-        file.write(csv)
+    args = parse_args()
+    instrumentation.start("ehr_extraction")
+
+    # Extracted text is cached, so reruns only extract new or changed documents
+    cache = None
+    if args.clear_cache:
+        DocumentCache().clear()
+    if not args.no_cache:
+        cache = DocumentCache()
+
+    patients = group_docs(args.folder)
+
+    # The manifest knows which files we used for the last extraction of every patient
+    # We fingerprint all of them, also those we take from the journal, so they enter the manifest as well
+    manifest = Manifest()
+    fingerprints = {patient: manifest.fingerprint(args.folder, patient, patients[patient]) for patient in patients}
+
+    # Every chunk and patient goes into the journal, so a crash does not cost us the whole run
+    journal = Journal()
+    done = {}
+    if args.resume or args.retry_failed:
+        done = journal.completed()
+        print(f"Resuming with {len(done)} finished and {len(journal.failed())} failed patients from {journal.path}")
+        if args.retry_failed:
+            patients = {patient: patients[patient] for patient in patients if patient in journal.failed()}
+        patients = {patient: patients[patient] for patient in patients if patient not in done}
+    else:
+        journal.clear()
+
+    if args.incremental:
+        unchanged = [patient for patient in patients if manifest.unchanged(patient, fingerprints[patient])]
+        print(f"{len(unchanged)} patients have not changed since the last extraction")
+        patients = {patient: patients[patient] for patient in patients if patient not in unchanged}
+
+    # We load the local model once and extract information from each patient
+    # while the documents are still processed using PyPDF2, Tesseract and python-docx
+    # With --server the model stays loaded in inference_server.py and we only load the tokenizer
+    if args.server:
+        try:
+            session = InferenceClient()
+        except OSError as e:
+            sys.exit(f"No inference server on {config.inference_server_host}:{config.inference_server_port}, "
+                     f"start it with python rgt-digital-twin/inference_server.py. Exception: {e}")
+    else:
+        session = ExtractionSession()
+    with instrumentation.span("pipeline", args.folder, patients=len(patients)):
+        attributes = run_pipeline(args.folder, session, cache, journal, patients)
+    print(session.report())
+
+    # Remember what we extracted, and merge it with the patients we did not have to extract again
+    attributes = update_manifest(manifest, fingerprints, list(patients), {**done, **attributes}, args.incremental)
+    manifest.save()
+
+    # And finally we parse the extraction and export it as csv
+    with instrumentation.span("export", "ehr_extracted.csv") as span:
+        records = export_records(attributes)
+        records.write_csv("ehr_extracted.csv", '|')
+        if config.export_parquet:
+            records.write_parquet("ehr_extracted.parquet")
+        span["records"] = len(records)
+        span["bytes"] = os.path.getsize("ehr_extracted.csv")
+    instrumentation.finish()
 
 if __name__ == '__main__':
     main() 
\ No newline at end of file
@@ -0,0 +1,300 @@
+#
+# Copyright [Aug 20, 2024] [Jacqueline Lammert, Maximilian Tschochohei]
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# This module exports the dictionaries generated by the LLMs
+#
+# Every model answers with a slightly different set of keys. We collect the
+# records column by column, so a key that shows up late only adds one column,
+# and write the csv row by row straight to disk. The same columns can be written
+# as Parquet, which loads in a fraction of the time of a csv.
+#
+
+import io
+import ast
+import csv
+import json
+import logging
+
+
+class Records:
+    """
+    Records with ragged keys, stored column by column
+    """
+
+    def __init__(self):
+        self.columns = {}
+        self.dtypes = {}
+        self.empty = {}
+        self.blocks = {}
+        self.block_count = 0
+        self.rows = 0
+
+    def append(
+        self,
+        record: dict,
+    ):
+        # pandas concatenates per run of columns that are in the same block both in the records so far and in the
+        # new record (a block per dtype, and one for its missing keys), and every run becomes a block of the result
+        for key in record:
+            if key not in self.columns:
+                # Earlier records did not have this key
+                self.columns[key] = [None] * self.rows
+        dtypes = {}
+        for key, value in record.items():
+            dtypes.setdefault(_dtype(value), []).append(key)
+        new_blocks = {}
+        for dtype, keys in _runs(self.columns, lambda key: _dtype(record[key]) if key in record else None):
+            # Reordered like the records so far, a run of a block stays whole only if it can be sliced out of it
+            ranks = [dtypes[dtype].index(key) for key in keys] if dtype is not None else []
+            whole = len({b - a for a, b in zip(ranks, ranks[1:])}) <= 1
+            for key in keys:
+                new_blocks[key] = (keys[0] if whole else key) if dtype is not None else None
+        for (block, new_block), keys in _runs(self.columns, lambda key: (self.blocks.get(key), new_blocks[key])):
+            dtype = _dtype(record[keys[0]]) if new_block is not None else None
+            if not self.rows:
+                new = cast = dtype
+            else:
+                first = None if block is None else (self.dtypes[keys[0]], all(self.empty[key] for key in keys))
+                second = None if dtype is None else (dtype, all(record[key] is None for key in keys))
+                new = _concat_dtype(first, second)
+                # The values themselves are converted by numpy, which differs for bools followed by floats
+                cast = "float" if first and second and (first[0], second[0]) == ("bool", "float") else new
+            self.block_count += 1
+            for key in keys:
+                column = self.columns[key]
+                if self.dtypes.get(key) != new and cast in ("int", "float"):
+                    column[:] = [_numeric(value, cast) for value in column]
+                value = record.get(key)
+                column.append(_numeric(value, cast))
+                self.dtypes[key] = new
+                self.blocks[key] = self.block_count
+                self.empty[key] = self.empty.get(key, True) and value is None
+        self.rows += 1
+
+    def __len__(self) -> int:
+        return self.rows
+
+    def write_csv(
+        self,
+        path: str,
+        sep: str = '|',
+    ):
+        """
+        Stream the records into a csv, with the same layout pandas writes (index in the first column)
+        """
+        with open(path, "w", newline="", encoding="utf-8") as f:
+            self._write_csv(f, sep)
+
+    def to_csv(
+        self,
+        sep: str = '|',
+    ) -> str:
+        f = io.StringIO()
+        self._write_csv(f, sep)
+        return f.getvalue()
+
+    def write_parquet(
+        self,
+        path: str,
+    ):
+        """
+        Write the records as Parquet, this needs pyarrow
+        """
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise ImportError("Parquet export needs pyarrow, install it with pip install pyarrow")
+        table = pa.table({str(key): _arrow_column(column) for key, column in self.columns.items()})
+        pq.write_table(table, path)
+
+    def _write_csv(
+        self,
+        f,
+        sep: str,
+    ):
+        writer = csv.writer(f, delimiter=sep, lineterminator="\n")
+        writer.writerow([""] + list(self.columns))
+        columns = list(self.columns.values())
+        for i in range(self.rows):
+            writer.writerow([i] + [_cell(column[i]) for column in columns])
+
+
+def parse_output(
+    text: str,
+) -> dict:
+    """
+    Parse the dictionary in an answer of a model
+    Usually it is a python block, sometimes the model writes json instead, and sometimes there is no block at all
+    """
+    try:
+        # Using ast.literal_eval is inherently unsafe, but we can trust the input here
+        return ast.literal_eval(text.split("python")[1].split("```")[0])
+    except Exception:
+        pass
+    try:
+        block = text.split("json")[1].split("```")[0]
+        try:
+            return json.loads(block)
+        except Exception:
+            return ast.literal_eval(block)
+    except Exception:
+        pass
+    try:
+        return ast.literal_eval(text)
+    except Exception:
+        # A bare dictionary, e.g. from constrained decoding, followed by the end of text token
+        return ast.literal_eval(text[text.index("{"):text.rindex("}") + 1])
+
+
+def add_records(
+    records: Records,
+    outputs: dict,
+    name: str,
+    fields: dict = None,
+) -> Records:
+    """
+    Parse the {key: answer} of a model and add one record per answer, with the key in column name
+    fields is {key: {column: value}} for columns that are added to the record of a key
+    Answers that cannot be parsed are printed and logged
+    """
+    for key, results in parse_outputs(outputs).items():
+        results[name] = key
+        if fields is not None:
+            results.update(fields.get(key, {}))
+        records.append(results)
+    return records
+
+
+def parse_outputs(
+    outputs: dict,
+) -> dict:
+    """
+    Parse the {key: answer} of a model into {key: dictionary}, leaving out answers that cannot be parsed
+    """
+    log = logging.getLogger(__name__)
+    parsed = {}
+    for key in outputs:
+        try:
+            results = parse_output(outputs[key])
+            if not isinstance(results, dict):
+                raise ValueError(f"expected a dictionary, got {type(results).__name__}")
+        except Exception as e:
+            print(f"Could not parse {key}; Exception: {e}")
+            log.info(outputs[key])
+            continue
+        parsed[key] = results
+    return parsed
+
+
+def _dtype(
+    value,
+) -> str:
+    """
+    The dtype pandas gives a column of a single record with this value
+    """
+    if isinstance(value, bool):
+        return "bool"
+    if isinstance(value, int):
+        return "int"
+    if isinstance(value, float):
+        return "float"
+    return "object"
+
+
+def _runs(
+    keys,
+    group,
+) -> list:
+    """
+    Split keys into runs of neighbours in the same group, as [(group, [key])]
+    """
+    runs = []
+    for key in keys:
+        if not runs or runs[-1][0] != group(key):
+            runs.append((group(key), []))
+        runs[-1][1].append(key)
+    return runs
+
+
+def _concat_dtype(
+    first,
+    second,
+) -> str:
+    """
+    The dtype pandas gives a column when it concatenates two frames
+    Each side is (dtype, whether all values are None), or None if the frame does not have the column
+    """
+    present = [unit for unit in (first, second) if unit is not None]
+    if len(present) == 2 and first[0] == second[0]:
+        return first[0]
+    # Columns of only None do not count, unless there is nothing else
+    dtypes = [dtype for dtype, empty in present if not empty] or [dtype for dtype, empty in present]
+    if len(set(dtypes)) == 1:
+        dtype = dtypes[0]
+    elif dtypes == ["bool", "float"]:
+        # pandas keeps objects here, but numpy has already turned the bools into floats
+        dtype = "object"
+    elif set(dtypes) <= {"bool", "int", "float"}:
+        # Like numpy, bools become 0 and 1 next to numbers
+        dtype = "float" if "float" in dtypes else "int"
+    else:
+        dtype = "object"
+    if len(present) < 2:
+        # The missing values are NaN, which ints and bools cannot hold
+        dtype = {"int": "float", "bool": "object"}.get(dtype, dtype)
+    if dtype in ("int", "bool") and any(empty for dtype, empty in present):
+        # Neither can they hold None
+        dtype = "object"
+    return dtype
+
+
+def _numeric(
+    value,
+    dtype: str,
+):
+    """
+    A value as pandas stores it in a column of dtype
+    """
+    if value is None:
+        return None
+    if dtype == "int":
+        return int(value)
+    if dtype == "float":
+        return float(value)
+    return value
+
+
+def _cell(
+    value,
+) -> str:
+    if value is None:
+        return ""
+    return str(value)
+
+
+def _arrow_column(
+    column: list,
+) -> list:
+    """
+    Keep a column as it is if all values are of one scalar type, else make it strings
+    Nested lists and dicts of the models become their string representation, as in the csv
+    """
+    types = {type(value) for value in column if value is not None}
+    if len(types) == 1 and types <= {str, int, float, bool}:
+        return column
+    if types <= {int, float}:
+        return [None if value is None else float(value) for value in column]
+    return [None if value is None else str(value) for value in column]
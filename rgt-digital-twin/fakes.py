@@ -0,0 +1,149 @@
+#
+# Copyright [Aug 20, 2024] [Jacqueline Lammert, Maximilian Tschochohei]
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Deterministic stand-ins for the models we call
+#
+# The tests and the pipeline benchmark use them to run our own code without
+# loading gemma-2 or sending a single request to the cloud.
+#
+
+import re
+import time
+import json
+import types
+import random
+import asyncio
+import hashlib
+import config
+
+# What the fake Gemini puts into its study summaries
+DIAGNOSES = ["Uterine carcinosarcoma", "Low-grade serous ovarian carcinoma", "Endometrial carcinoma"]
+BIOMARKERS = ["HER2 3+", "PD-L1 CPS 10", "TMB 12 mut/Mb", "MSI-high"]
+TREATMENTS = ["Carboplatin/Paclitaxel", "Pembrolizumab", "Trastuzumab-Deruxtecan"]
+
+
+class FakeSession:
+    """
+    Deterministic stand-in for an ExtractionSession
+    It answers with a dictionary of the fields of the prompt, filled from the letters where it can
+    """
+
+    def __init__(
+        self,
+        tokenizer,
+        context_length: int = 8192,
+        seconds_per_token: float = 0.0,
+    ):
+        self.model_name = "fake"
+        self.tokenizer = tokenizer
+        self.batch_size = config.local_extraction_batch_size
+        self.seconds_per_token = seconds_per_token
+        self._context_length = context_length
+        self.generation_calls = 0
+        self.generated_tokens = 0
+        self.prompts = 0
+
+    def context_length(self) -> int:
+        return self._context_length
+
+    def count_tokens(
+        self,
+        text: str,
+    ) -> int:
+        return len(self.tokenizer(text)["input_ids"])
+
+    def generate_batch(
+        self,
+        prompts: list,
+        max_new_tokens: int,
+        prefix: str = "",
+        callback = None,
+        schema: dict = None,
+        stage: str = "generation",
+    ) -> list:
+        from constrained import prompt_schema
+
+        fields = schema or prompt_schema(prefix)
+        answers = []
+        for n, prompt in enumerate(prompts):
+            answers.append(fake_answer(prompt, fields))
+            tokens = self.count_tokens(answers[-1])
+            self.generated_tokens += tokens
+            time.sleep(tokens * self.seconds_per_token)
+            if callback is not None:
+                callback(n, answers[-1])
+        self.generation_calls += 1
+        self.prompts += len(prompts)
+        return answers
+
+    def report(self) -> str:
+        return f"Fake model: {self.prompts} prompts, {self.generated_tokens} tokens"
+
+
+class FakeGemini:
+    """
+    Deterministic stand-in for the Gemini model of a LiteratureEngine, with a fixed latency per request
+    """
+
+    def __init__(
+        self,
+        latency: float = 0.05,
+        diagnoses: list = DIAGNOSES,
+        biomarkers: list = BIOMARKERS,
+        treatments: list = TREATMENTS,
+    ):
+        self.latency = latency
+        self.diagnoses = diagnoses
+        self.biomarkers = biomarkers
+        self.treatments = treatments
+
+    async def generate_content_async(
+        self,
+        contents,
+        generation_config = None,
+        safety_settings = None,
+    ):
+        await asyncio.sleep(self.latency)
+        rng = random.Random(hashlib.sha256(repr(contents).encode()).digest())
+        text = json.dumps({
+            "study_title": f"Study {rng.randint(1, 999)}",
+            "diagnosis": rng.choice(self.diagnoses),
+            "biomarkers": rng.sample(self.biomarkers, 2),
+            "treatment": rng.choice(self.treatments),
+        })
+        return types.SimpleNamespace(text=f"```json\n{text}\n```", usage_metadata=types.SimpleNamespace(
+            prompt_token_count=sum(len(str(content).split()) for content in contents),
+            cached_content_token_count=0,
+        ))
+
+
+def fake_answer(
+    prompt: str,
+    fields: dict,
+) -> str:
+    """
+    The dictionary the fake model answers with, with what the letters or earlier answers say and N/A for the rest
+    """
+    answer = {field: "N/A" for field in fields}
+    diagnosis = re.search(r"(?:Diagnose:|'diagnosis': ')\s*([^'\n]+)", prompt)
+    if diagnosis and "diagnosis" in answer:
+        answer["diagnosis"] = diagnosis.group(1).strip()
+    age = re.search(r"(?:Alter:|'age':)\s*(\d+)", prompt)
+    if age and "age" in answer:
+        answer["age"] = int(age.group(1))
+    if "biomarkers" in answer:
+        biomarkers = re.search(r"Biomarker:\s*([^\n]+)", prompt)
+        answer["biomarkers"] = biomarkers.group(1).strip().split(", ") if biomarkers else []
+    return f"```python\n{answer}\n```"
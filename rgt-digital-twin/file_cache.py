@@ -0,0 +1,141 @@
+#
+# Copyright [Aug 20, 2024] [Jacqueline Lammert, Maximilian Tschochohei]
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# This class holds the on-disk store behind the document and the response cache
+#
+# Every entry is a gzipped JSON file named after its key. Entries are written to
+# a temporary file first, so a crash never leaves half an entry behind, and
+# reading an entry touches it. When the store grows beyond its size cap we evict
+# the entries that were used least recently.
+#
+
+import os
+import gzip
+import json
+import hashlib
+
+
+class FileCache:
+    """
+    Store of JSON values on disk, keyed by a hash
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        max_bytes: int,
+    ):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def get(
+        self,
+        key: str,
+    ):
+        """
+        Return the value for a key, or None if we don't have it or it expired
+        """
+        path = self._path(key)
+        try:
+            with gzip.open(path, "rt", encoding="utf-8") as f:
+                value = json.load(f)
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+        if not self._fresh(value):
+            os.remove(path)
+            self.expired += 1
+            self.misses += 1
+            return None
+        # Touch the entry so eviction knows it was used recently
+        os.utime(path)
+        self.hits += 1
+        return value
+
+    def put(
+        self,
+        key: str,
+        value,
+    ):
+        """
+        Store a value, call evict() once you are done adding entries
+        """
+        path = self._path(key)
+        temporary = f"{path}.{os.getpid()}.tmp"
+        with gzip.open(temporary, "wt", encoding="utf-8") as f:
+            json.dump(value, f, ensure_ascii=False)
+        os.replace(temporary, path)
+
+    def evict(self):
+        """
+        Delete least recently used entries until the cache fits into max_bytes
+        """
+        entries = []
+        total = 0
+        for name in os.listdir(self.directory):
+            if not name.endswith(".json.gz"):
+                continue
+            stat = os.stat(os.path.join(self.directory, name))
+            entries.append((stat.st_mtime, stat.st_size, name))
+            total += stat.st_size
+
+        for mtime, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def clear(self):
+        """
+        Delete all entries
+        """
+        for name in os.listdir(self.directory):
+            if name.endswith(".json.gz") or name.endswith(".tmp"):
+                os.remove(os.path.join(self.directory, name))
+
+    def _fresh(
+        self,
+        value,
+    ) -> bool:
+        """
+        Whether a stored value may still be used, caches with expiring entries override this
+        """
+        return True
+
+    def _path(
+        self,
+        key: str,
+    ) -> str:
+        return os.path.join(self.directory, f"{key}.json.gz")
+
+
+def file_digest(
+    path: str,
+):
+    """
+    sha256 of the contents of a file, read block by block so large scans do not end up in memory
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest
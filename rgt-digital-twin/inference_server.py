@@ -0,0 +1,388 @@
+#
+# Copyright [Aug 20, 2024] [Jacqueline Lammert, Maximilian Tschochohei]
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# This module keeps the local model warm between extraction runs
+#
+# Loading gemma-2 takes minutes and we run the extraction ward by ward many
+# times a day. The server loads the model once and answers generate requests
+# over HTTP on the local machine. Requests go onto a queue, and one worker takes
+# every waiting request with the same prompt prefix and generates them as one
+# batch, so several runs at the same time still fill the batches of the model.
+# The client looks like an ExtractionSession to ehr_extraction.py, it only loads
+# the tokenizer to chunk the records and sends the prompts to the server.
+#
+# Start the server with: python rgt-digital-twin/inference_server.py
+# and the extraction with: python rgt-digital-twin/ehr_extraction.py ehr --server
+#
+# The server binds to localhost by default. Prompts contain patient data, so
+# never expose it beyond the machine or the hospital network.
+#
+
+import json
+import time
+import queue
+import logging
+import threading
+import http.client
+import urllib.parse
+import concurrent.futures
+import config
+import instrumentation
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class InferenceServer:
+    """
+    HTTP server that owns an ExtractionSession and batches the generate requests of all clients
+    """
+
+    def __init__(
+        self,
+        session,
+        host: str = config.inference_server_host,
+        port: int = config.inference_server_port,
+        batch_wait: float = config.inference_server_batch_wait,
+    ):
+        self.session = session
+        self.batch_wait = batch_wait
+        self.requests = queue.Queue()
+        self.served = 0
+        self.batches = 0
+        self.httpd = ThreadingHTTPServer((host, port), _handler(self))
+        self.httpd.daemon_threads = True
+        self.worker = threading.Thread(target=self._work, daemon=True)
+
+    @property
+    def address(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        """
+        Serve in the background, e.g. for a benchmark or a stub
+        """
+        self.worker.start()
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def serve_forever(self):
+        self.worker.start()
+        print(f"Serving {self.session.model_name} on {self.address}")
+        try:
+            self.httpd.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.shutdown()
+
+    def shutdown(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.requests.put(None)
+
+    def info(self) -> dict:
+        """
+        What a client needs to know about the model
+        """
+        return {
+            "model_name": self.session.model_name,
+            "context_length": self.session.context_length(),
+            "batch_size": self.session.batch_size,
+        }
+
+    def report(self) -> str:
+        return (f"Server: {self.served} requests in {self.batches} batches. "
+                + self.session.report())
+
+    def generate(
+        self,
+        request: dict,
+    ) -> list:
+        """
+        Queue a request ({prompts, max_new_tokens, prefix, schema}) and wait until the worker generated it
+        """
+        request["done"] = threading.Event()
+        self.requests.put(request)
+        request["done"].wait()
+        if "error" in request:
+            raise request["error"]
+        return request["answers"]
+
+    def _work(self):
+        """
+        Take the next request and every other waiting request with the same settings, and generate them together
+        """
+        pending = []
+        while True:
+            request = pending.pop(0) if pending else self.requests.get()
+            if request is None:
+                return
+            # Give clients that send at the same moment a chance to join the batch
+            if self.batch_wait:
+                time.sleep(self.batch_wait)
+            batch = [request]
+            while True:
+                try:
+                    other = self.requests.get_nowait()
+                except queue.Empty:
+                    break
+                if other is None:
+                    self.requests.put(None)
+                    break
+                if _batch_key(other) == _batch_key(request):
+                    batch.append(other)
+                else:
+                    pending.append(other)
+
+            prompts = [prompt for item in batch for prompt in item["prompts"]]
+            try:
+                answers = self.session.generate_batch(prompts, max_new_tokens=request["max_new_tokens"],
+                                                      prefix=request["prefix"], schema=request["schema"],
+                                                      stage=request["stage"])
+            except Exception as e:
+                for item in batch:
+                    item["error"] = e
+                    item["done"].set()
+                continue
+            self.batches += 1
+            self.served += len(batch)
+            logging.getLogger(__name__).info(f"Generated {len(prompts)} prompts of {len(batch)} requests in one batch")
+            for item in batch:
+                item["answers"], answers = answers[:len(item["prompts"])], answers[len(item["prompts"]):]
+                item["done"].set()
+
+
+class InferenceClient:
+    """
+    Stands in for an ExtractionSession and sends the prompts to an InferenceServer
+    Prompts are sent in slices over a pool of connections, so the server always has a full batch to work on
+    """
+
+    def __init__(
+        self,
+        url: str = None,
+        connections: int = config.inference_client_connections,
+        tokenizer = None,
+        timeout: float = config.inference_client_timeout,
+    ):
+        self.url = url or f"http://{config.inference_server_host}:{config.inference_server_port}"
+        self.connections = connections
+        self.timeout = timeout
+        self.local = threading.local()
+        self.requests = 0
+        self.request_seconds = 0.0
+
+        info = self._call("GET", "/info")
+        self.model_name = info["model_name"]
+        self.batch_size = info["batch_size"]
+        self._context_length = info["context_length"]
+        print(f"Using {self.model_name} on {self.url}")
+
+        # Chunking needs the tokenizer of the model, which loads in a second without the weights
+        if tokenizer is None:
+            from transformers import AutoTokenizer
+
+            tokenizer = AutoTokenizer.from_pretrained(self.model_name)
+        self.tokenizer = tokenizer
+
+    def context_length(self) -> int:
+        return self._context_length
+
+    def count_tokens(
+        self,
+        text: str,
+    ) -> int:
+        """
+        Count the tokens of a text as the model sees it
+        """
+        return len(self.tokenizer(text)["input_ids"])
+
+    def generate(
+        self,
+        prompt: str,
+        max_new_tokens: int,
+        prefix: str = "",
+        schema: dict = None,
+        stage: str = "generation",
+    ) -> str:
+        return self.generate_batch([prompt], max_new_tokens, prefix, schema=schema, stage=stage)[0]
+
+    def generate_batch(
+        self,
+        prompts: list,
+        max_new_tokens: int,
+        prefix: str = "",
+        callback = None,
+        schema: dict = None,
+        stage: str = "generation",
+    ) -> list:
+        """
+        Same as ExtractionSession.generate_batch, the server does the batching
+        Returns the decoded answers in order, and None for prompts that failed
+        """
+        size = max(1, self.batch_size)
+        slices = [list(range(i, min(i + size, len(prompts)))) for i in range(0, len(prompts), size)]
+        answers = [None] * len(prompts)
+        with concurrent.futures.ThreadPoolExecutor(self.connections) as pool:
+            futures = {pool.submit(self._call, "POST", "/generate", {
+                "prompts": [prompts[n] for n in numbers],
+                "max_new_tokens": max_new_tokens,
+                "prefix": prefix,
+                "schema": schema,
+                "stage": stage,
+            }): numbers for numbers in slices}
+            for future in concurrent.futures.as_completed(futures):
+                numbers = futures[future]
+                try:
+                    for n, answer in zip(numbers, future.result()["answers"]):
+                        answers[n] = answer
+                except Exception as e:
+                    print(f"My apologies, extraction for chunks {numbers[0] + 1} to {numbers[-1] + 1} failed: "
+                          f"Exception: {e}")
+                if callback is not None:
+                    for n in numbers:
+                        callback(n, answers[n])
+        return answers
+
+    def report(self) -> str:
+        """
+        Summarize our requests and what the server did for all its clients
+        """
+        report = f"Client: {self.requests} requests in {self.request_seconds:.1f}s. "
+        try:
+            report += self._call("GET", "/report")["report"]
+        except Exception as e:
+            report += f"No report from the server: {e}"
+        logging.getLogger(__name__).info(report)
+        return report
+
+    def _call(
+        self,
+        method: str,
+        path: str,
+        body: dict = None,
+    ) -> dict:
+        """
+        Send a request on the connection of this thread, reconnecting once if the server closed it
+        """
+        start = time.perf_counter()
+        data = json.dumps(body).encode() if body is not None else None
+        with instrumentation.span("request", path) as span:
+            for attempt in range(2):
+                connection = getattr(self.local, "connection", None)
+                if connection is None:
+                    url = urllib.parse.urlsplit(self.url)
+                    connection = http.client.HTTPConnection(url.hostname, url.port, timeout=self.timeout)
+                    self.local.connection = connection
+                try:
+                    connection.request(method, path, body=data, headers={"Content-Type": "application/json"})
+                    response = connection.getresponse()
+                    payload = json.loads(response.read() or b"{}")
+                    break
+                except (http.client.HTTPException, ConnectionError):
+                    connection.close()
+                    self.local.connection = None
+                    if attempt:
+                        raise
+                    span["retries"] = 1
+            if response.status != 200:
+                raise RuntimeError(payload.get("error", f"HTTP {response.status}"))
+            if body is not None:
+                span["prompts"] = len(body["prompts"])
+        self.requests += 1
+        self.request_seconds += time.perf_counter() - start
+        return payload
+
+
+def _batch_key(
+    request: dict,
+) -> tuple:
+    """
+    Requests can share a batch if they generate with the same settings
+    """
+    schema = request["schema"]
+    return (request["max_new_tokens"], request["prefix"], tuple(schema.items()) if schema else None)
+
+
+def _handler(
+    server: InferenceServer,
+):
+    """
+    Request handler class bound to a server
+    """
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            if self.path == "/info":
+                self._reply(200, server.info())
+            elif self.path == "/report":
+                self._reply(200, {"report": server.report()})
+            else:
+                self._reply(404, {"error": f"Unknown path {self.path}"})
+
+        def do_POST(self):
+            if self.path != "/generate":
+                self._reply(404, {"error": f"Unknown path {self.path}"})
+                return
+            try:
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+                request = {
+                    "prompts": [str(prompt) for prompt in body["prompts"]],
+                    "max_new_tokens": int(body["max_new_tokens"]),
+                    "prefix": str(body.get("prefix") or ""),
+                    "schema": body.get("schema"),
+                    "stage": str(body.get("stage") or "generation"),
+                }
+            except Exception as e:
+                self._reply(400, {"error": f"Bad request: {e}"})
+                return
+            try:
+                self._reply(200, {"answers": server.generate(request)})
+            except Exception as e:
+                self._reply(500, {"error": str(e)})
+
+        def _reply(self, status, payload):
+            data = json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            # The default handler prints every request to stderr
+            logging.getLogger(__name__).debug(format % args)
+
+    return Handler
+
+
+def main():
+    logging.basicConfig(filename='inference_server.log',
+                    filemode='a',
+                    format='%(asctime)s,%(msecs)d %(name)s %(levelname)s %(message)s',
+                    datefmt='%H:%M:%S',
+                    level=logging.INFO)
+
+    from local_model import ExtractionSession
+
+    instrumentation.start("inference_server")
+    InferenceServer(ExtractionSession()).serve_forever()
+    instrumentation.finish()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,399 @@
+#
+# Copyright [Aug 20, 2024] [Jacqueline Lammert, Maximilian Tschochohei]
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# This module extracts the text of EHR documents in parallel
+#
+# Documents are split into tasks of a few pages each and the tasks are spread
+# over a pool of processes, so one long scanned letter does not keep all other
+# cores waiting. Tesseract is the slow part, so this is where it pays off.
+#
+# PDF pages without a text layer (scans) are rasterized a few pages at a time
+# and OCRed, so even a 300 page scan never has all its bitmaps in memory.
+#
+
+import os
+import time
+import logging
+import multiprocessing
+import pytesseract
+import docx
+import config
+import instrumentation
+from doc_cache import DocumentCache
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from PyPDF2 import PdfReader
+from pdf2image import convert_from_path
+
+
+def ingest(
+    filepath: str,
+    docs: list,
+    workers: int = config.ingestion_workers,
+    cache: DocumentCache = None,
+) -> dict:
+    """
+    Extract the pages of every doc in filepath and return them as a {doc: [pages]} dict
+    Docs that fail are reported and left out, they do not stop the other docs
+    Docs we find in the cache are not extracted again
+    """
+    output = {}
+    for group, pages in ingest_patients(filepath, {None: docs}, workers, cache):
+        output.update(pages)
+    return output
+
+
+def ingest_patients(
+    filepath: str,
+    patients: dict,
+    workers: int = config.ingestion_workers,
+    cache: DocumentCache = None,
+):
+    """
+    Extract the docs of every patient in a {patient: [docs]} dict
+    Yields (patient, {doc: [pages]}) as soon as all docs of a patient are done
+    We only start on the next patients while fewer than two tasks per worker are running,
+    so a consumer that stops taking patients also stops the extraction
+    """
+    workers = workers or os.cpu_count() or 1
+    pool = None
+    if workers > 1:
+        # We run next to the loaded model in a threaded process, forking that can deadlock or copy the model
+        method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+        pool = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                   mp_context=multiprocessing.get_context(method))
+
+    stats = {}
+    waiting = {}
+    running = set()
+    queue = iter(patients)
+    try:
+        while True:
+            # Start on more patients while the pool has room
+            while len(running) < 2 * workers:
+                patient = next(queue, _DONE)
+                if patient is _DONE:
+                    break
+                job = _PatientJob(filepath, patient, patients[patient], cache)
+                for task in job.tasks:
+                    if pool is None:
+                        job.add(*run_task(task))
+                    else:
+                        future = pool.submit(run_task, task)
+                        waiting[future] = job
+                        running.add(future)
+                if job.done():
+                    yield patient, job.finish(stats)
+
+            if not running:
+                break
+
+            # Hand out every patient whose last task just finished
+            finished, running = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                job = waiting.pop(future)
+                job.add(*future.result())
+                if job.done():
+                    yield job.patient, job.finish(stats)
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+
+    if stats:
+        print(f"OCR on {sum(doc['ocr_pages'] for doc in stats.values())} pages, "
+              f"peak RSS per document up to {max(doc['peak_rss_mb'] for doc in stats.values()):.0f} MB")
+    if cache is not None:
+        cache.evict()
+        print(cache.report())
+
+
+# Marks the end of the patient iterator
+_DONE = object()
+
+
+class _PatientJob:
+    """
+    The docs of one patient while they are being extracted
+    """
+
+    def __init__(
+        self,
+        filepath: str,
+        patient: str,
+        docs: list,
+        cache: DocumentCache,
+    ):
+        self.patient = patient
+        self.cache = cache
+        self.tasks = []
+        self.planned = []
+        self.cached = {}
+        self.keys = {}
+        self.parts = {}
+        self.stats = {}
+        self.failed = {}
+
+        for doc in docs:
+            print(f"Processing {doc}")
+            try:
+                if cache is not None:
+                    self.keys[doc] = cache.key(f"{filepath}/{doc}", document_kind(doc))
+                    self.cached[doc] = cache.get(self.keys[doc])
+                    if self.cached[doc] is not None:
+                        self.planned.append(doc)
+                        continue
+                self.tasks.extend(plan_tasks(filepath, doc))
+                self.planned.append(doc)
+            except Exception as e:
+                print(f"Sorry, I could not process {doc}. Exception: {e}")
+                self.failed[doc] = str(e)
+        self.remaining = len(self.tasks)
+
+    def add(
+        self,
+        doc: str,
+        first: int,
+        pages: list,
+        error: str,
+        task_stats: dict,
+    ):
+        """
+        Take the result of one task, we put the pages back in order when the patient is done
+        """
+        self.remaining -= 1
+        doc_stats = self.stats.setdefault(doc, {"ocr_pages": 0, "peak_rss_mb": 0.0, "seconds": 0.0, "ocr_failed": False})
+        doc_stats["ocr_pages"] += task_stats["ocr_pages"]
+        doc_stats["ocr_failed"] = doc_stats["ocr_failed"] or task_stats["ocr_failed"]
+        doc_stats["seconds"] += task_stats["seconds"]
+        doc_stats["peak_rss_mb"] = max(doc_stats["peak_rss_mb"], task_stats["peak_rss_mb"])
+        if error is not None:
+            if doc not in self.failed:
+                print(f"Sorry, I could not process {doc}. Exception: {error}")
+            self.failed.setdefault(doc, error)
+            return
+        self.parts.setdefault(doc, []).append((first, pages))
+
+    def done(self) -> bool:
+        return self.remaining == 0
+
+    def finish(
+        self,
+        stats: dict,
+    ) -> dict:
+        """
+        Put the pages of every doc in order, store them in the cache and return them as {doc: [pages]}
+        """
+        log = logging.getLogger(__name__)
+        output = {}
+        for doc in self.planned:
+            # The docs were extracted in other processes, so we record their spans here
+            doc_stats = self.stats.get(doc, {"ocr_pages": 0, "peak_rss_mb": 0.0, "seconds": 0.0, "ocr_failed": False})
+            if doc in self.failed:
+                instrumentation.record("document", doc, doc_stats["seconds"], patient=self.patient,
+                                       ocr_pages=doc_stats["ocr_pages"], error=self.failed[doc])
+                continue
+            if self.cached.get(doc) is not None:
+                output[doc] = self.cached[doc]
+                instrumentation.record("document", doc, patient=self.patient, pages=len(output[doc]), cached=True)
+                continue
+            output[doc] = [page for first, pages in sorted(self.parts.get(doc, []), key=lambda part: part[0])
+                           for page in pages]
+            instrumentation.record("document", doc, doc_stats["seconds"], patient=self.patient,
+                                   pages=len(output[doc]), ocr_pages=doc_stats["ocr_pages"],
+                                   worker_peak_rss_mb=round(doc_stats["peak_rss_mb"], 1),
+                                   ocr_failed=doc_stats["ocr_failed"])
+            if doc in self.stats:
+                stats[doc] = self.stats[doc]
+                log.info(f"Extracted {doc}: {len(output[doc])} pages, {self.stats[doc]['ocr_pages']} with OCR, "
+                         f"peak RSS {self.stats[doc]['peak_rss_mb']:.0f} MB")
+            if doc_stats["ocr_failed"]:
+                # Pages without text would otherwise come from the cache even after Tesseract is fixed
+                log.warning(f"Not caching {doc}, OCR failed for some of its pages")
+            elif self.cache is not None:
+                self.cache.put(self.keys[doc], output[doc])
+        for doc in self.failed:
+            if doc not in self.planned:
+                instrumentation.record("document", doc, patient=self.patient, error=self.failed[doc])
+        return output
+
+
+def plan_tasks(
+    filepath: str,
+    doc: str,
+) -> list:
+    """
+    Split a doc into (path, doc, kind, first page, last page) tasks
+    PDFs are split into ranges of ingestion_pages_per_task pages, everything else is a single task
+    """
+    path = f"{filepath}/{doc}"
+    kind = document_kind(doc)
+    if kind == "pdf":
+        count = len(PdfReader(path).pages)
+        step = config.ingestion_pages_per_task
+        return [(path, doc, kind, first, min(first + step, count)) for first in range(0, count, step)]
+    return [(path, doc, kind, 0, None)]
+
+
+def document_kind(
+    doc: str,
+) -> str:
+    """
+    Decide how we extract a doc from its file name
+    """
+    # If the doc is a pdf we use PyPDF2 reader (fast and accurate)
+    if "pdf" in doc.lower():
+        return "pdf"
+
+    # If the doc is a docx we use python-docx
+    elif "docx" in doc.lower():
+        return "docx"
+
+    # If the doc is a jpg or image we use pytesseract (slow)
+    elif "jpg" in doc.lower() or "png" in doc.lower():
+        return "image"
+
+    else:
+        raise Exception(f"{doc} did not match document type .pdf, .docx, .jpg, .png")
+
+
+def extract_pdf(
+    path: str,
+    first: int,
+    last: int,
+) -> tuple:
+    """
+    Extract the text of the pages first to last (exclusive) of a pdf
+    Scanned pages have no text layer, we OCR those and only those
+    Returns the pages, the number of pages we had to OCR and whether OCR failed
+    """
+    reader = PdfReader(path)
+    pages = [reader.pages[n].extract_text() for n in range(first, last)]
+
+    scanned = [n for n, page in enumerate(pages) if len((page or "").strip()) < config.ocr_min_text_chars]
+    ocr_pages = 0
+    ocr_failed = False
+    try:
+        for start, end in _windows(scanned, config.ocr_pages_per_raster):
+            # pdf2image counts pages from 1, and we only ever hold one window of bitmaps in memory
+            images = convert_from_path(path, dpi=config.ocr_dpi,
+                                       first_page=first + start + 1, last_page=first + end)
+            for n, image in zip(range(start, end), images):
+                pages[n] = pytesseract.image_to_string(image, lang=config.ocr_language)
+                ocr_pages += 1
+            del images
+    except Exception as e:
+        # Without poppler or Tesseract we still keep the text layer of the other pages
+        logging.getLogger(__name__).warning(f"OCR failed for {path}, keeping the text layer. Exception: {e}")
+        ocr_failed = True
+    return pages, ocr_pages, ocr_failed
+
+
+def _windows(
+    pages: list,
+    size: int,
+) -> list:
+    """
+    Group sorted page numbers into (start, end) ranges of consecutive pages, at most size pages each
+    """
+    windows = []
+    for n in pages:
+        if windows and windows[-1][1] == n and n - windows[-1][0] < size:
+            windows[-1][1] = n + 1
+        else:
+            windows.append([n, n + 1])
+    return [tuple(window) for window in windows]
+
+
+def extract_docx(
+    path: str,
+) -> list:
+    """
+    Extract the paragraphs of a docx, one paragraph per page
+    """
+    return [para.text for para in docx.Document(path).paragraphs]
+
+
+def extract_image(
+    path: str,
+) -> list:
+    """
+    Read the text of an image with Tesseract
+    """
+    return [pytesseract.image_to_string(path, lang=config.ocr_language)]
+
+
+def run_task(
+    task: tuple,
+) -> tuple:
+    """
+    Run one task and return (doc, first page, pages, error, stats)
+    Errors are returned as text instead of raised so a bad file never breaks the pool
+    """
+    path, doc, kind, first, last = task
+    _reset_peak_rss()
+    start = time.perf_counter()
+    ocr_pages = 0
+    ocr_failed = False
+    try:
+        if kind == "pdf":
+            pages, ocr_pages, ocr_failed = extract_pdf(path, first, last)
+        elif kind == "docx":
+            pages = extract_docx(path)
+        else:
+            pages = extract_image(path)
+            ocr_pages = 1
+        return doc, first, pages, None, {"ocr_pages": ocr_pages, "peak_rss_mb": _peak_rss_mb(),
+                                         "seconds": time.perf_counter() - start, "ocr_failed": ocr_failed}
+    except Exception as e:
+        return doc, first, None, str(e), {"ocr_pages": ocr_pages, "peak_rss_mb": _peak_rss_mb(),
+                                          "seconds": time.perf_counter() - start, "ocr_failed": ocr_failed}
+
+
+def _reset_peak_rss():
+    """
+    Reset the peak RSS of a pool worker so we can measure it per task (Linux only)
+    The main process keeps its peak, the spans of the run and the benchmarks report it
+    """
+    if not _in_worker:
+        return
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def _peak_rss_mb() -> float:
+    """
+    Peak RSS since the last reset, or since the process started where we cannot reset it
+    """
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return instrumentation.peak_rss_mb()
+
+
+# Only set in the processes of the pool
+_in_worker = False
+
+
+def _init_worker():
+    global _in_worker
+    _in_worker = True
+    # Tesseract starts its own threads, with one process per core that only gets in the way
+    os.environ["OMP_THREAD_LIMIT"] = "1"
@@ -0,0 +1,237 @@
+#
+# Copyright [Aug 20, 2024] [Jacqueline Lammert, Maximilian Tschochohei]
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# This module measures where a run spends its time
+#
+# Every unit of work (a run, a patient, a document, a chunk, a Gemini request)
+# is a span with its duration, token counts, OCR pages, retries and the peak
+# memory of the process so far. Spans are appended to a JSON lines file as soon
+# as they end, and the totals per kind of span are written as a Prometheus
+# textfile at the end of a run (for the textfile collector of node_exporter).
+# We only keep the totals in memory, so a run of 40 hours does not grow with
+# the number of spans.
+#
+# Spans nest: a span started inside another one (in the same thread or asyncio
+# task) records the id of the outer span as its parent.
+#
+# The spans contain file names and patient identifiers, but no text of the records.
+#
+
+import os
+import sys
+import json
+import time
+import uuid
+import resource
+import threading
+import contextlib
+import contextvars
+import config
+
+# Numeric attributes we add up per kind of span
+COUNTERS = ["input_tokens", "output_tokens", "cached_tokens", "pages", "ocr_pages", "retries", "records", "bytes",
+            "draft_tokens", "accepted_tokens"]
+
+_parent = contextvars.ContextVar("span", default=None)
+
+
+class Tracer:
+    """
+    Records spans of one pipeline, to a JSON lines file if spans_path is given
+    """
+
+    def __init__(
+        self,
+        pipeline: str,
+        spans_path: str = None,
+    ):
+        self.pipeline = pipeline
+        self.run = time.strftime("%Y%m%dT%H%M%S") + "-" + uuid.uuid4().hex[:6]
+        self.started = time.time()
+        self.lock = threading.Lock()
+        self.totals = {}
+        self.file = open(spans_path, "a", encoding="utf-8") if spans_path else None
+
+    @contextlib.contextmanager
+    def span(
+        self,
+        kind: str,
+        name: str = "",
+        **attributes,
+    ):
+        """
+        Measure the block inside the with statement, the caller can add attributes to the yielded dict
+        A block that raises is recorded with the error and the exception is passed on
+        """
+        id = uuid.uuid4().hex[:12]
+        token = _parent.set(id)
+        start = time.perf_counter()
+        try:
+            yield attributes
+        except Exception as e:
+            attributes["error"] = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            _parent.reset(token)
+            self.record(kind, name, time.perf_counter() - start, id=id, **attributes)
+
+    def record(
+        self,
+        kind: str,
+        name: str = "",
+        seconds: float = 0.0,
+        id: str = None,
+        **attributes,
+    ):
+        """
+        Record a span we measured ourselves, e.g. a document that was extracted in another process
+        Attributes that are None are left out
+        """
+        attributes = {key: value for key, value in attributes.items() if value is not None}
+        span = {
+            "run": self.run,
+            "pipeline": self.pipeline,
+            "kind": kind,
+            "name": name,
+            "id": id or uuid.uuid4().hex[:12],
+            "parent": _parent.get(),
+            "end": round(time.time(), 3),
+            "seconds": round(seconds, 4),
+            "peak_rss_mb": round(peak_rss_mb(), 1),
+            **attributes,
+        }
+        with self.lock:
+            totals = self.totals.setdefault(kind, {"count": 0, "seconds": 0.0, "errors": 0, "peak_rss_mb": 0.0})
+            totals["count"] += 1
+            totals["seconds"] += seconds
+            totals["errors"] += 1 if attributes.get("error") else 0
+            totals["peak_rss_mb"] = max(totals["peak_rss_mb"], span["peak_rss_mb"])
+            for counter in COUNTERS:
+                if isinstance(attributes.get(counter), (int, float)):
+                    totals[counter] = totals.get(counter, 0) + attributes[counter]
+            if self.file is not None:
+                self.file.write(json.dumps(span, default=str) + "\n")
+                self.file.flush()
+
+    def prometheus(self) -> str:
+        """
+        The totals per kind of span in the Prometheus text format
+        """
+        lines = []
+        metrics = [("spans_total", "count", "counter", "Spans that ended"),
+                   ("span_seconds_total", "seconds", "counter", "Seconds spent in spans"),
+                   ("span_errors_total", "errors", "counter", "Spans that ended with an error"),
+                   ("span_peak_rss_megabytes", "peak_rss_mb", "gauge", "Peak resident memory of the process")]
+        metrics += [(f"{counter}_total", counter, "counter", f"{counter.replace('_', ' ').capitalize()} of all spans")
+                    for counter in COUNTERS]
+        with self.lock:
+            for metric, key, kind, help in metrics:
+                samples = [(span_kind, totals[key]) for span_kind, totals in sorted(self.totals.items())
+                           if key in totals]
+                if not samples:
+                    continue
+                lines.append(f"# HELP rgt_{metric} {help}")
+                lines.append(f"# TYPE rgt_{metric} {kind}")
+                for span_kind, value in samples:
+                    lines.append(f'rgt_{metric}{{pipeline="{self.pipeline}",kind="{span_kind}"}} {value:g}')
+        lines.append("# HELP rgt_run_start_timestamp_seconds Start of the run")
+        lines.append("# TYPE rgt_run_start_timestamp_seconds gauge")
+        lines.append(f'rgt_run_start_timestamp_seconds{{pipeline="{self.pipeline}"}} {self.started:.0f}')
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(
+        self,
+        path: str,
+    ):
+        """
+        Write the textfile atomically, so the collector never reads half a file
+        """
+        with open(f"{path}.tmp", "w", encoding="utf-8") as f:
+            f.write(self.prometheus())
+        os.replace(f"{path}.tmp", path)
+
+    def report(self) -> str:
+        """
+        One line per kind of span, the slowest first
+        """
+        lines = []
+        with self.lock:
+            for kind, totals in sorted(self.totals.items(), key=lambda item: -item[1]["seconds"]):
+                counters = ", ".join(f"{totals[counter]:g} {counter.replace('_', ' ')}"
+                                     for counter in COUNTERS if totals.get(counter))
+                lines.append(f"{kind}: {totals['count']} spans, {totals['seconds']:.1f}s"
+                             + (f", {totals['errors']} errors" if totals["errors"] else "")
+                             + (f", {counters}" if counters else ""))
+        return "\n".join(lines)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+# Until a script starts its own tracer, spans only add up in memory
+tracer = Tracer("default")
+
+
+def start(
+    pipeline: str,
+) -> Tracer:
+    """
+    Start recording the spans of a script, to the files in config.py
+    """
+    global tracer
+    tracer.close()
+    spans_path = config.metrics_spans_path.format(pipeline=pipeline) if config.metrics_spans_path else None
+    tracer = Tracer(pipeline, spans_path)
+    return tracer
+
+
+def finish():
+    """
+    Write the Prometheus textfile and print where the time went
+    """
+    if config.metrics_prometheus_path:
+        tracer.write_prometheus(config.metrics_prometheus_path.format(pipeline=tracer.pipeline))
+    print(tracer.report())
+    tracer.close()
+
+
+def span(
+    kind: str,
+    name: str = "",
+    **attributes,
+):
+    return tracer.span(kind, name, **attributes)
+
+
+def record(
+    kind: str,
+    name: str = "",
+    seconds: float = 0.0,
+    **attributes,
+):
+    tracer.record(kind, name, seconds, **attributes)
+
+
+def peak_rss_mb(
+    children: bool = False,
+) -> float:
+    """
+    Peak resident memory of this process so far, or of its largest child process that has ended
+    """
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 / 1024 if sys.platform == "darwin" else peak / 1024
@@ -0,0 +1,130 @@
+#
+# Copyright [Aug 20, 2024] [Jacqueline Lammert, Maximilian Tschochohei]
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# This class holds a journal of an EHR extraction run
+#
+# Every chunk answer and every patient summary is appended to a JSON lines file
+# and synced to disk right away. If a run crashes we can resume from the journal
+# instead of starting the local model from scratch. A line that was cut off by
+# the crash is skipped when we read the journal back.
+#
+
+import os
+import json
+import time
+import hashlib
+import config
+
+
+class Journal:
+    """
+    Append-only JSON lines journal of chunk answers and patient results
+    """
+
+    def __init__(
+        self,
+        path: str = config.journal_path,
+    ):
+        self.path = path
+        self.chunks = {}
+        self.patients = {}
+        self.failures = {}
+        if os.path.exists(path):
+            self._load()
+
+    def chunk_key(
+        self,
+        prompt: str,
+    ) -> str:
+        """
+        Chunks are identified by their full prompt, so a changed prompt is not taken from the journal
+        """
+        return hashlib.sha256(prompt.encode()).hexdigest()
+
+    def record_chunk(
+        self,
+        patient: str,
+        key: str,
+        response: str,
+    ):
+        self.chunks[key] = response
+        self._append({"type": "chunk", "patient": patient, "key": key, "response": response})
+
+    def record_patient(
+        self,
+        patient: str,
+        summary: str,
+    ):
+        self.patients[patient] = summary
+        self.failures.pop(patient, None)
+        self._append({"type": "patient", "patient": patient, "summary": summary})
+
+    def record_failure(
+        self,
+        patient: str,
+        error: str,
+    ):
+        self.failures[patient] = error
+        self.patients.pop(patient, None)
+        self._append({"type": "failed", "patient": patient, "error": error})
+
+    def completed(self) -> dict:
+        """
+        Summaries of all patients that were extracted successfully, as {patient: summary}
+        """
+        return dict(self.patients)
+
+    def failed(self) -> dict:
+        """
+        Patients whose last attempt failed, as {patient: error}
+        """
+        return dict(self.failures)
+
+    def clear(self):
+        """
+        Start a new journal for a fresh run
+        """
+        self.chunks = {}
+        self.patients = {}
+        self.failures = {}
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def _append(
+        self,
+        entry: dict,
+    ):
+        entry["time"] = time.time()
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _load(self):
+        with open(self.path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # The last line may be cut off if we crashed while writing it
+                    continue
+                if entry["type"] == "chunk":
+                    self.chunks[entry["key"]] = entry["response"]
+                elif entry["type"] == "patient":
+                    self.patients[entry["patient"]] = entry["summary"]
+                    self.failures.pop(entry["patient"], None)
+                elif entry["type"] == "failed":
+                    self.failures[entry["patient"]] = entry["error"]
+                    self.patients.pop(entry["patient"], None)
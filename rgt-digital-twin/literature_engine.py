@@ -0,0 +1,388 @@
+#
+# Copyright [Aug 20, 2024] [Jacqueline Lammert, Maximilian Tschochohei]
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# This module sends the literature requests to Gemini concurrently
+#
+# A semaphore bounds the requests in flight, a token bucket keeps us within the
+# requests per minute of the Vertex AI quota, and requests that fail with a
+# retryable error (quota, overload, timeout) are retried with exponential backoff.
+#
+# The model only needs a generate_content_async(contents, generation_config=...,
+# safety_settings=...) method that returns something with a .text, so a local fake
+# model can stand in for Gemini when we test or benchmark.
+#
+# Every PDF is read once and shared by all prompts. If there are several prompts
+# we put the PDF into a Vertex AI context cache, so its tokens are sent once and
+# billed at the cached rate for every further prompt.
+#
+# Prompts that carry all they need as text, like matching a patient against the
+# summary of a study, are sent without any document.
+#
+
+import time
+import random
+import datetime
+import hashlib
+import asyncio
+import logging
+import config
+import instrumentation
+
+from vertexai.generative_models import GenerativeModel, Part
+from response_cache import ResponseCache
+
+
+class TokenBucket:
+    """
+    Allows rate_per_minute requests per minute on average and bursts of up to burst requests
+    """
+
+    def __init__(
+        self,
+        rate_per_minute: float = config.literature_requests_per_minute,
+        burst: int = None,
+    ):
+        self.rate = rate_per_minute / 60
+        self.capacity = burst or max(1, int(rate_per_minute // 6))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        """
+        Wait until we are allowed to send the next request
+        """
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+def is_retryable(
+    e: Exception,
+) -> bool:
+    """
+    Check if a request failed for a reason that may go away if we try again
+    """
+    # google.api_core exceptions carry the HTTP status code
+    code = getattr(e, "code", None)
+    if isinstance(code, int) and code in (408, 429, 500, 502, 503, 504):
+        return True
+    return type(e).__name__ in (
+        "ResourceExhausted", "ServiceUnavailable", "DeadlineExceeded", "InternalServerError",
+        "TooManyRequests", "GatewayTimeout", "TimeoutError",
+    )
+
+
+class LiteratureEngine:
+    """
+    Sends many literature requests concurrently within the limits of our quota
+    Every doc is read once and shared by all prompts, on Vertex AI through a context cache
+    """
+
+    def __init__(
+        self,
+        model = None,
+        concurrency: int = config.literature_concurrency,
+        rate_per_minute: float = config.literature_requests_per_minute,
+        max_retries: int = config.literature_max_retries,
+        backoff_seconds: float = config.literature_backoff_seconds,
+        context_cache: bool = None,
+        cache: ResponseCache = None,
+    ):
+        self.model = model or config.literature_model
+        self.concurrency = concurrency
+        self.rate_per_minute = rate_per_minute
+        self.max_retries = max_retries
+        self.backoff_seconds = backoff_seconds
+        # Context caching is a Vertex AI feature, a fake model gets the doc inline
+        self.context_cache = config.literature_context_cache if context_cache is None else context_cache
+        if model is not None and context_cache is None:
+            self.context_cache = False
+        self.cache = cache
+        self.requests = 0
+        self.retries = 0
+        self.failures = 0
+        self.input_tokens = 0
+        self.cached_tokens = 0
+
+    async def generate(
+        self,
+        contents: list,
+        name: str,
+        model = None,
+    ):
+        """
+        Send one request, retrying with exponential backoff on retryable errors
+        Returns the response text, or None if the request failed for good
+        """
+        log = logging.getLogger(__name__)
+        model = model or self.model
+        with instrumentation.span("request", name) as span:
+            for attempt in range(self.max_retries + 1):
+                span["retries"] = attempt
+                async with self._semaphore:
+                    await self._bucket.acquire()
+                    try:
+                        self.requests += 1
+                        response = await model.generate_content_async(
+                            contents,
+                            generation_config=config.generation_config,
+                            safety_settings=config.safety_settings,
+                        )
+                        log.info(response)
+                        span.update(self._count_tokens(response))
+                        return response.text
+                    except Exception as e:
+                        if not is_retryable(e) or attempt == self.max_retries:
+                            print(f"Error in {name}: {e}")
+                            self.failures += 1
+                            span["error"] = f"{type(e).__name__}: {e}"
+                            return None
+                        error = e
+                # Back off outside of the semaphore so other requests can go ahead
+                delay = self.backoff_seconds * 2 ** attempt * (1 + random.random())
+                print(f"Retrying {name} in {delay:.1f}s: {error}")
+                self.retries += 1
+                await asyncio.sleep(delay)
+
+    async def process_docs(
+        self,
+        filepath: str,
+        docs: list,
+        prompts: dict,
+    ) -> dict:
+        """
+        Run every prompt of a {name: prompt} dict on every doc, all at the same time
+        Returns {name: {doc: text}} with None for docs that failed
+        """
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        self._documents = asyncio.Semaphore(self.concurrency)
+        self._bucket = TokenBucket(self.rate_per_minute)
+
+        async def run(doc):
+            # Only a few docs are held in memory at a time, and each of them is read only once
+            async with self._documents:
+                with instrumentation.span("document", doc, prompts=len(prompts)) as span:
+                    return await process(doc, span)
+
+        async def process(doc, span):
+            print(f"Processing {doc}")
+            try:
+                data = await asyncio.to_thread(read_bytes, f"{filepath}/{doc}")
+            except Exception as e:
+                print(f"Error in {doc}: {e}")
+                span["error"] = f"{type(e).__name__}: {e}"
+                return doc, {}
+
+            # Answers we already have don't need a request
+            texts = {}
+            keys = {}
+            if self.cache is not None:
+                document_hash = hashlib.sha256(data).hexdigest()
+                for name in prompts:
+                    keys[name] = self.cache.key(document_hash, prompts[name])
+                    texts[name] = self.cache.get(keys[name])
+            missing = [name for name in prompts if texts.get(name) is None]
+            span["bytes"] = len(data)
+            span["cached"] = len(prompts) - len(missing)
+            if not missing:
+                return doc, texts
+
+            pdf_file = Part.from_data(data=data, mime_type="application/pdf")
+            model, contents, context = await self._attach(doc, pdf_file, len(missing))
+            try:
+                answers = await asyncio.gather(*[
+                    self.generate(contents + [prompts[name]], f"{doc} ({name})", model) for name in missing
+                ])
+            finally:
+                await self._detach(context)
+            for name, text in zip(missing, answers):
+                texts[name] = text
+                if self.cache is not None and text is not None:
+                    self.cache.put(keys[name], text)
+            return doc, texts
+
+        output = {name: {doc: None for doc in docs} for name in prompts}
+        for doc, texts in await asyncio.gather(*[run(doc) for doc in docs]):
+            for name in texts:
+                output[name][doc] = texts[name]
+        if self.cache is not None:
+            self.cache.evict()
+        return output
+
+    def cached_answers(
+        self,
+        filepath: str,
+        docs: list,
+        prompt: str,
+    ) -> dict:
+        """
+        Answers of a prompt that are in the response cache, as {doc: text} with None for the rest
+        The docs are only read to hash them, no request is sent
+        """
+        answers = {doc: None for doc in docs}
+        if self.cache is None:
+            return answers
+        for doc in docs:
+            try:
+                data = read_bytes(f"{filepath}/{doc}")
+            except OSError:
+                continue
+            answers[doc] = self.cache.get(self.cache.key(hashlib.sha256(data).hexdigest(), prompt))
+        return answers
+
+    async def process_texts(
+        self,
+        prompts: dict,
+    ) -> dict:
+        """
+        Send text-only prompts of a {name: prompt} dict, all at the same time
+        Returns {name: text} with None for prompts that failed
+        """
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        self._bucket = TokenBucket(self.rate_per_minute)
+
+        async def run(name):
+            key = None
+            if self.cache is not None:
+                # There is no document behind a text prompt, the prompt carries everything
+                key = self.cache.key("text", prompts[name])
+                text = self.cache.get(key)
+                if text is not None:
+                    return text
+            text = await self.generate([prompts[name]], f"{name}")
+            if key is not None and text is not None:
+                self.cache.put(key, text)
+            return text
+
+        names = list(prompts)
+        answers = await asyncio.gather(*[run(name) for name in names])
+        if self.cache is not None:
+            self.cache.evict()
+        return dict(zip(names, answers))
+
+    async def _attach(
+        self,
+        doc: str,
+        pdf_file: Part,
+        uses: int,
+    ) -> tuple:
+        """
+        Make a doc available to the model and return (model, contents, cache)
+        With context caching the doc is uploaded once and the prompts only refer to it,
+        otherwise every request carries the doc itself
+        """
+        if not self.context_cache or uses < 2:
+            return self.model, [pdf_file], None
+        try:
+            from vertexai.preview import caching
+
+            cache = await asyncio.to_thread(
+                caching.CachedContent.create,
+                model_name=config.literature_model_name,
+                contents=[pdf_file],
+                ttl=datetime.timedelta(minutes=config.literature_context_cache_minutes),
+            )
+            return GenerativeModel.from_cached_content(cached_content=cache), [], cache
+        except Exception as e:
+            # Docs below the minimum size for context caching end up here, they are cheap anyway
+            logging.getLogger(__name__).info(f"No context cache for {doc}, sending it with every prompt: {e}")
+            return self.model, [pdf_file], None
+
+    async def _detach(
+        self,
+        cache,
+    ):
+        """
+        Delete the context cache of a doc once all prompts are done, we pay for every hour it is stored
+        """
+        if cache is None:
+            return
+        try:
+            await asyncio.to_thread(cache.delete)
+        except Exception as e:
+            logging.getLogger(__name__).warning(f"Could not delete context cache {cache}: {e}")
+
+    def _count_tokens(
+        self,
+        response,
+    ) -> dict:
+        """
+        Add up the tokens of a response and return them as attributes of its span
+        """
+        usage = getattr(response, "usage_metadata", None)
+        if usage is None:
+            return {}
+        tokens = {
+            "input_tokens": getattr(usage, "prompt_token_count", 0) or 0,
+            "output_tokens": getattr(usage, "candidates_token_count", 0) or 0,
+            "cached_tokens": getattr(usage, "cached_content_token_count", 0) or 0,
+        }
+        self.input_tokens += tokens["input_tokens"]
+        self.cached_tokens += tokens["cached_tokens"]
+        return tokens
+
+    def report(self) -> str:
+        return (f"Literature requests: {self.requests} sent, {self.retries} retried, {self.failures} failed, "
+                f"{self.input_tokens} input tokens of which {self.cached_tokens} from the context cache")
+
+
+def read_bytes(
+    path: str,
+) -> bytes:
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def run(
+    filepath: str,
+    docs: list,
+    prompts: dict,
+    engine: LiteratureEngine = None,
+) -> dict:
+    """
+    Run every prompt of a {name: prompt} dict on every doc and return {name: {doc: text}}
+    """
+    engine = engine or default_engine()
+    output = asyncio.run(engine.process_docs(filepath, docs, prompts))
+    print(engine.report())
+    if engine.cache is not None:
+        print(engine.cache.report())
+    return output
+
+
+def run_texts(
+    prompts: dict,
+    engine: LiteratureEngine = None,
+) -> dict:
+    """
+    Send text-only prompts of a {name: prompt} dict and return {name: text}
+    """
+    engine = engine or default_engine()
+    output = asyncio.run(engine.process_texts(prompts))
+    print(engine.report())
+    if engine.cache is not None:
+        print(engine.cache.report())
+    return output
+
+
+def default_engine() -> LiteratureEngine:
+    return LiteratureEngine(cache=ResponseCache() if config.literature_response_cache else None)
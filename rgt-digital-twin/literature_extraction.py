@@ -19,120 +19,107 @@
 
 import config
 import vertexai
-import urllib
-import warnings
-import time
-import json
-import pandas as pd
 import logging
 import sys 
-import ast
 import os
+import literature_engine
+import instrumentation
+import treatment_matching
+import argparse
+
+from study_index import StudyIndex, normalise_terms
+from export import Records, add_records, parse_outputs
 
 # For access to Gemini model
-from google.cloud import aiplatform
 from google.oauth2 import service_account
 
-from vertexai.generative_models import (
-    GenerationConfig,
-    GenerativeModel,
-    HarmBlockThreshold,
-    HarmCategory,
-    Part,
-)
-
-def process_docs(
+def list_docs(
     filepath: str,
-    prompt: str,
-) -> dict:
+) -> list:
     """
-    Process docs from a filepath using a prompt and return the output as a dict
+    List the docs in a filepath
     """
-    log = logging.getLogger(__name__)
     # First check if the directory exists
     try:
         if os.path.exists(filepath):
-            folder = os.listdir(os.path.basename(filepath))
+            return os.listdir(filepath)
     except Exception as e:
         print(f"No valid path given: {e}")
+    return []
+
+def process_docs(
+    filepath: str,
+    prompt: str,
+) -> dict:
+    """
+    Process docs from a filepath using a prompt and return the output as a dict
+    """
+    return process_prompts(filepath, {"output": prompt})["output"]
 
-    # First we initialize the dict for our output
-    output = {}
-    for doc in folder:
-        output[doc] = None
-
-    # Prompt the model to generate content for structured data extraction
-    for doc in folder:
-        if output[doc] is None:
-            print(f"Processing {doc}")
-            try:
-                with open(f"{filepath}/{doc}", "rb") as f:
-                    pdf_file = Part.from_data(data=f.read(), mime_type="application/pdf")
-                response = config.literature_model.generate_content(
-                    [pdf_file,prompt],
-                    generation_config=config.generation_config,
-                    safety_settings=config.safety_settings,
-                    )
-                log.info(response)
-                output[doc]=response.text
-            except Exception as e:
-                print(f"Error in {doc}: {e}")
-        else:
-            print(f"Skipping {doc}")
-    return output
-
-def export_csv(
+def process_prompts(
+    filepath: str,
+    prompts: dict,
+) -> dict:
+    """
+    Process docs from a filepath using several prompts at once and return {name: {doc: output}}
+    Requests run concurrently, within the concurrency and rate limits set in config.py
+    """
+    return literature_engine.run(filepath, list_docs(filepath), prompts)
+
+def export_records(
     literature: dict,
     treatments: dict,
-    sep: str,
-) -> str:
+) -> Records:
+    """
+    Parse the dictionaries generated by LLMs (this contains errors!) into one record per study and its treatment
+    That can be exported to Excel/Sheets for processing by clinicians
     """
-    Process a dataframe consisting of dictionaries generated by LLMs (this contains errors!)
-    To a csv that can be exported to Excel/Sheets for processing by clinicians 
-    """ 
-    log = logging.getLogger(__name__)
-    df = pd.DataFrame()
-    literature
-
-    for study in literature:
-        success = False
-        try:
-            # Using ast.literal_eval is inherently unsafe, but we can trust the input here
-            results = ast.literal_eval(literature[study].split("python")[1].split("```")[0])
-            results["Source"] = study
-            results["Treatment"] = treatments[study]
-            results = pd.DataFrame([results])
-            df = pd.concat([df, results], ignore_index=True)
-        except Exception as e:
-            try:
-                results = json.loads(literature[study].split("json")[1].split("```")[0])
-                results["Source"] = study
-                results["Treatment"] = treatments[study]
-                results = pd.DataFrame([results])
-                df = pd.concat([df, results], ignore_index=True)
-                success = True
-            except Exception as f:
-                try:
-                    results = ast.literal_eval(literature[study])
-                    results["Source"] = study
-                    results["Treatment"] = treatments[study]
-                    results = pd.DataFrame([results])
-                    df = pd.concat([df, results], ignore_index=True)
-                    success = True
-                except Exception as g:
-                    print(f"Could not parse {study}; Exception: {g}")                 
-                    log.info(literature[study])
-                if not success:
-                    print(f"Could not parse {study}; Exception: {f}")
-                    log.info(literature[study])
-            if not success:
-                print(f"Could not parse {study}; Exception: {e}")
-                log.info(literature[study])
-
-    return df.to_csv(sep = sep)
+    fields = {study: {"Treatment": treatments[study]} for study in literature}
+    return add_records(Records(), literature, "Source", fields)
+
+def export_matches(
+    literature: dict,
+    matches: dict,
+) -> Records:
+    """
+    Combine the study summaries with the treatments of every patient of a cohort into one record per patient and study
+    matches is {patient: {study: treatment}} as returned by treatment_matching.match_cohort
+    Studies whose summary cannot be parsed were matched on the raw summary, which goes into the Summary column
+    """
+    # Every summary is parsed once and not for every patient
+    summaries = parse_outputs({study: literature[study] for study in literature if literature[study] is not None})
+    records = Records()
+    raw = set()
+    for patient in matches:
+        for study in matches[patient]:
+            if study in summaries:
+                records.append({"Patient": patient, **summaries[study], "Source": study, "Treatment": matches[patient][study]})
+            else:
+                # We paid for the treatment, so we keep it next to the summary as the model wrote it
+                records.append({"Patient": patient, "Summary": literature[study], "Source": study,
+                                "Treatment": matches[patient][study]})
+                raw.add(study)
+    if raw:
+        print(f"Exported the raw summaries of {len(raw)} studies that could not be parsed: {sorted(raw)}")
+    return records
+
+def parse_args(
+    argv: list,
+) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Extract study summaries and treatment suggestions from literature")
+    parser.add_argument("folder", help="folder with the literature as .pdf")
+    parser.add_argument("patient", nargs="?", help="disease information of a single patient, without any PII")
+    parser.add_argument("--cohort", help="csv of ehr_extraction.py, every patient is matched against the study summaries")
+    parser.add_argument("--sep", default="|", help="separator of the cohort csv")
+    parser.add_argument("--top-k", type=int, default=config.study_index_top_k,
+                        help="only match every patient against the k best fitting studies of the local study index, 0 matches all")
+    parser.add_argument("--recall", help="literature_matched.csv of a run with --top-k 0, to report the recall of the study index")
+    args = parser.parse_args(argv)
+    if not args.patient and not args.cohort:
+        parser.error("give either the disease information of a patient or a --cohort")
+    return args
 
 def main():
-    import logging
     logging.basicConfig(filename='literature_extraction.log',
                     filemode='a',
                     format='%(asctime)s,%(msecs)d %(name)s %(levelname)s %(message)s',
@@ -159,15 +146,61 @@ def main():
         credentials=CREDENTIALS,
     )
 
-    print(f"Folder: {sys.argv[1]}")
-    print(f"Patient information: {sys.argv[2]}")
-    folder = sys.argv[1]
-    patient = sys.argv[2]
-    summary_dict = process_docs(folder, config.literature_extraction_prompt)
-    treatment_dict = process_docs(folder, config.treatment_prompt.format(patient=patient))
-    csv = export_csv(summary_dict,treatment_dict,'|')
-    with open("literature_extracted.csv", "w") as file:
-        file.write(csv)
+    args = parse_args(sys.argv[1:])
+    instrumentation.start("literature_extraction")
+    folder = args.folder
+    print(f"Folder: {folder}")
+
+    if args.cohort:
+        # The studies are summarised once, then every patient is matched against the summaries
+        print(f"Cohort: {args.cohort}")
+        summary_dict = process_docs(folder, config.literature_extraction_prompt)
+        cohort = treatment_matching.load_cohort(args.cohort, args.sep)
+        reference = treatment_matching.load_reference(args.recall) if args.recall else None
+        matches = treatment_matching.match_cohort(cohort, summary_dict, top_k=args.top_k, reference=reference)
+        with instrumentation.span("export", "literature_matched.csv") as span:
+            records = export_matches(summary_dict, matches)
+            records.write_csv("literature_matched.csv", '|')
+            if config.export_parquet:
+                records.write_parquet("literature_matched.parquet")
+            span["records"] = len(records)
+        instrumentation.finish()
+        return
+
+    patient = args.patient
+    print(f"Patient information: {patient}")
+    engine = literature_engine.default_engine()
+    summary_dict = None
+    if args.top_k:
+        # Only summaries from the response cache are free, otherwise shortlisting would read every doc twice
+        summary_dict = engine.cached_answers(folder, list_docs(folder), config.literature_extraction_prompt)
+        if None in summary_dict.values():
+            print("Not every study summary is cached, sending both prompts for every study")
+            summary_dict = None
+    if summary_dict is not None:
+        # The treatment prompt only goes to the studies that fit the patient
+        index = StudyIndex(summary_dict)
+        shortlist = index.shortlist(normalise_terms(patient), args.top_k)
+        print(index.report({patient: shortlist}))
+        treatments = literature_engine.run(folder, shortlist, {
+            "treatment": config.treatment_prompt.format(patient=patient),
+        }, engine)["treatment"]
+        treatment_dict = {study: treatments.get(study) for study in summary_dict}
+    else:
+        # Both prompts run at the same time and share one read and upload of every doc
+        outputs = literature_engine.run(folder, list_docs(folder), {
+            "summary": config.literature_extraction_prompt,
+            "treatment": config.treatment_prompt.format(patient=patient),
+        }, engine)
+        summary_dict = outputs["summary"]
+        treatment_dict = outputs["treatment"]
+    with instrumentation.span("export", "literature_extracted.csv") as span:
+        records = export_records(summary_dict, treatment_dict)
+        records.write_csv("literature_extracted.csv", '|')
+        if config.export_parquet:
+            records.write_parquet("literature_extracted.parquet")
+        span["records"] = len(records)
+    instrumentation.finish()
 
 if __name__ == '__main__':
     main() 
\ No newline at end of file
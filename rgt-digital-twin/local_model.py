@@ -0,0 +1,613 @@
+#
+# Copyright [Aug 20, 2024] [Jacqueline Lammert, Maximilian Tschochohei]
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# This class holds the local LLM that is used by ehr_extraction.py
+#
+# Loading gemma-2 from disk takes minutes, so we load it exactly once per run
+# and hand the session to every patient instead of reloading the model
+#
+
+import time
+import copy
+import logging
+import config
+import instrumentation
+
+
+class ExtractionSession:
+    """
+    Owns the local model and tokenizer for one extraction run and keeps track
+    of how much time we spend loading the model versus generating text
+    """
+
+    def __init__(
+        self,
+        model_name: str = config.local_extraction_model,
+        preset: str = config.local_extraction_preset,
+        model = None,
+        tokenizer = None,
+        weights: str = config.local_extraction_weights,
+        draft_model: str = config.local_extraction_draft_model,
+    ):
+        """
+        Load the model from disk, or wrap a model and tokenizer that are already loaded
+        Prepared quantized weights (see model_artifacts.py) take precedence over the local-gemma preset
+        """
+        self.model_name = model_name
+        self.generation_seconds = 0.0
+        self.generation_calls = 0
+        self.generated_tokens = 0
+        self.batch_size = config.local_extraction_batch_size
+
+        # Generation ends as soon as an answer holds a complete dictionary, we count what that saves
+        self.stop_on_answer = config.local_extraction_stop_on_answer
+        self.budget_tokens = 0
+        self.stopped_early = 0
+
+        # Tokens of the vocabulary and allowed tokens per grammar state for constrained decoding, built on first use
+        self.vocabulary = None
+        self.constraint_caches = {}
+
+        # Key/value caches of the static prompt prefixes, so we prefill them only once per session
+        self.prefix_caching = config.local_extraction_prefix_cache
+        self.prefix_ids = {}
+        self.prefix_caches = {}
+        self.prefill_seconds = 0.0
+
+        start = time.perf_counter()
+        self.weights = None
+        self.preset = None
+        if model is None:
+            import model_artifacts
+
+            self.weights = model_artifacts.choose_weights(model_name) if weights == "auto" else weights
+            if self.weights:
+                # Quantized once by model_artifacts.py prepare, the weights are memory-mapped instead of read
+                print(f"Loading prepared {self.weights} weights of {model_name}")
+                model, tokenizer = model_artifacts.load(model_name, self.weights)
+            else:
+                # Review https://github.com/huggingface/local-gemma for gemma-2 local usage instructions
+                # Make sure that you load an "instruction-tuned" (it) version of gemma-2
+                from local_gemma import LocalGemma2ForCausalLM
+                from transformers import AutoTokenizer
+
+                self.preset = model_artifacts.choose_preset(model_name) if preset == "auto" else preset
+                print(f"Loading {model_name} with preset {self.preset}. This may take a while.")
+                # memory_extreme offloads to CPU when our local machine is 🐌
+                model = LocalGemma2ForCausalLM.from_pretrained(model_name, preset=self.preset)
+                tokenizer = AutoTokenizer.from_pretrained(model_name)
+        self.model = model
+        self.tokenizer = tokenizer
+        self.load_seconds = time.perf_counter() - start
+        print(f"Loaded {model_name} in {self.load_seconds:.1f}s")
+        instrumentation.record("model_load", model_name, self.load_seconds,
+                               weights=self.weights, preset=self.preset)
+
+        # Batches are padded on the left so that all prompts end right where generation starts
+        self.tokenizer.padding_side = "left"
+        if self.tokenizer.pad_token is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
+        eos_token_ids = self.model.generation_config.eos_token_id
+        if eos_token_ids is None:
+            eos_token_ids = self.tokenizer.eos_token_id
+        if isinstance(eos_token_ids, int):
+            eos_token_ids = [eos_token_ids]
+        self.eos_token_ids = set(eos_token_ids)
+
+        # A small model with the same tokenizer drafts tokens that the model verifies several at a time
+        self.draft_model = None
+        self.draft_hooks = []
+        self.draft_calls = 0
+        self.verify_calls = 0
+        self.draft_tokens = 0
+        self.accepted_tokens = 0
+        if draft_model:
+            self.use_draft(draft_model)
+
+    def use_draft(
+        self,
+        draft_model,
+        tokenizer = None,
+    ):
+        """
+        Assist generation with a draft model, given by name or already loaded, None turns assisted generation off
+        Greedy verification keeps every answer identical to the answer without the draft
+        """
+        for hook in self.draft_hooks:
+            hook.remove()
+        self.draft_model = None
+        self.draft_hooks = []
+        if draft_model is None:
+            return
+        if isinstance(draft_model, str):
+            from transformers import AutoModelForCausalLM, AutoTokenizer
+
+            start = time.perf_counter()
+            name = draft_model
+            draft_model = AutoModelForCausalLM.from_pretrained(name, torch_dtype=self.model.dtype)
+            tokenizer = AutoTokenizer.from_pretrained(name)
+            print(f"Loaded draft model {name} in {time.perf_counter() - start:.1f}s")
+            instrumentation.record("model_load", name, time.perf_counter() - start, draft=True)
+        # The model verifies the token ids of the draft, so both need the same vocabulary
+        if draft_model.config.vocab_size != self.model.config.vocab_size or (
+                tokenizer is not None and tokenizer.get_vocab() != self.tokenizer.get_vocab()):
+            print("The draft model has another vocabulary than the model, generating without it")
+            return
+        self.draft_model = draft_model.to(self.model.device).eval()
+
+        # Every forward pass of the draft proposes one token, every pass of the model verifies a draft
+        def count(name):
+            def hook(module, args, output):
+                setattr(self, name, getattr(self, name) + 1)
+            return hook
+
+        self.draft_hooks = [self.draft_model.register_forward_hook(count("draft_calls")),
+                            self.model.register_forward_hook(count("verify_calls"))]
+
+    def context_length(self) -> int:
+        """
+        Number of tokens the model can attend to, capped by local_extraction_context_length
+        """
+        length = getattr(self.model.config, "max_position_embeddings", None) or self.tokenizer.model_max_length
+        if config.local_extraction_context_length:
+            length = min(length, config.local_extraction_context_length)
+        return length
+
+    def count_tokens(
+        self,
+        text: str,
+    ) -> int:
+        """
+        Count the tokens of a text as the model sees it
+        """
+        return len(self.tokenizer(text)["input_ids"])
+
+    def generate(
+        self,
+        prompt: str,
+        max_new_tokens: int,
+        prefix: str = "",
+        schema: dict = None,
+        stage: str = "generation",
+    ) -> str:
+        """
+        Run the model on a single prompt and return the decoded answer
+        """
+        return self._generate([prompt], max_new_tokens, prefix, schema, stage)[0]
+
+    def generate_batch(
+        self,
+        prompts: list,
+        max_new_tokens: int,
+        prefix: str = "",
+        callback = None,
+        schema: dict = None,
+        stage: str = "generation",
+    ) -> list:
+        """
+        Run the model on many prompts, batch_size prompts per generate call
+        Every answer gets at most max_new_tokens, and never more than fits into the context
+        With a schema ({field: kind}, see constrained.py) every answer is a dictionary of these fields
+        All prompts start with the same prefix, which is prefilled only once per session
+        Returns the decoded answers in order, and None for prompts that failed
+        If given, callback(n, answer) is called for every prompt as soon as its batch is done
+        Every answer is recorded as a span of kind stage, e.g. chunk or summary
+        """
+        answers = []
+        i = 0
+        while i < len(prompts):
+            batch = prompts[i:i + self.batch_size]
+            try:
+                answers.extend(self._generate(batch, max_new_tokens, prefix, schema, stage))
+            except Exception as e:
+                # If the batch does not fit into memory we halve it and try again
+                if _is_out_of_memory(e) and self.batch_size > 1:
+                    self.batch_size = self.batch_size // 2
+                    _free_memory()
+                    print(f"Out of memory, reducing batch size to {self.batch_size}")
+                    instrumentation.record("retry", stage, retries=1, reason="out of memory", batch_size=self.batch_size)
+                    continue
+                # Otherwise we retry the prompts one by one so one bad chunk does not take the batch with it
+                instrumentation.record("retry", stage, retries=len(batch), reason=f"{type(e).__name__}: {e}")
+                for n, prompt in enumerate(batch):
+                    try:
+                        answers.append(self._generate([prompt], max_new_tokens, prefix, schema, stage)[0])
+                    except Exception as f:
+                        print(f"My apologies, extraction for chunk {i + n + 1} failed: Exception: {f}")
+                        instrumentation.record(stage, error=f"{type(f).__name__}: {f}")
+                        answers.append(None)
+            if callback is not None:
+                for n in range(i, i + len(batch)):
+                    callback(n, answers[n])
+            i += len(batch)
+        return answers
+
+    def _generate(
+        self,
+        prompts: list,
+        max_new_tokens: int,
+        prefix: str = "",
+        schema: dict = None,
+        stage: str = "generation",
+    ) -> list:
+        """
+        Pad the prompts to the same length and generate all of them in one call
+        Every answer is cut to the length it would have had if it was generated alone,
+        so the results are the same for any batch size
+        """
+        # Assisted generation verifies the draft of one row at a time, and constrained rows cannot take back rejected tokens
+        assisted = self.draft_model is not None and schema is None
+        if assisted and len(prompts) > 1:
+            return [self._generate([prompt], max_new_tokens, prefix, schema, stage)[0] for prompt in prompts]
+
+        model_inputs = self._tokenize(prompts, prefix)
+        prompt_lengths = model_inputs["attention_mask"].sum(dim=1).tolist()
+        padded_length = model_inputs["input_ids"].shape[1]
+
+        # Long prompts leave less room in the context, so each prompt has its own budget of new tokens
+        context_length = self.context_length()
+        budgets = [max(1, min(max_new_tokens, context_length - length)) for length in prompt_lengths]
+
+        generate_kwargs = {}
+        # Assisted generation does not continue a cache we prefilled ourselves correctly, the answers would differ
+        if prefix and self.prefix_caching and not assisted:
+            try:
+                generate_kwargs["past_key_values"] = self._prefix_cache(prefix, len(prompts), padded_length + max(budgets))
+                # gemma-2 asks generate() for a hybrid cache of its own, we bring ours
+                generate_kwargs["cache_implementation"] = None
+            except Exception as e:
+                if _is_out_of_memory(e):
+                    raise
+                # Without a cache we can copy and repeat per row we generate with the full prompt instead
+                self._disable_prefix_caching(e)
+        stopping = None
+        if self.stop_on_answer:
+            from transformers import StoppingCriteriaList
+
+            stopping = AnswerComplete(self.tokenizer, padded_length, budgets)
+            generate_kwargs["stopping_criteria"] = StoppingCriteriaList([stopping])
+        if schema is not None:
+            generate_kwargs["logits_processor"] = self._constraint(schema, padded_length, len(prompts))
+        if assisted:
+            generate_kwargs["assistant_model"] = self.draft_model
+        draft_calls = self.draft_calls
+        verify_calls = self.verify_calls
+
+        start = time.perf_counter()
+        try:
+            generated_ids = self.model.generate(
+                **model_inputs.to(self.model.device),
+                max_new_tokens=max(budgets),
+                pad_token_id=self.tokenizer.pad_token_id,
+                **generate_kwargs,
+            )
+        except Exception as e:
+            if "past_key_values" not in generate_kwargs or _is_out_of_memory(e):
+                raise
+            # Not every model accepts a cache we prefilled ourselves, so we do without
+            self._disable_prefix_caching(e)
+            return self._generate(prompts, max_new_tokens, prefix, schema, stage)
+        seconds = time.perf_counter() - start
+        self.generation_seconds += seconds
+        self.generation_calls += 1
+
+        # The model echoes the prompt, we only want the answer
+        log = logging.getLogger(__name__)
+        draft = {}
+        if assisted:
+            # Every verification accepts some drafted tokens and adds one token of the model
+            draft["draft_tokens"] = self.draft_calls - draft_calls
+            draft["accepted_tokens"] = generated_ids.shape[1] - padded_length - (self.verify_calls - verify_calls)
+            self.draft_tokens += draft["draft_tokens"]
+            self.accepted_tokens += draft["accepted_tokens"]
+            log.info(f"Draft model: {draft['accepted_tokens']} of {draft['draft_tokens']} drafted tokens accepted "
+                     f"({draft['accepted_tokens'] / max(draft['draft_tokens'], 1):.0%})")
+        answers = []
+        for i, (row, budget) in enumerate(zip(generated_ids[:, padded_length:].tolist(), budgets)):
+            row = row[:budget]
+            if stopping is not None and stopping.ends[i] is not None:
+                # The answer was complete here, anything after it is padding
+                row = row[:stopping.ends[i]]
+                self.stopped_early += 1
+            for n, token in enumerate(row):
+                if token in self.eos_token_ids:
+                    row = row[:n + 1]
+                    break
+            self.generated_tokens += len(row)
+            self.budget_tokens += budget
+            log.info(f"Answer of {len(row)} tokens, {budget - len(row)} of {budget} tokens saved")
+            # The rows of a batch are generated together, every row gets its share of the time
+            instrumentation.record(stage, seconds=seconds / len(prompts), input_tokens=prompt_lengths[i],
+                                   output_tokens=len(row), batch_rows=len(prompts),
+                                   stopped_early=stopping is not None and stopping.ends[i] is not None, **draft)
+            answers.append(self.tokenizer.decode(row))
+        return answers
+
+    def _constraint(
+        self,
+        schema: dict,
+        prompt_length: int,
+        rows: int,
+    ):
+        """
+        Logits processor that keeps every row within the grammar of a schema
+        """
+        from transformers import LogitsProcessorList
+        from constrained import SchemaConstraint, Vocabulary
+
+        if self.vocabulary is None:
+            start = time.perf_counter()
+            self.vocabulary = Vocabulary(self.tokenizer, self.eos_token_ids)
+            print(f"Prepared the vocabulary for constrained decoding in {time.perf_counter() - start:.1f}s")
+        cache = self.constraint_caches.setdefault(tuple(schema.items()), {})
+        return LogitsProcessorList([SchemaConstraint(self.vocabulary, schema, prompt_length, rows, cache)])
+
+    def _tokenize(
+        self,
+        prompts: list,
+        prefix: str,
+    ):
+        """
+        Tokenize the prefix once and the prompts on their own, so every row starts with the same prefix tokens
+        The prompts are padded on the left, which puts the padding between prefix and prompt
+        """
+        import torch
+
+        if not prefix:
+            return self.tokenizer(prompts, padding=True, return_attention_mask=True, return_tensors="pt")
+
+        prefix_ids = self._prefix_ids(prefix)
+        model_inputs = self.tokenizer(prompts, padding=True, add_special_tokens=False,
+                                      return_attention_mask=True, return_tensors="pt")
+        n = len(prompts)
+        model_inputs["input_ids"] = torch.cat([prefix_ids.expand(n, -1), model_inputs["input_ids"]], dim=1)
+        model_inputs["attention_mask"] = torch.cat(
+            [torch.ones((n, prefix_ids.shape[1]), dtype=model_inputs["attention_mask"].dtype),
+             model_inputs["attention_mask"]], dim=1)
+        return model_inputs
+
+    def _prefix_ids(
+        self,
+        prefix: str,
+    ):
+        """
+        Token ids of a prefix, tokenized once per session
+        """
+        if prefix not in self.prefix_ids:
+            self.prefix_ids[prefix] = self.tokenizer(prefix, return_tensors="pt")["input_ids"]
+        return self.prefix_ids[prefix]
+
+    def _prefix_cache(
+        self,
+        prefix: str,
+        batch_size: int,
+        max_length: int,
+    ):
+        """
+        Return a copy of the key/value cache of the prefix for batch_size rows of up to max_length tokens
+        The cache itself is computed on first use and kept for the rest of the session
+        """
+        import torch
+        from transformers import DynamicCache, HybridCache
+
+        if prefix not in self.prefix_caches:
+            start = time.perf_counter()
+            with torch.no_grad():
+                outputs = self.model(input_ids=self._prefix_ids(prefix).to(self.model.device), use_cache=True)
+            self.prefill_seconds += time.perf_counter() - start
+            if outputs.past_key_values is None:
+                raise ValueError("The model did not return a key/value cache")
+            if not isinstance(outputs.past_key_values, (DynamicCache, HybridCache)):
+                raise TypeError(f"Cannot reuse a {type(outputs.past_key_values).__name__} as prefix cache")
+            self.prefix_caches[prefix] = outputs.past_key_values
+
+        if isinstance(self.prefix_caches[prefix], HybridCache):
+            return self._hybrid_cache(self.prefix_caches[prefix], self._prefix_ids(prefix).shape[1],
+                                      batch_size, max_length)
+        # generate() writes into the cache, so every call gets its own copy
+        cache = copy.deepcopy(self.prefix_caches[prefix])
+        if batch_size > 1:
+            cache.batch_repeat_interleave(batch_size)
+        return cache
+
+    def _hybrid_cache(
+        self,
+        prefix_cache,
+        prefix_length: int,
+        batch_size: int,
+        max_length: int,
+    ):
+        """
+        A new gemma-2 HybridCache for batch_size rows of up to max_length tokens that starts with the prefix
+        Its size is fixed when it is created, so it cannot be repeated per row like a DynamicCache
+        """
+        from transformers import HybridCache
+
+        # Once the prefix fills the sliding window, the sliding layers no longer hold it position by position
+        if prefix_length >= self.model.config.sliding_window:
+            raise ValueError(f"The prefix of {prefix_length} tokens does not fit into the sliding window")
+        cache = HybridCache(self.model.config, batch_size, max_length,
+                            device=self.model.device, dtype=prefix_cache.key_cache[0].dtype)
+        for layer, (keys, values) in enumerate(zip(prefix_cache.key_cache, prefix_cache.value_cache)):
+            # Offloaded models keep the cache of every layer next to the layer
+            cache.key_cache[layer] = cache.key_cache[layer].to(keys.device)
+            cache.value_cache[layer] = cache.value_cache[layer].to(values.device)
+            cache.key_cache[layer][:, :, :prefix_length] = keys[:, :, :prefix_length]
+            cache.value_cache[layer][:, :, :prefix_length] = values[:, :, :prefix_length]
+        return cache
+
+    def _disable_prefix_caching(
+        self,
+        e: Exception,
+    ):
+        """
+        Turn prefix caching off for the rest of the session and generate with the full prompt instead
+        """
+        print(f"Prefix caching does not work with this model, disabling it. Exception: {e}")
+        logging.getLogger(__name__).warning(f"Prefix caching disabled: {type(e).__name__}: {e}")
+        self.prefix_caching = False
+        self.prefix_caches = {}
+
+    def report(self) -> str:
+        """
+        Summarize load time versus generation time for the log
+        """
+        tokens_per_second = self.generated_tokens / max(self.generation_seconds, 1e-9)
+        loaded = f"{self.weights} weights" if self.weights else f"preset {self.preset}" if self.preset else "given model"
+        report = (f"Model load: {self.load_seconds:.1f}s ({loaded}), "
+                  f"generation: {self.generation_seconds:.1f}s in {self.generation_calls} calls, "
+                  f"{self.generated_tokens} tokens ({tokens_per_second:.1f} tokens/s), "
+                  f"batch size {self.batch_size}, "
+                  f"prefix prefill: {self.prefill_seconds:.1f}s for {len(self.prefix_caches)} cached prefixes, "
+                  f"{self.stopped_early} answers stopped once complete, "
+                  f"{self.budget_tokens - self.generated_tokens} of {self.budget_tokens} budgeted tokens saved")
+        if self.draft_tokens:
+            report += (f", draft model: {self.accepted_tokens} of {self.draft_tokens} drafted tokens accepted "
+                       f"({self.accepted_tokens / self.draft_tokens:.0%})")
+        logging.getLogger(__name__).info(report)
+        return report
+
+
+class AnswerComplete:
+    """
+    Stopping criterion that ends a row as soon as its answer holds a complete dictionary
+    or has used up its own budget, so a batch is done once every row is done
+    """
+
+    def __init__(
+        self,
+        tokenizer,
+        prompt_length: int,
+        budgets: list,
+    ):
+        self.tokenizer = tokenizer
+        self.prompt_length = prompt_length
+        self.budgets = budgets
+        # Number of answer tokens at which each row was complete, None while it is still running
+        self.ends = [None] * len(budgets)
+        self.checked = 0
+
+    def __call__(
+        self,
+        input_ids,
+        scores,
+        **kwargs,
+    ):
+        import torch
+
+        length = input_ids.shape[1] - self.prompt_length
+        # Assisted generation adds several tokens at once, so we check every token since the last call
+        checked = self.checked
+        self.checked = length
+        for i, row in enumerate(input_ids[:, self.prompt_length + checked:].tolist()):
+            for n, token in enumerate(row, start=checked + 1):
+                if self.ends[i] is not None or n >= self.budgets[i]:
+                    break
+                # Only a token that closes a brace or a fence can complete the answer
+                piece = self.tokenizer.decode([token])
+                if "}" in piece or "`" in piece:
+                    answer = self.tokenizer.decode(input_ids[i, self.prompt_length:self.prompt_length + n].tolist())
+                    if answer_complete(answer):
+                        self.ends[i] = n
+        done = [end is not None or length >= budget for end, budget in zip(self.ends, self.budgets)]
+        return torch.tensor(done, device=input_ids.device)
+
+
+def answer_complete(
+    text: str,
+) -> bool:
+    """
+    Check if an answer holds a complete dictionary
+    A fenced answer (```python or ```json) is complete once its fence is closed,
+    otherwise once the braces of the first dictionary are balanced again
+    """
+    fence = text.find("```")
+    if fence >= 0:
+        return text.find("```", fence + 3) >= 0
+    depth = 0
+    quote = None
+    escaped = False
+    for c in text:
+        if quote is not None:
+            if escaped:
+                escaped = False
+            elif c == "\\":
+                escaped = True
+            elif c == quote:
+                quote = None
+        elif c in "\"'":
+            if depth > 0:
+                quote = c
+        elif c == "{":
+            depth += 1
+        elif c == "}" and depth > 0:
+            depth -= 1
+            if depth == 0:
+                return True
+    return False
+
+
+def build_prompt(
+    instruction: str,
+    records: str,
+) -> str:
+    """
+    Wrap an instruction prompt from config.py and the patient records into a model prompt
+    """
+    return prompt_prefix(instruction) + prompt_suffix(records)
+
+
+def prompt_prefix(
+    instruction: str,
+) -> str:
+    """
+    The part of the prompt that is the same for every chunk
+    """
+    return f"""user: "{instruction}
+                <|start_header_id|>PATIENT RECORDS:<|end_header_id|>\n 
+                """
+
+
+def prompt_suffix(
+    records: str,
+) -> str:
+    """
+    The part of the prompt that holds the patient records
+    """
+    return f"""{records}<|end_of_text|> assistant:"""
+
+
+def _is_out_of_memory(
+    e: Exception,
+) -> bool:
+    """
+    Check if an exception means that the accelerator or the host ran out of memory
+    """
+    if isinstance(e, MemoryError):
+        return True
+    message = str(e).lower()
+    return "out of memory" in message or "can't allocate memory" in message
+
+
+def _free_memory():
+    """
+    Give cached accelerator memory back after an out of memory error
+    """
+    import gc
+    import torch
+
+    gc.collect()
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
@@ -0,0 +1,134 @@
+#
+# Copyright [Aug 20, 2024] [Jacqueline Lammert, Maximilian Tschochohei]
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# This class holds the manifest of the last EHR extraction
+#
+# For every patient we remember the files (size, mtime and hash) and the summary
+# of their last extraction. When new letters arrive we only extract the patients
+# whose files changed and take the summaries of everyone else from the manifest.
+# A change of the prompts, the model or the settings that shape the summaries
+# invalidates the whole manifest.
+#
+
+import os
+import json
+import hashlib
+import config
+from file_cache import file_digest
+
+
+class Manifest:
+    """
+    Files and summaries of the last extraction of every patient
+    """
+
+    def __init__(
+        self,
+        path: str = config.manifest_path,
+    ):
+        self.path = path
+        self.patients = {}
+        self.signature = _signature()
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                manifest = json.load(f)
+            # Summaries made with other prompts or another model are of no use to us
+            if manifest.get("signature") == self.signature:
+                self.patients = manifest["patients"]
+
+    def fingerprint(
+        self,
+        filepath: str,
+        patient: str,
+        docs: list,
+    ) -> dict:
+        """
+        Size, mtime and hash of the docs of a patient
+        We only hash a file again if its size or mtime differ from the manifest
+        """
+        known = self.patients.get(patient, {}).get("docs", {})
+        fingerprint = {}
+        for doc in docs:
+            stat = os.stat(f"{filepath}/{doc}")
+            entry = {"size": stat.st_size, "mtime": stat.st_mtime}
+            if doc in known and known[doc]["size"] == entry["size"] and known[doc]["mtime"] == entry["mtime"]:
+                entry["sha256"] = known[doc]["sha256"]
+            else:
+                entry["sha256"] = file_digest(f"{filepath}/{doc}").hexdigest()
+            fingerprint[doc] = entry
+        return fingerprint
+
+    def unchanged(
+        self,
+        patient: str,
+        fingerprint: dict,
+    ) -> bool:
+        """
+        Check if a patient has the same set of docs with the same contents as in the last extraction
+        """
+        known = self.patients.get(patient)
+        if known is None:
+            return False
+        return ({doc: entry["sha256"] for doc, entry in known["docs"].items()}
+                == {doc: entry["sha256"] for doc, entry in fingerprint.items()})
+
+    def summary(
+        self,
+        patient: str,
+    ) -> str:
+        return self.patients[patient]["summary"]
+
+    def summaries(self) -> dict:
+        """
+        Summaries of all patients in the manifest, as {patient: summary}
+        """
+        return {patient: self.patients[patient]["summary"] for patient in self.patients}
+
+    def update(
+        self,
+        patient: str,
+        fingerprint: dict,
+        summary: str,
+    ):
+        self.patients[patient] = {"docs": fingerprint, "summary": summary}
+
+    def forget(
+        self,
+        patient: str,
+    ):
+        self.patients.pop(patient, None)
+
+    def save(self):
+        """
+        Write the manifest, via a temporary file so a crash never leaves half a manifest
+        """
+        temporary = f"{self.path}.tmp"
+        with open(temporary, "w", encoding="utf-8") as f:
+            json.dump({"signature": self.signature, "patients": self.patients}, f, ensure_ascii=False)
+        os.replace(temporary, self.path)
+
+
+def _signature() -> str:
+    """
+    Hash of everything besides the files that changes the summaries
+    """
+    settings = [config.local_extraction_model, config.local_extraction_prompt, config.local_summary_prompt,
+                # How the records are deduplicated, chunked, generated and merged changes the summaries as well
+                config.dedup_threshold, config.dedup_shingle_words, config.dedup_min_words, config.dedup_permutations,
+                config.local_extraction_context_length, config.local_extraction_overlap,
+                config.local_extraction_max_new_tokens, config.local_summary_max_new_tokens,
+                config.local_extraction_constrained, config.local_reduce_group_size]
+    return hashlib.sha256(json.dumps(settings).encode()).hexdigest()
+
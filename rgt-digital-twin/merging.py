@@ -0,0 +1,143 @@
+#
+# Copyright [Aug 20, 2024] [Jacqueline Lammert, Maximilian Tschochohei]
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# This module merges the answers of the chunks of a patient
+#
+# Most fields agree between chunks (the diagnosis of a patient does not change
+# from letter to letter) or can be combined without thinking (biomarkers and
+# treatments are lists). We merge those ourselves and only ask the model when
+# two chunks disagree or an answer cannot be parsed. Answers are merged in
+# groups that fit into the context, over as many levels as a patient needs.
+#
+
+import pprint
+
+from export import parse_output
+
+# Values that mean the model found nothing
+_MISSING = {"", "n/a", "na", "none", "unknown", "not mentioned"}
+
+
+def compact(
+    answer: str,
+) -> str:
+    """
+    Reduce an answer to its dictionary without missing values, or the stripped text if it cannot be parsed
+    """
+    fields = parse(answer)
+    if fields is None:
+        return answer.strip()
+    return format_answer({key: value for key, value in fields.items() if not _is_missing(value)})
+
+
+def parse(
+    answer: str,
+):
+    """
+    The dictionary of an answer, or None if it has none
+    """
+    try:
+        fields = parse_output(answer)
+    except Exception:
+        return None
+    return fields if isinstance(fields, dict) else None
+
+
+def format_answer(
+    fields: dict,
+) -> str:
+    """
+    Write a dictionary the way the model does, so export and later levels read it like any other answer
+    """
+    return f"```python\n{pprint.pformat(fields, sort_dicts=False, width=120)}\n```"
+
+
+def merge(
+    answers: list,
+):
+    """
+    Merge the dictionaries of several answers without the model
+    Lists are joined without duplicates, other fields must agree between all answers
+    Returns the merged dictionary, or None if an answer cannot be parsed or two answers disagree
+    """
+    merged = {}
+    for answer in answers:
+        fields = parse(answer)
+        if fields is None:
+            return None
+        for key, value in fields.items():
+            if _is_missing(value):
+                continue
+            if key not in merged:
+                merged[key] = list(value) if isinstance(value, (list, tuple)) else value
+            elif isinstance(merged[key], list) and isinstance(value, (list, tuple)):
+                known = {_normalise(item) for item in merged[key]}
+                merged[key] += [item for item in value if _normalise(item) not in known]
+            elif _normalise(merged[key]) != _normalise(value):
+                return None
+    return merged
+
+
+def group(
+    answers: list,
+    budget: int,
+    size: int,
+    count_tokens,
+) -> list:
+    """
+    Split answers into consecutive groups of at most size answers and about budget tokens
+    A group always takes two answers if there are two left, so every level gets smaller
+    """
+    groups = []
+    current = []
+    tokens = 0
+    for answer in answers:
+        n = count_tokens(answer)
+        if len(current) >= 2 and (len(current) >= size or tokens + n > budget):
+            groups.append(current)
+            current = []
+            tokens = 0
+        current.append(answer)
+        tokens += n
+    if current:
+        groups.append(current)
+    return groups
+
+
+def join(
+    answers: list,
+) -> str:
+    """
+    The records we give the model when it has to merge a group itself
+    """
+    return "\n\n".join(answers)
+
+
+def _is_missing(
+    value,
+) -> bool:
+    if value is None:
+        return True
+    if isinstance(value, dict):
+        value = list(value.values())
+    if isinstance(value, (list, tuple)):
+        return len(value) == 0 or all(_is_missing(item) for item in value)
+    return str(value).strip().lower() in _MISSING
+
+
+def _normalise(
+    value,
+) -> str:
+    return " ".join(str(value).lower().split())
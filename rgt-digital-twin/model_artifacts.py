@@ -0,0 +1,292 @@
+#
+# Copyright [Aug 20, 2024] [Jacqueline Lammert, Maximilian Tschochohei]
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# This module prepares quantized copies of the local model and loads them
+#
+# Loading gemma-2 in full precision and quantizing or offloading it on the fly
+# takes minutes on every run. We quantize the weights once with quanto (int8 or
+# int4) and save them with safetensors in model_artifact_dir. Loading such an
+# artifact memory-maps the file: the model is built on the meta device and the
+# mapped tensors are assigned to it, so nothing is copied or quantized again and
+# the operating system only reads the pages we actually use.
+#
+# Usage: python rgt-digital-twin/model_artifacts.py prepare --weights int4
+#        python rgt-digital-twin/model_artifacts.py info
+#
+
+import os
+import json
+import time
+import argparse
+import config
+
+# local-gemma presets from the fastest to the one that needs the least memory, with the bytes per parameter they need on the device
+PRESETS = [("exact", 2), ("memory", 0.5), ("memory_extreme", 0)]
+
+
+def artifact_dir(
+    model_name: str,
+    weights: str,
+    directory: str = config.model_artifact_dir,
+) -> str:
+    return os.path.join(directory, f"{model_name.replace('/', '--')}-{weights}")
+
+
+def prepared(
+    model_name: str,
+    directory: str = config.model_artifact_dir,
+) -> list:
+    """
+    The weights we have an artifact of, the most precise first
+    """
+    return [weights for weights in ["int8", "int4"]
+            if os.path.exists(os.path.join(artifact_dir(model_name, weights, directory), "quantization.json"))]
+
+
+def prepare(
+    model_name: str = config.local_extraction_model,
+    weights: str = "int4",
+    directory: str = config.model_artifact_dir,
+    model = None,
+    tokenizer = None,
+) -> str:
+    """
+    Quantize a model once and save it with its tokenizer, returns the directory of the artifact
+    The model is loaded in full precision on the CPU unless it is given
+    """
+    import torch
+    from quanto import freeze
+    from quanto import safe_save
+    from safetensors.torch import save_file
+
+    if weights not in ("int8", "int4"):
+        raise ValueError(f"Unknown weights {weights}, use int8 or int4")
+    start = time.perf_counter()
+    if model is None:
+        from transformers import AutoModelForCausalLM, AutoTokenizer
+
+        print(f"Loading {model_name} in full precision. This may take a while.")
+        model = AutoModelForCausalLM.from_pretrained(model_name, torch_dtype=torch.bfloat16, low_cpu_mem_usage=True)
+        tokenizer = AutoTokenizer.from_pretrained(model_name)
+    model.eval()
+    _quantize(model, weights)
+    freeze(model)
+
+    path = artifact_dir(model_name, weights, directory)
+    os.makedirs(path, exist_ok=True)
+    # Tied weights share their storage, safetensors stores them once and we remember the other names
+    state_dict = {}
+    aliases = {}
+    storages = {}
+    for name, value in model.state_dict().items():
+        if isinstance(value, torch.Tensor) and type(value) is torch.Tensor:
+            key = (value.untyped_storage().data_ptr(), value.storage_offset(), tuple(value.shape))
+            if key in storages:
+                aliases[name] = storages[key]
+                continue
+            storages[key] = name
+            value = value.contiguous()
+        state_dict[name] = value
+    safe_save(state_dict, os.path.join(path, "model.safetensors"))
+    # Buffers that are not in the state dict (e.g. rotary frequencies) cannot be rebuilt on the meta device
+    persistent = set(model.state_dict())
+    buffers = {name: buffer.contiguous() for name, buffer in model.named_buffers() if name not in persistent}
+    save_file(buffers, os.path.join(path, "buffers.safetensors"))
+    model.config.save_pretrained(path)
+    if getattr(model, "generation_config", None) is not None:
+        model.generation_config.save_pretrained(path)
+    tokenizer.save_pretrained(path)
+    with open(os.path.join(path, "quantization.json"), "w") as f:
+        json.dump({"model": model_name, "weights": weights, "aliases": aliases}, f, indent=2)
+    print(f"Prepared {weights} weights of {model_name} in {path} in {time.perf_counter() - start:.1f}s")
+    return path
+
+
+def load(
+    model_name: str = config.local_extraction_model,
+    weights: str = "int4",
+    directory: str = config.model_artifact_dir,
+) -> tuple:
+    """
+    Load a prepared artifact with memory-mapped weights and return (model, tokenizer)
+    """
+    import torch
+    from quanto import freeze
+    from quanto import safe_load
+    from safetensors.torch import load_file
+    from transformers import AutoConfig, AutoModelForCausalLM, AutoTokenizer, GenerationConfig
+
+    path = artifact_dir(model_name, weights, directory)
+    if not os.path.exists(os.path.join(path, "quantization.json")):
+        raise FileNotFoundError(f"No {weights} weights of {model_name} in {directory}, "
+                                f"run python rgt-digital-twin/model_artifacts.py prepare --weights {weights}")
+    with open(os.path.join(path, "quantization.json")) as f:
+        aliases = json.load(f)["aliases"]
+
+    # Build the model without allocating any weights and quantize it the same way as in prepare
+    with torch.device("meta"):
+        model = AutoModelForCausalLM.from_config(AutoConfig.from_pretrained(path), torch_dtype=torch.bfloat16)
+    _quantize(model, weights)
+    freeze(model)
+
+    # safetensors maps the file, assign keeps the mapped tensors instead of copying them into the model
+    state_dict = safe_load(os.path.join(path, "model.safetensors"))
+    for alias, name in aliases.items():
+        state_dict[alias] = state_dict[name]
+    model.load_state_dict(state_dict, assign=True)
+    for name, buffer in load_file(os.path.join(path, "buffers.safetensors")).items():
+        module, _, attribute = name.rpartition(".")
+        model.get_submodule(module).register_buffer(attribute, buffer, persistent=False)
+    if os.path.exists(os.path.join(path, "generation_config.json")):
+        model.generation_config = GenerationConfig.from_pretrained(path)
+    model.eval()
+
+    # On a GPU with enough free memory we copy the weights over, otherwise we run on the mapped weights
+    if torch.cuda.is_available() and _artifact_bytes(path) * config.model_memory_headroom < torch.cuda.mem_get_info()[0]:
+        model.to("cuda")
+    return model, AutoTokenizer.from_pretrained(path)
+
+
+def choose_weights(
+    model_name: str = config.local_extraction_model,
+    directory: str = config.model_artifact_dir,
+):
+    """
+    The most precise prepared weights that fit into the available memory, or None
+    """
+    for weights in prepared(model_name, directory):
+        needed = _artifact_bytes(artifact_dir(model_name, weights, directory)) * config.model_memory_headroom
+        if needed <= available_memory():
+            return weights
+    return None
+
+
+def choose_preset(
+    model_name: str = config.local_extraction_model,
+) -> str:
+    """
+    The fastest local-gemma preset that fits into memory
+    """
+    return fitting_presets(model_name)[0]
+
+
+def fitting_presets(
+    model_name: str = config.local_extraction_model,
+) -> list:
+    """
+    The local-gemma presets whose weights fit into the memory of the GPU, or the RAM without one, the fastest first
+    memory_extreme offloads to the CPU and always fits
+    """
+    memory = accelerator_memory() or available_memory()
+    parameters = parameter_count(model_name)
+    return [preset for preset, bytes_per_parameter in PRESETS
+            if parameters * bytes_per_parameter * config.model_memory_headroom <= memory]
+
+
+def parameter_count(
+    model_name: str,
+) -> int:
+    """
+    Estimate the parameters of a model from its config, without downloading the weights
+    """
+    from transformers import AutoConfig
+
+    model_config = AutoConfig.from_pretrained(model_name)
+    model_config = getattr(model_config, "text_config", model_config)
+    hidden = model_config.hidden_size
+    heads = model_config.num_attention_heads
+    head_dim = getattr(model_config, "head_dim", None) or hidden // heads
+    kv_heads = getattr(model_config, "num_key_value_heads", None) or heads
+    attention = hidden * head_dim * (2 * heads + 2 * kv_heads)
+    mlp = 3 * hidden * model_config.intermediate_size
+    return model_config.vocab_size * hidden + model_config.num_hidden_layers * (attention + mlp)
+
+
+def available_memory() -> int:
+    """
+    Bytes of RAM we can use without swapping
+    """
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+
+
+def accelerator_memory() -> int:
+    """
+    Free bytes on the GPU, 0 without one
+    """
+    try:
+        import torch
+
+        if torch.cuda.is_available():
+            return torch.cuda.mem_get_info()[0]
+    except Exception:
+        pass
+    return 0
+
+
+def _quantize(
+    model,
+    weights: str,
+):
+    """
+    Quantize every linear layer but the output layer, which is often tied to the embeddings
+    """
+    from quanto import qint4, qint8, quantize
+
+    output = model.get_output_embeddings()
+    modules = [module for module in model.modules() if module is not output]
+    quantize(model, modules=modules, weights={"int8": qint8, "int4": qint4}[weights])
+
+
+def _artifact_bytes(
+    path: str,
+) -> int:
+    return sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path) if name.endswith(".safetensors"))
+
+
+def parse_args(
+    argv: list = None,
+) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Prepare quantized copies of the local model")
+    commands = parser.add_subparsers(dest="command", required=True)
+    prepare_parser = commands.add_parser("prepare", help="quantize the model once and save it in model_artifact_dir")
+    prepare_parser.add_argument("--weights", choices=["int8", "int4"], default="int4")
+    prepare_parser.add_argument("--model", default=config.local_extraction_model)
+    info_parser = commands.add_parser("info", help="show the prepared weights and what a run would load")
+    info_parser.add_argument("--model", default=config.local_extraction_model)
+    return parser.parse_args(argv)
+
+
+def main():
+    args = parse_args()
+    if args.command == "prepare":
+        prepare(args.model, args.weights)
+        return
+    print(f"Prepared weights of {args.model}: {', '.join(prepared(args.model)) or 'none'}")
+    print(f"Available memory: {available_memory() / 2**30:.1f} GB RAM, {accelerator_memory() / 2**30:.1f} GB GPU")
+    weights = choose_weights(args.model)
+    if weights:
+        print(f"A run loads the prepared {weights} weights")
+    else:
+        print(f"A run loads {args.model} with the local-gemma preset {choose_preset(args.model)}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+#
+# Copyright [Aug 20, 2024] [Jacqueline Lammert, Maximilian Tschochohei]
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# This class holds an on-disk cache for the answers of Gemini on literature
+#
+# An answer depends on the PDF, the prompt, the model and the generation config,
+# so that is what we key it on. The study summary does not depend on the patient,
+# so a rerun over an unchanged library does not send a single summary request.
+# Entries expire after a while, and the FileCache underneath evicts the entries
+# that were used least recently when the cache grows beyond its size cap.
+#
+
+import json
+import time
+import hashlib
+import config
+from file_cache import FileCache
+
+
+class ResponseCache(FileCache):
+    """
+    Cache for model answers, keyed by document, prompt, model and generation config
+    """
+
+    def __init__(
+        self,
+        directory: str = config.literature_cache_dir,
+        ttl_days: float = config.literature_cache_ttl_days,
+        max_bytes: int = config.literature_cache_max_mb * 1024 * 1024,
+    ):
+        super().__init__(directory, max_bytes)
+        self.ttl_seconds = ttl_days * 24 * 60 * 60
+
+    def key(
+        self,
+        document_hash: str,
+        prompt: str,
+        model_name: str = config.literature_model_name,
+        generation_config = config.generation_config,
+    ) -> str:
+        """
+        Combine everything that changes the answer into one key
+        """
+        # GenerationConfig of vertexai can give us a dict, otherwise we fall back to its repr
+        to_dict = getattr(generation_config, "to_dict", None)
+        settings = json.dumps(to_dict(), sort_keys=True) if to_dict else repr(generation_config)
+        digest = hashlib.sha256()
+        for part in [document_hash, hashlib.sha256(prompt.encode()).hexdigest(), model_name, settings]:
+            digest.update(part.encode())
+            digest.update(b"\0")
+        return digest.hexdigest()
+
+    def get(
+        self,
+        key: str,
+    ):
+        """
+        Return the cached answer for a key, or None if we don't have it or it expired
+        """
+        entry = super().get(key)
+        return None if entry is None else entry["text"]
+
+    def put(
+        self,
+        key: str,
+        text: str,
+    ):
+        """
+        Store an answer, call evict() once you are done adding entries
+        """
+        super().put(key, {"created": time.time(), "text": text})
+
+    def report(self) -> str:
+        return f"Response cache: {self.hits} hits, {self.misses} misses ({self.expired} expired)"
+
+    def _fresh(
+        self,
+        entry: dict,
+    ) -> bool:
+        return time.time() - entry["created"] <= self.ttl_seconds
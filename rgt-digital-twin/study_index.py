@@ -0,0 +1,197 @@
+#
+# Copyright [Aug 20, 2024] [Jacqueline Lammert, Maximilian Tschochohei]
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# This class holds a local index of the study summaries
+#
+# The diagnoses, biomarkers and treatments of every study summary are split into
+# normalised terms (PD-L1 and pd l1 both become pdl1, ERBB2 becomes her2) and
+# mapped to the studies they appear in. Before we ask Gemini for treatments we
+# score the studies against the diagnosis and biomarkers of a patient and only
+# send the top k. Terms that appear in few studies count more than terms that
+# appear everywhere. Studies whose summary we could not parse are always kept.
+#
+
+import re
+import math
+import config
+
+from export import parse_output
+
+# Words that tell us nothing about which study fits a patient
+STOPWORDS = {
+    "and", "or", "the", "of", "with", "without", "in", "for", "not", "to", "at", "by", "on",
+    "high", "low", "positive", "negative", "yes", "no", "none", "value", "status", "other",
+    "markers", "marker", "patient", "patients", "disease", "diagnosis", "biomarker", "biomarkers",
+}
+
+
+class StudyIndex:
+    """
+    Inverted index from normalised diagnosis, biomarker and treatment terms to studies
+    """
+
+    def __init__(
+        self,
+        summaries: dict,
+        weights: dict = config.study_index_weights,
+    ):
+        self.weights = weights
+        self.postings = {field: {} for field in weights}
+        self.studies = []
+        self.unindexed = []
+        for study in summaries:
+            try:
+                summary = parse_output(summaries[study])
+            except Exception:
+                # We cannot tell what this study is about, so it is never filtered out
+                self.unindexed.append(study)
+                continue
+            self.studies.append(study)
+            for field, terms in study_terms(summary).items():
+                for term in terms:
+                    self.postings[field].setdefault(term, set()).add(study)
+
+    def score(
+        self,
+        terms: set,
+    ) -> dict:
+        """
+        Score every study against the terms of a patient, as {study: score} for studies with a match
+        """
+        scores = {}
+        for field in self.postings:
+            for term in terms:
+                studies = self.postings[field].get(term)
+                if not studies:
+                    continue
+                idf = math.log(1 + len(self.studies) / len(studies))
+                for study in studies:
+                    scores[study] = scores.get(study, 0) + self.weights[field] * idf
+        return scores
+
+    def shortlist(
+        self,
+        terms: set,
+        top_k: int = config.study_index_top_k,
+    ) -> list:
+        """
+        The top_k studies for the terms of a patient, plus all studies we could not index
+        If no study matches at all we keep every study rather than dropping the patient
+        """
+        scores = self.score(terms)
+        if not scores:
+            return self.studies + self.unindexed
+        ranked = sorted(scores, key=lambda study: (-scores[study], study))
+        return ranked[:top_k] + self.unindexed
+
+    def report(
+        self,
+        shortlists: dict,
+        reference: dict = None,
+    ) -> str:
+        """
+        Summarise the shortlists of {patient: [studies]}
+        With a reference of {patient: {relevant studies}} from a run without the index, we also report the recall
+        """
+        total = len(self.studies) + len(self.unindexed)
+        kept = sum(len(studies) for studies in shortlists.values())
+        fallbacks = sum(len(studies) == total for studies in shortlists.values())
+        lines = [f"Study index: {len(self.studies)} studies indexed, {len(self.unindexed)} could not be parsed",
+                 f"Study index: kept {kept} of {total * len(shortlists)} patient/study pairs, "
+                 f"{fallbacks} patients without any match kept all studies"]
+        if reference:
+            found = 0
+            relevant = 0
+            for patient in reference:
+                if patient not in shortlists:
+                    continue
+                relevant += len(reference[patient])
+                found += len(reference[patient] & set(shortlists[patient]))
+                missed = reference[patient] - set(shortlists[patient])
+                if missed:
+                    lines.append(f"Study index: missed {sorted(missed)} for {patient}")
+            recall = found / relevant if relevant else 1.0
+            lines.append(f"Study index: recall {recall:.1%} ({found} of {relevant} relevant studies kept)")
+        return "\n".join(lines)
+
+
+def study_terms(
+    summary,
+    field: str = None,
+) -> dict:
+    """
+    Collect the terms of a parsed summary by field, as {field: {terms}}
+    Everything nested below a diagnosis, biomarker or treatment key belongs to that field, keys included
+    """
+    terms = {}
+    if isinstance(summary, dict):
+        for key, value in summary.items():
+            inner = field or field_of(key)
+            if inner is not None:
+                terms.setdefault(inner, set()).update(normalise_terms(key) if field else set())
+            for name, found in study_terms(value, inner).items():
+                terms.setdefault(name, set()).update(found)
+    elif isinstance(summary, (list, tuple)):
+        for value in summary:
+            for name, found in study_terms(value, field).items():
+                terms.setdefault(name, set()).update(found)
+    elif field is not None:
+        terms[field] = normalise_terms(summary)
+    return terms
+
+
+def field_of(
+    key: str,
+) -> str:
+    """
+    The field of the index a key of a summary belongs to, or None
+    """
+    key = "".join(c for c in str(key).lower() if c.isalnum())
+    if "diagnos" in key or "disease" in key:
+        return "diagnosis"
+    if "marker" in key:
+        return "biomarkers"
+    if "treatment" in key and "response" not in key:
+        return "treatment"
+    return None
+
+
+def patient_terms(
+    record: dict,
+) -> set:
+    """
+    Terms of the diagnosis and biomarkers of a patient from the csv of ehr_extraction.py
+    """
+    terms = set()
+    for column, value in record.items():
+        if field_of(column) in ("diagnosis", "biomarkers"):
+            terms |= normalise_terms(value)
+    return terms
+
+
+def normalise_terms(
+    text,
+) -> set:
+    """
+    Split text into lower case terms, joining hyphenated names like PD-L1 into pdl1 and keeping their parts
+    """
+    terms = set()
+    for word in re.findall(r"[a-z0-9]+(?:[-/][a-z0-9]+)*", str(text).lower()):
+        parts = re.split(r"[-/]", word)
+        for term in ["".join(parts)] + (parts if len(parts) > 1 else []):
+            term = config.study_index_synonyms.get(term, term)
+            if len(term) > 2 and not term.isdigit() and term not in STOPWORDS:
+                terms.add(term)
+    return terms
@@ -0,0 +1,237 @@
+#
+# Copyright [Aug 20, 2024] [Jacqueline Lammert, Maximilian Tschochohei]
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# This module makes up EHR and literature corpora for the benchmarks
+#
+# Every patient gets doctor's letters as text PDFs, scanned PDFs without a text
+# layer, DOCX reports and PNG lab sheets, named Patient-###_* like the real EHR.
+# The same seed always gives the same corpus, so benchmark results of two
+# commits are comparable. There is no real patient data in here.
+#
+# Text PDFs are written by hand (a few Helvetica text objects per page), so we
+# need no PDF library. Scans and lab sheets are drawn with Pillow.
+#
+
+import os
+import random
+import config
+
+# Letter heads repeat in every letter, like in a real EHR
+_HEADERS = [
+    "Klinikum Musterstadt - Frauenklinik - Gynaekologische Onkologie\nMusterstrasse 1, 80000 Musterstadt",
+    "Praxis fuer Haematologie und Onkologie\nBeispielweg 12, 80001 Musterstadt",
+]
+DIAGNOSES = [
+    "Karzinosarkom des Uterus", "Low-grade seroeses Ovarialkarzinom", "High-grade seroeses Ovarialkarzinom",
+    "Endometriumkarzinom", "Zervixkarzinom", "Mammakarzinom",
+]
+BIOMARKERS = ["HER2 3+", "PD-L1 CPS 10", "TMB 12 mut/Mb", "BRCA1 Mutation", "MSI-high", "ER positiv", "KRAS G12D"]
+TREATMENTS = [
+    "Carboplatin/Paclitaxel", "Pembrolizumab", "Lenvatinib/Pembrolizumab", "Trastuzumab-Deruxtecan",
+    "Olaparib", "Letrozol", "Bevacizumab",
+]
+_FINDINGS = [
+    "Im CT Thorax/Abdomen kein Hinweis auf Progress.", "Neu aufgetretene Metastasen in Lunge und Leber.",
+    "Die Patientin vertraegt die Therapie gut.", "Laborwerte im Normbereich, keine Dosisreduktion.",
+    "Tumormarker CA-125 ruecklaeufig.", "Vorstellung im Tumorboard empfohlen.",
+    "Staging nach FIGO IIIC.", "Entlassung in gutem Allgemeinzustand.",
+]
+
+
+def patient_profile(
+    rng: random.Random,
+) -> dict:
+    """
+    Make up the diagnosis, biomarkers and treatments of one patient
+    """
+    return {
+        "diagnosis": rng.choice(DIAGNOSES),
+        "biomarkers": rng.sample(BIOMARKERS, 2),
+        "treatments": rng.sample(TREATMENTS, 2),
+        "age": rng.randint(35, 85),
+    }
+
+
+def letter_pages(
+    rng: random.Random,
+    profile: dict,
+    pages: int,
+    lines_per_page: int = 40,
+) -> list:
+    """
+    The pages of one letter about a patient, with a letter head and blank lines between paragraphs
+    """
+    result = []
+    for n in range(pages):
+        lines = _HEADERS[rng.randrange(len(_HEADERS))].split("\n") + [""]
+        if n == 0:
+            lines += [f"Diagnose: {profile['diagnosis']}",
+                      f"Biomarker: {', '.join(profile['biomarkers'])}",
+                      f"Alter: {profile['age']} Jahre", ""]
+        while len(lines) < lines_per_page:
+            sentence = rng.choice(_FINDINGS)
+            if rng.random() < 0.3:
+                sentence = f"Therapie mit {rng.choice(profile['treatments'])} seit {rng.randint(1, 24)} Monaten."
+            lines.append(sentence)
+            if rng.random() < 0.2:
+                lines.append("")
+        result.append("\n".join(lines))
+    return result
+
+
+def write_corpus(
+    folder: str,
+    patients: int = 10,
+    text_pdfs: int = 2,
+    scanned_pdfs: int = 1,
+    docx: int = 1,
+    images: int = 1,
+    pages: int = 3,
+    seed: int = 0,
+) -> dict:
+    """
+    Write the documents of patients Patient-001, Patient-002, ... into folder
+    Returns {patient: profile} so a benchmark can check what the model should find
+    """
+    os.makedirs(folder, exist_ok=True)
+    rng = random.Random(seed)
+    profiles = {}
+    for i in range(1, patients + 1):
+        patient = f"{config.patient_identifier}-{i:03d}"
+        profile = patient_profile(rng)
+        profiles[patient] = profile
+        for n in range(text_pdfs):
+            write_text_pdf(f"{folder}/{patient}_arztbrief_{n + 1}.pdf", letter_pages(rng, profile, pages))
+        for n in range(scanned_pdfs):
+            write_scanned_pdf(f"{folder}/{patient}_scan_{n + 1}.pdf", letter_pages(rng, profile, pages))
+        for n in range(docx):
+            write_docx(f"{folder}/{patient}_befund_{n + 1}.docx", letter_pages(rng, profile, 1)[0])
+        for n in range(images):
+            lab = "\n".join([f"Laborbefund {patient}"] +
+                            [f"{name}: {rng.uniform(1, 200):.1f}" for name in ["CA-125", "CEA", "Hb", "Leukozyten"]])
+            write_image(f"{folder}/{patient}_labor_{n + 1}.png", lab)
+    return profiles
+
+
+def write_literature(
+    folder: str,
+    studies: int = 20,
+    pages: int = 2,
+    seed: int = 0,
+) -> list:
+    """
+    Write made up study PDFs into folder and return their file names
+    """
+    os.makedirs(folder, exist_ok=True)
+    rng = random.Random(seed)
+    docs = []
+    for i in range(1, studies + 1):
+        diagnosis = rng.choice(DIAGNOSES)
+        biomarker = rng.choice(BIOMARKERS)
+        treatment = rng.choice(TREATMENTS)
+        lines = [f"Phase II study of {treatment} in {diagnosis} with {biomarker}", "",
+                 f"Patients with {diagnosis} and {biomarker} were treated with {treatment}.",
+                 f"The objective response rate was {rng.randint(10, 60)}%, "
+                 f"median progression-free survival {rng.randint(3, 18)} months.", ""]
+        text = "\n".join(lines)
+        doc = f"study_{i:03d}.pdf"
+        write_text_pdf(f"{folder}/{doc}", [text] * pages)
+        docs.append(doc)
+    return docs
+
+
+def write_text_pdf(
+    path: str,
+    pages: list,
+):
+    """
+    Write a PDF with a text layer, one string per page
+    """
+    objects = [b"<< /Type /Catalog /Pages 2 0 R >>", None,
+               b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica /Encoding /WinAnsiEncoding >>"]
+    kids = []
+    for page in pages:
+        lines = [line.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)") for line in page.split("\n")]
+        stream = ("BT /F1 10 Tf 12 TL 50 800 Td " + " ".join(f"({line}) Tj T*" for line in lines) + " ET")
+        stream = stream.encode("latin-1", "replace")
+        objects.append(b"<< /Length %d >>\nstream\n%s\nendstream" % (len(stream), stream))
+        objects.append(b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] "
+                       b"/Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>" % len(objects))
+        kids.append(len(objects))
+    objects[1] = b"<< /Type /Pages /Kids [%s] /Count %d >>" % (
+        b" ".join(b"%d 0 R" % kid for kid in kids), len(kids))
+
+    data = b"%PDF-1.4\n"
+    offsets = []
+    for n, body in enumerate(objects):
+        offsets.append(len(data))
+        data += b"%d 0 obj\n%s\nendobj\n" % (n + 1, body)
+    xref = len(data)
+    data += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    data += b"".join(b"%010d 00000 n \n" % offset for offset in offsets)
+    data += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref)
+    with open(path, "wb") as f:
+        f.write(data)
+
+
+def write_scanned_pdf(
+    path: str,
+    pages: list,
+):
+    """
+    Write a PDF of page images without a text layer, like a scanned letter
+    """
+    images = [_render(page) for page in pages]
+    images[0].save(path, save_all=True, append_images=images[1:], resolution=150)
+
+
+def write_image(
+    path: str,
+    text: str,
+):
+    _render(text, size=(1240, 600)).save(path)
+
+
+def write_docx(
+    path: str,
+    text: str,
+):
+    from docx import Document
+
+    document = Document()
+    for paragraph in text.split("\n\n"):
+        document.add_paragraph(paragraph)
+    document.save(path)
+
+
+def _render(
+    text: str,
+    size: tuple = (1240, 1754),
+):
+    """
+    Draw text black on white at about 150 dpi, large enough for Tesseract to read
+    """
+    from PIL import Image, ImageDraw, ImageFont
+
+    image = Image.new("L", size, 255)
+    draw = ImageDraw.Draw(image)
+    try:
+        font = ImageFont.load_default(size=24)
+    except TypeError:
+        # Pillow before 10.1 only has a small bitmap font
+        font = ImageFont.load_default()
+    for n, line in enumerate(text.split("\n")):
+        draw.text((80, 80 + n * 36), line, fill=0, font=font)
+    return image
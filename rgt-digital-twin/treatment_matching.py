@@ -0,0 +1,155 @@
+#
+# Copyright [Aug 20, 2024] [Jacqueline Lammert, Maximilian Tschochohei]
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# This module matches a whole cohort against the literature in one run
+#
+# Instead of sending every PDF again for every patient, we summarise the studies
+# once (the summaries come from the response cache after the first run) and send
+# small text prompts with a patient and a study summary. Only the clinical
+# columns listed in config.cohort_fields leave the machine, the patient IDs are
+# replaced by case numbers and mapped back locally. With a study index, every
+# case is only matched against the studies that fit its diagnosis and biomarkers.
+#
+
+import pandas as pd
+import config
+import literature_engine
+
+from study_index import StudyIndex, patient_terms
+from export import parse_output
+
+
+def load_cohort(
+    path: str,
+    sep: str = '|',
+) -> dict:
+    """
+    Read the csv of ehr_extraction.py and return {patient: row} with the fields we have for every patient
+    """
+    df = pd.read_csv(path, sep=sep, index_col=0, dtype=str)
+    cohort = {}
+    for i, row in df.iterrows():
+        patient = row.get("Patient")
+        if pd.isna(patient):
+            patient = str(i)
+        cohort[patient] = {column: row[column] for column in df.columns
+                           if column != "Patient" and not pd.isna(row[column])}
+    return cohort
+
+
+def deidentify(
+    record: dict,
+    fields: list = config.cohort_fields,
+) -> str:
+    """
+    Project a patient onto the allowed fields, as "field: value" lines
+    Column names are compared without case, spaces or dashes, as the local model does not always stick to them
+    """
+    allowed = {_normalise(field) for field in fields}
+    lines = [f"{column}: {value}" for column, value in record.items() if _normalise(column) in allowed]
+    return "\n".join(lines)
+
+
+def match_prompts(
+    cases: dict,
+    summaries: dict,
+    shortlists: dict = None,
+) -> dict:
+    """
+    Build a prompt for every pair of case and study, as {(case, study): prompt}
+    With shortlists of {case: [studies]} only the shortlisted studies of a case are used
+    """
+    prompts = {}
+    for case in cases:
+        studies = shortlists[case] if shortlists is not None else summaries
+        for study in studies:
+            if summaries[study] is None:
+                continue
+            prompts[(case, study)] = config.treatment_matching_prompt.format(
+                patient=cases[case], study=summaries[study])
+    return prompts
+
+
+def match_cohort(
+    cohort: dict,
+    summaries: dict,
+    engine: literature_engine.LiteratureEngine = None,
+    top_k: int = config.study_index_top_k,
+    reference: dict = None,
+) -> dict:
+    """
+    Match every patient of a cohort against the top_k study summaries of the study index, or all of them if top_k is 0
+    Returns {patient: {study: treatment}} for the matched studies, with None for pairs that failed
+    """
+    # Patients with the same clinical picture share one request
+    cases = {}
+    patients = {}
+    terms = {}
+    for patient in cohort:
+        projection = deidentify(cohort[patient])
+        if not projection:
+            print(f"Skipping patient {patient}: none of the fields in config.cohort_fields")
+            continue
+        case = cases.setdefault(projection, f"case {len(cases) + 1}")
+        patients[patient] = case
+        terms[case] = patient_terms(cohort[patient])
+    cases = {case: projection for projection, case in cases.items()}
+
+    shortlists = None
+    if top_k:
+        # The index runs locally and costs no requests
+        index = StudyIndex({study: summaries[study] for study in summaries if summaries[study] is not None})
+        shortlists = {case: index.shortlist(terms[case], top_k) for case in cases}
+        print(index.report({patient: shortlists[patients[patient]] for patient in patients}, reference))
+
+    print(f"Matching {len(patients)} patients ({len(cases)} distinct cases) against {len(summaries)} studies")
+    prompts = match_prompts(cases, summaries, shortlists)
+    answers = literature_engine.run_texts(prompts, engine)
+    treatments = {case: {} for case in cases}
+    for case, study in answers:
+        treatments[case][study] = answers[(case, study)]
+    return {patient: treatments[patients[patient]] for patient in patients}
+
+
+def load_reference(
+    path: str,
+    sep: str = '|',
+) -> dict:
+    """
+    Read the literature_matched.csv of a run without the study index and return {patient: {relevant studies}}
+    A study is relevant for a patient if Gemini suggested a treatment from it
+    """
+    df = pd.read_csv(path, sep=sep, index_col=0, dtype=str)
+    reference = {}
+    for patient, study, treatment in zip(df["Patient"], df["Source"], df["Treatment"]):
+        relevant = reference.setdefault(patient, set())
+        if pd.isna(treatment):
+            continue
+        try:
+            answer = parse_output(treatment)
+        except Exception:
+            # We cannot tell, so we count it as relevant rather than flatter the recall
+            relevant.add(study)
+            continue
+        suggestions = [answer[key] for key in answer if "suggestion" in str(key).lower()] if isinstance(answer, dict) else [answer]
+        if any(str(suggestion).strip().lower() not in ("", "n/a", "na", "none") for suggestion in suggestions):
+            relevant.add(study)
+    return reference
+
+
+def _normalise(
+    name: str,
+) -> str:
+    return "".join(c for c in str(name).lower() if c.isalnum())
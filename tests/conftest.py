@@ -0,0 +1,70 @@
+#
+# Copyright [Aug 20, 2024] [Jacqueline Lammert, Maximilian Tschochohei]
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import os
+import re
+import sys
+import pytest
+import threading
+import vertexai
+
+from google.auth.credentials import AnonymousCredentials
+
+# The scripts import each other by name, as when they run from rgt-digital-twin
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "rgt-digital-twin"))
+
+# config.py creates the Gemini model on import, the tests never send a request so they need no credentials
+vertexai.init(project=os.environ.get("GCP_PROJECT_ID") or "rgt-digital-twin-tests",
+              location=os.environ.get("GCP_REGION") or "us-central1",
+              credentials=AnonymousCredentials())
+
+
+class WordTokenizer:
+    """
+    Tokenizer that makes every word and every run of whitespace a token, decoding gives back the exact text
+    """
+
+    def __init__(self):
+        self.ids = {}
+        self.pieces = []
+        # The inference server tokenizes on its own threads
+        self.lock = threading.Lock()
+
+    def __call__(
+        self,
+        text: str,
+        add_special_tokens: bool = True,
+        **kwargs,
+    ) -> dict:
+        ids = []
+        with self.lock:
+            for piece in re.findall(r"\s+|\S+", text):
+                if piece not in self.ids:
+                    self.ids[piece] = len(self.pieces)
+                    self.pieces.append(piece)
+                ids.append(self.ids[piece])
+        return {"input_ids": ids}
+
+    def decode(
+        self,
+        ids: list,
+    ) -> str:
+        return "".join(self.pieces[id] for id in ids)
+
+
+@pytest.fixture
+def tokenizer():
+    return WordTokenizer()
@@ -0,0 +1,69 @@
+#
+# Copyright [Aug 20, 2024] [Jacqueline Lammert, Maximilian Tschochohei]
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import pytest
+import chunking
+
+PARAGRAPH = "Die Patientin stellte sich zur Verlaufskontrolle vor. HER2 3+, PD-L1 CPS 10, TMB 12 mut/Mb."
+
+
+def count(tokenizer, text):
+    return len(tokenizer(text, add_special_tokens=False)["input_ids"])
+
+
+def letters(n=6, paragraphs=5):
+    return {f"Patient-0001_letter{i}.pdf": ["\n\n".join(f"{i}.{p} {PARAGRAPH}" for p in range(paragraphs))] * 2
+            for i in range(n)}
+
+
+@pytest.mark.parametrize("budget,overlap", [(60, 0), (120, 20), (300, 100)])
+def test_chunks_stay_within_budget(tokenizer, budget, overlap):
+    chunks = chunking.chunk_patient(letters(), tokenizer, budget, overlap)
+
+    assert len(chunks) > 1
+    assert all(count(tokenizer, chunk) <= budget for chunk in chunks)
+
+
+def test_chunks_overlap(tokenizer):
+    overlap = 20
+    chunks = chunking.chunk_patient(letters(), tokenizer, 120, overlap)
+
+    for previous, chunk in zip(chunks, chunks[1:]):
+        tail = tokenizer.decode(tokenizer(previous, add_special_tokens=False)["input_ids"][-overlap:])
+        assert chunk.startswith(tail)
+
+
+def test_chunks_keep_every_page(tokenizer):
+    document = letters()
+    chunks = chunking.chunk_patient(document, tokenizer, 120, 0)
+
+    text = "\n\n".join(chunks)
+    for doc in document:
+        assert f"[{doc}]" in text
+    assert text.count(PARAGRAPH) == sum(page.count(PARAGRAPH) for pages in document.values() for page in pages)
+
+
+def test_long_line_is_cut_by_tokens(tokenizer):
+    line = " ".join(f"word{n}" for n in range(500))
+    chunks = chunking.chunk_pages([line], tokenizer, 50, 10)
+
+    assert all(count(tokenizer, chunk) <= 50 for chunk in chunks)
+    assert "word499" in chunks[-1]
+
+
+def test_budget_must_leave_room_next_to_overlap(tokenizer):
+    with pytest.raises(ValueError):
+        chunking.chunk_pages(["text"], tokenizer, 10, 10)
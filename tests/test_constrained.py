@@ -0,0 +1,78 @@
+#
+# Copyright [Aug 20, 2024] [Jacqueline Lammert, Maximilian Tschochohei]
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import pytest
+import config
+import constrained
+
+from constrained import Grammar, prompt_schema
+
+SCHEMA = {"gender": constrained.STRING, "age": constrained.INTEGER, "overall_survival": constrained.NUMBER,
+          "biomarkers": constrained.LIST}
+
+
+def accepts(text, schema=SCHEMA):
+    grammar = Grammar(schema)
+    state = grammar.feed(grammar.start, text)
+    return state is not None and state[0] == "done"
+
+
+def test_prompt_schema_reads_the_fields_of_the_prompts():
+    for prompt in [config.local_extraction_prompt, config.local_summary_prompt]:
+        schema = prompt_schema(prompt)
+        assert schema["age"] == constrained.INTEGER
+        assert schema["overall_survival"] == constrained.NUMBER
+        assert schema["biomarkers"] == constrained.LIST
+        assert schema["diagnosis"] == constrained.STRING
+
+
+def test_prompt_without_fields_is_an_error():
+    with pytest.raises(ValueError):
+        prompt_schema("Summarize the records")
+
+
+@pytest.mark.parametrize("text", [
+    '{"gender": "female", "age": 61, "overall_survival": 14.5, "biomarkers": ["HER2 3+", "PD-L1 CPS 10"]}',
+    '{\n  "age": "N/A",\n  "biomarkers": []\n}',
+    '{"biomarkers": "N/A", "gender": "say \\"female\\""}',
+    '{}',
+])
+def test_grammar_accepts_valid_objects(text):
+    assert accepts(text)
+
+
+@pytest.mark.parametrize("text", [
+    '{"age": 61, "age": 62}',
+    '{"age": -1}',
+    '{"overall_survival": -2.5}',
+    '{"ecog": 1}',
+    '{"age": 6.5}',
+    '{"gender": female}',
+    '{"gender": "fe\nmale"}',
+    '{"biomarkers": [1]}',
+    "{'age': 61}",
+    '{"age": 61,}',
+])
+def test_grammar_rejects_invalid_objects(text):
+    assert not accepts(text)
+
+
+def test_grammar_ends_with_the_object():
+    grammar = Grammar(SCHEMA)
+    state = grammar.feed(grammar.start, '{"age": 61}')
+
+    assert state[0] == "done"
+    assert grammar.step(state, "{") is None
@@ -0,0 +1,74 @@
+#
+# Copyright [Aug 20, 2024] [Jacqueline Lammert, Maximilian Tschochohei]
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import dedup
+
+LETTER = ("Sehr geehrte Frau Kollegin, wir berichten ueber unsere gemeinsame Patientin, die sich am 12.03.2024 "
+          "in unserer Ambulanz zur Verlaufskontrolle unter laufender Therapie mit Carboplatin und Paclitaxel "
+          "vorstellte. Im CT Thorax und Abdomen zeigt sich kein Hinweis auf einen Progress der Erkrankung.")
+OTHER = ("Die Patientin wurde heute zur Operation aufgenommen. Es erfolgte eine Hysterektomie mit beidseitiger "
+         "Adnexektomie und pelviner Lymphonodektomie. Der postoperative Verlauf war komplikationslos, die "
+         "Entlassung erfolgt in gutem Allgemeinzustand nach Hause mit Empfehlung zur Tumorkonferenz.")
+HEAD = ("Universitaetsklinikum Musterstadt Klinik und Poliklinik fuer Frauenheilkunde Ismaninger Strasse 22 "
+        "81675 Muenchen Telefon 089 4140 0 Direktor Professor Doktor Max Mustermann")
+
+
+def test_copies_are_dropped():
+    document = {"Patient-0001_brief.pdf": [LETTER, OTHER], "Patient-0001_brief.docx": [LETTER]}
+
+    deduplicated, removed = dedup.deduplicate(document, 0.8, 10)
+
+    assert deduplicated == {"Patient-0001_brief.pdf": [LETTER, OTHER], "Patient-0001_brief.docx": [""]}
+    assert removed == [LETTER]
+
+
+def test_copy_with_other_whitespace_and_case_is_dropped():
+    fax = LETTER.upper().replace(" ", "  ")
+
+    deduplicated, removed = dedup.deduplicate({"Patient-0001_a.pdf": [LETTER], "Patient-0001_fax.pdf": [fax]}, 0.8, 10)
+
+    assert removed == [fax]
+
+
+def test_repeated_letter_head_is_dropped_from_new_pages():
+    document = {"Patient-0001_a.pdf": [f"{HEAD}\n\n{LETTER}"], "Patient-0001_b.pdf": [f"{HEAD}\n\n{OTHER}"]}
+
+    deduplicated, removed = dedup.deduplicate(document, 0.8, 10)
+
+    assert deduplicated["Patient-0001_b.pdf"] == [OTHER]
+    assert removed == [HEAD]
+
+
+def test_different_and_short_pages_are_kept():
+    document = {"Patient-0001_a.pdf": [LETTER, OTHER, "Seite 2", "Seite 2", ""]}
+
+    deduplicated, removed = dedup.deduplicate(document, 0.8, 10)
+
+    assert deduplicated == document
+    assert removed == []
+
+
+def test_lab_tables_that_differ_in_one_value_are_kept():
+    table = ("Immunhistochemie Befund vom 12.03.2024 Material Abradat Corpus uteri Oestrogenrezeptor positiv 80 "
+             "Prozent der Tumorzellen Progesteronrezeptor positiv 40 Prozent der Tumorzellen Ki67 30 Prozent "
+             "PD-L1 CPS 10 HER2 {} p53 Wildtyp Muster MLH1 erhalten PMS2 erhalten MSH2 erhalten MSH6 erhalten "
+             "Beurteilung Karzinosarkom des Uterus mit heterologer Komponente")
+    document = {"Patient-0001_a.pdf": [table.format("1+")], "Patient-0001_b.pdf": [table.format("3+")]}
+
+    deduplicated, removed = dedup.deduplicate(document, 0.8, 10)
+
+    assert deduplicated == document
+    assert removed == []
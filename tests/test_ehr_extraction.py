@@ -0,0 +1,105 @@
+#
+# Copyright [Aug 20, 2024] [Jacqueline Lammert, Maximilian Tschochohei]
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import config
+import ehr_extraction
+
+from fakes import FakeSession
+from journal import Journal
+from manifest import Manifest
+from local_model import build_prompt
+
+LETTERS = [f"Diagnose: Karzinosarkom\nAlter: {40 + n}\nBiomarker: HER2 3+, PD-L1 CPS {n}" for n in range(3)]
+
+
+class FailingSession(FakeSession):
+    """
+    FakeSession that gives up on every prompt that holds one of the failing letters
+    """
+
+    def __init__(
+        self,
+        tokenizer,
+        failing: list,
+        **kwargs,
+    ):
+        super().__init__(tokenizer, **kwargs)
+        self.failing = failing
+
+    def generate_batch(
+        self,
+        prompts: list,
+        max_new_tokens: int,
+        prefix: str = "",
+        callback = None,
+        **kwargs,
+    ) -> list:
+        answers = super().generate_batch(prompts, max_new_tokens, prefix, **kwargs)
+        answers = [None if any(letter in prompt for letter in self.failing) else answer
+                   for prompt, answer in zip(prompts, answers)]
+        if callback is not None:
+            for n, answer in enumerate(answers):
+                callback(n, answer)
+        return answers
+
+
+def one_letter_per_chunk(
+    tokenizer,
+    monkeypatch,
+) -> int:
+    """
+    Context length that leaves room for exactly one letter per chunk
+    """
+    monkeypatch.setattr(config, "local_extraction_overlap", 0)
+    monkeypatch.setattr(config, "dedup_threshold", None)
+    overhead = len(tokenizer(build_prompt(config.local_extraction_prompt, ""))["input_ids"])
+    return overhead + config.local_extraction_max_new_tokens + len(tokenizer(LETTERS[0] + "\n")["input_ids"]) + 4
+
+
+def test_patient_with_a_failed_chunk_fails(tmp_path, tokenizer, monkeypatch):
+    context_length = one_letter_per_chunk(tokenizer, monkeypatch)
+    journal = Journal(str(tmp_path / "journal.jsonl"))
+    patients = {"Patient-0001": {"Patient-0001_letter.pdf": LETTERS[:2]},
+                "Patient-0002": {"Patient-0002_letter.pdf": LETTERS[2:]}}
+
+    session = FailingSession(tokenizer, failing=[LETTERS[1]], context_length=context_length)
+    stuffs = ehr_extraction.map_chunks(patients, session, journal)
+
+    # A summary of the first letter alone would silently miss what the second one says
+    assert "Patient-0001" not in stuffs
+    assert len(stuffs["Patient-0002"]) == 1
+    assert list(Journal(journal.path).failed()) == ["Patient-0001"]
+
+    # The retry only generates the chunk that failed
+    session = FakeSession(tokenizer, context_length=context_length)
+    stuffs = ehr_extraction.map_chunks({"Patient-0001": patients["Patient-0001"]}, session, Journal(journal.path))
+
+    assert len(stuffs["Patient-0001"]) == 2
+    assert session.prompts == 1
+
+
+def test_incremental_export_takes_unchanged_patients_of_the_folder(tmp_path):
+    manifest = Manifest(str(tmp_path / "manifest.json"))
+    for patient in ["Patient-0001", "Patient-0002", "Patient-0003"]:
+        manifest.update(patient, {}, f"old summary of {patient}")
+    # Patient-0001 is unchanged, Patient-0002 changed and failed, Patient-0003 left the folder
+    fingerprints = {"Patient-0001": {}, "Patient-0002": {"letter.pdf": {}}, "Patient-0004": {"letter.pdf": {}}}
+
+    attributes = ehr_extraction.update_manifest(manifest, fingerprints, ["Patient-0002", "Patient-0004"],
+                                                {"Patient-0004": "summary"}, incremental=True)
+
+    assert attributes == {"Patient-0001": "old summary of Patient-0001", "Patient-0004": "summary"}
+    assert "Patient-0002" not in manifest.summaries()
@@ -0,0 +1,110 @@
+#
+# Copyright [Aug 20, 2024] [Jacqueline Lammert, Maximilian Tschochohei]
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import pandas as pd
+import pytest
+
+from export import Records, add_records, parse_output
+
+SUMMARIES = {
+    "Patient-0001": "```python\n{'gender': 'female', 'age': 61, 'diagnosis': 'Uterine carcinosarcoma',"
+                    " 'biomarkers': ['HER2 3+', 'PD-L1 CPS 10']}\n```",
+    "Patient-0002": "Here you go:\n```json\n{\"gender\": \"female\", \"age\": 48, \"diagnosis\": \"Ovarian | granulosa\","
+                    " \"biomarkers\": \"N/A\", \"date_of_death\": \"05/2024\"}\n```",
+    "Patient-0003": "{'gender': 'female', 'age': 70, 'diagnosis': 'Leiomyosarcoma \"high grade\"',"
+                    " 'biomarkers': []}<eos>",
+    "Patient-0004": "I could not find a dictionary in these records.",
+}
+
+
+def pandas_csv(
+    outputs: dict,
+    sep: str = '|',
+) -> str:
+    """
+    The csv as ehr_extraction.py wrote it with pandas, one DataFrame per record
+    """
+    df = pd.DataFrame()
+    for patient in outputs:
+        try:
+            results = parse_output(outputs[patient])
+        except Exception:
+            continue
+        results["Patient"] = patient
+        df = pd.concat([df, pd.DataFrame([results])], ignore_index=True)
+    return df.to_csv(sep=sep)
+
+
+def test_csv_is_identical_to_pandas():
+    records = add_records(Records(), SUMMARIES, "Patient")
+
+    assert len(records) == 3
+    assert records.to_csv('|') == pandas_csv(SUMMARIES)
+
+
+def test_written_csv_is_identical_to_pandas(tmp_path):
+    path = tmp_path / "ehr_extracted.csv"
+    add_records(Records(), SUMMARIES, "Patient").write_csv(str(path), '|')
+
+    assert path.read_bytes() == pandas_csv(SUMMARIES).encode()
+
+
+def test_empty_csv_is_identical_to_pandas():
+    assert Records().to_csv('|') == pd.DataFrame().to_csv(sep='|')
+
+
+def test_columns_appear_in_order_of_first_use():
+    records = Records()
+    records.append({"a": 1})
+    records.append({"b": 2, "a": 3})
+
+    assert records.columns == {"a": [1, 3], "b": [None, 2]}
+
+
+def test_missing_age_makes_ages_floats_like_pandas():
+    summaries = dict(SUMMARIES, **{"Patient-0002": "```python\n{'gender': 'female', 'diagnosis': 'Ovarian'}\n```"})
+    csv = add_records(Records(), summaries, "Patient").to_csv('|')
+
+    assert "|61.0|" in csv
+    assert csv == pandas_csv(summaries)
+
+
+@pytest.mark.parametrize("records", [
+    [{"age": 61}, {"age": None}, {"age": 48}],
+    [{"age": 61.0}, {"age": None, "diagnosis": "Ovarian"}, {"age": 48}],
+    [{"age": None}, {"age": 61.0}],
+    [{"her2": True}, {"her2": 3.0}, {"her2": False}],
+    [{"a": 1, "b": 2, "c": "x"}, {"c": None, "a": "y", "b": None}, {"a": 1, "b": 1}],
+])
+def test_dtypes_are_coerced_like_pandas(records):
+    df = pd.DataFrame()
+    for record in records:
+        df = pd.concat([df, pd.DataFrame([record])], ignore_index=True)
+    ours = Records()
+    for record in records:
+        ours.append(record)
+
+    assert ours.to_csv('|') == df.to_csv(sep='|')
+
+
+@pytest.mark.parametrize("answer", [
+    "```python\n{'age': 61}\n```",
+    "```json\n{\"age\": 61}\n```",
+    "{'age': 61}",
+    "{'age': 61}<|end_of_text|>",
+])
+def test_parse_output(answer):
+    assert parse_output(answer) == {"age": 61}
@@ -0,0 +1,62 @@
+#
+# Copyright [Aug 20, 2024] [Jacqueline Lammert, Maximilian Tschochohei]
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import os
+import hashlib
+
+from doc_cache import DocumentCache
+from file_cache import FileCache
+from response_cache import ResponseCache
+
+
+def test_values_round_trip(tmp_path):
+    cache = FileCache(str(tmp_path), max_bytes=1024 * 1024)
+    cache.put("a", ["page 1", "Seite 2 – Befund"])
+
+    assert cache.get("a") == ["page 1", "Seite 2 – Befund"]
+    assert cache.get("b") is None
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path):
+    cache = FileCache(str(tmp_path), max_bytes=1024 * 1024)
+    for n, key in enumerate(["old", "used", "new"]):
+        cache.put(key, "Befund " * 100)
+        os.utime(cache._path(key), (n, n))
+    cache.get("old")
+    cache.max_bytes = 2 * os.path.getsize(cache._path("new"))
+
+    cache.evict()
+
+    assert sorted(os.listdir(tmp_path)) == ["new.json.gz", "old.json.gz"]
+
+
+def test_expired_answers_are_deleted(tmp_path):
+    cache = ResponseCache(str(tmp_path), ttl_days=-1)
+    cache.put("a", "answer")
+
+    assert cache.get("a") is None
+    assert cache.expired == 1
+    assert os.listdir(tmp_path) == []
+
+
+def test_document_key_hashes_contents_and_extractor(tmp_path):
+    path = tmp_path / "letter.txt"
+    path.write_text("Arztbrief")
+    cache = DocumentCache(str(tmp_path / "cache"))
+    cache._extractors["pdf"] = "pdf:test"
+
+    assert cache.key(str(path), "pdf") == hashlib.sha256(b"Arztbrief" + b"pdf:test").hexdigest()
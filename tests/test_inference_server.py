@@ -0,0 +1,107 @@
+#
+# Copyright [Aug 20, 2024] [Jacqueline Lammert, Maximilian Tschochohei]
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import time
+import threading
+import pytest
+import config
+import ehr_extraction
+
+from fakes import FakeSession
+from inference_server import InferenceClient, InferenceServer
+from local_model import prompt_prefix, prompt_suffix
+
+LETTERS = [f"Diagnose: Karzinosarkom\nAlter: {40 + n}\nBiomarker: HER2 3+, PD-L1 CPS {n}" for n in range(12)]
+
+
+@pytest.fixture
+def server(tokenizer):
+    # Port 0 lets the system pick a free port
+    server = InferenceServer(FakeSession(tokenizer, seconds_per_token=0.001), port=0, batch_wait=0.05).start()
+    yield server
+    server.shutdown()
+
+
+def test_generate_batch_matches_session(server, tokenizer):
+    client = InferenceClient(server.address, tokenizer=tokenizer)
+    prefix = prompt_prefix(config.local_extraction_prompt)
+    prompts = [prompt_suffix(letter) for letter in LETTERS]
+
+    answers = client.generate_batch(prompts, config.local_extraction_max_new_tokens, prefix)
+
+    assert answers == FakeSession(tokenizer).generate_batch(prompts, config.local_extraction_max_new_tokens, prefix)
+    assert client.context_length() == server.session.context_length()
+
+
+class GatedSession(FakeSession):
+    """
+    FakeSession that holds its first batch until the test opens the gate
+    """
+
+    def __init__(self, tokenizer):
+        super().__init__(tokenizer)
+        self.started = threading.Event()
+        self.gate = threading.Event()
+        self.first = 0
+
+    def generate_batch(self, prompts, *args, **kwargs):
+        if not self.started.is_set():
+            self.first = len(prompts)
+            self.started.set()
+            self.gate.wait()
+        return super().generate_batch(prompts, *args, **kwargs)
+
+
+def test_concurrent_clients_share_batches(tokenizer):
+    # Without a batch window the batches only depend on what is queued while the first batch is generated
+    session = GatedSession(tokenizer)
+    server = InferenceServer(session, port=0, batch_wait=0).start()
+    prefix = prompt_prefix(config.local_extraction_prompt)
+    clients = [InferenceClient(server.address, connections=1, tokenizer=tokenizer) for _ in range(4)]
+    answers = {}
+
+    def run(n):
+        answers[n] = clients[n].generate_batch([prompt_suffix(LETTERS[n])], 64, prefix)
+
+    threads = [threading.Thread(target=run, args=(n,)) for n in range(len(clients))]
+    for thread in threads:
+        thread.start()
+    session.started.wait(10)
+    deadline = time.monotonic() + 10
+    while session.first + server.requests.qsize() < len(clients) and time.monotonic() < deadline:
+        time.sleep(0.001)
+    queued = server.requests.qsize()
+    session.gate.set()
+    for thread in threads:
+        thread.join()
+    server.shutdown()
+
+    assert session.first + queued == len(clients)
+    assert server.served == len(clients)
+    assert server.batches == (1 if session.first == len(clients) else 2)
+    for n in range(len(clients)):
+        assert answers[n] == FakeSession(tokenizer).generate_batch([prompt_suffix(LETTERS[n])], 64, prefix)
+
+
+def test_map_chunks_through_client(server, tokenizer):
+    client = InferenceClient(server.address, tokenizer=tokenizer)
+    patients = {f"Patient-{n:04d}": {f"Patient-{n:04d}_letter.pdf": [LETTERS[n]]} for n in range(3)}
+
+    stuffs = ehr_extraction.map_chunks(patients, client)
+
+    assert stuffs == ehr_extraction.map_chunks(patients, FakeSession(tokenizer))
+    assert all(len(stuffs[patient]) == 1 for patient in patients)
+    assert "Karzinosarkom" in stuffs["Patient-0000"][0]
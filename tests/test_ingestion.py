@@ -0,0 +1,67 @@
+#
+# Copyright [Aug 20, 2024] [Jacqueline Lammert, Maximilian Tschochohei]
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import os
+import ingestion
+import synthetic_corpus
+
+from doc_cache import DocumentCache
+
+LETTER = "Diagnose: Karzinosarkom des Uterus\nAlter: 61\nBiomarker: HER2 3+, PD-L1 CPS 10"
+
+
+def cached_entries(
+    cache: DocumentCache,
+) -> list:
+    return [name for name in os.listdir(cache.directory) if name.endswith(".json.gz")]
+
+
+def test_text_pdf_is_cached(tmp_path):
+    synthetic_corpus.write_text_pdf(str(tmp_path / "Patient-0001_letter.pdf"), [LETTER])
+    cache = DocumentCache(str(tmp_path / "cache"))
+
+    pages = ingestion.ingest(str(tmp_path), ["Patient-0001_letter.pdf"], workers=1, cache=cache)
+
+    assert "Karzinosarkom" in pages["Patient-0001_letter.pdf"][0]
+    assert len(cached_entries(cache)) == 1
+
+
+def test_scan_is_not_cached_when_ocr_fails(tmp_path, monkeypatch):
+    synthetic_corpus.write_scanned_pdf(str(tmp_path / "Patient-0001_scan.pdf"), [LETTER])
+    cache = DocumentCache(str(tmp_path / "cache"))
+
+    def convert_from_path(*args, **kwargs):
+        raise OSError("Unable to get page count. Is poppler installed and in PATH?")
+
+    monkeypatch.setattr(ingestion, "convert_from_path", convert_from_path)
+    pages = ingestion.ingest(str(tmp_path), ["Patient-0001_scan.pdf"], workers=1, cache=cache)
+
+    # We keep the empty text layer for this run, but the next run has to try OCR again
+    assert pages["Patient-0001_scan.pdf"] == [""]
+    assert cached_entries(cache) == []
+
+
+def test_main_process_keeps_its_peak_rss(tmp_path):
+    synthetic_corpus.write_text_pdf(str(tmp_path / "Patient-0001_letter.pdf"), [LETTER])
+    # Raise the peak well above what the process uses afterwards
+    data = b"x" * (256 * 1024 * 1024)
+    del data
+    peak = ingestion._peak_rss_mb()
+
+    ingestion.ingest(str(tmp_path), ["Patient-0001_letter.pdf"], workers=1)
+
+    # Without a pool the tasks run in this process, which must not reset its peak
+    assert ingestion._peak_rss_mb() >= peak
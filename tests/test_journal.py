@@ -0,0 +1,84 @@
+#
+# Copyright [Aug 20, 2024] [Jacqueline Lammert, Maximilian Tschochohei]
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+from journal import Journal
+
+
+def test_resume_round_trip(tmp_path):
+    path = str(tmp_path / "journal.jsonl")
+    journal = Journal(path)
+    key = journal.chunk_key("prompt of chunk 1")
+    journal.record_chunk("Patient-0001", key, "```python\n{'age': 61}\n```")
+    journal.record_patient("Patient-0001", "summary 1")
+
+    resumed = Journal(path)
+
+    assert resumed.chunks == {key: "```python\n{'age': 61}\n```"}
+    assert resumed.completed() == {"Patient-0001": "summary 1"}
+    assert resumed.failed() == {}
+
+
+def test_retry_failed_round_trip(tmp_path):
+    path = str(tmp_path / "journal.jsonl")
+    journal = Journal(path)
+    journal.record_patient("Patient-0001", "summary 1")
+    journal.record_failure("Patient-0002", "summarization failed")
+    journal.record_failure("Patient-0003", "chunking failed")
+
+    retried = Journal(path)
+    assert retried.failed() == {"Patient-0002": "summarization failed", "Patient-0003": "chunking failed"}
+    retried.record_patient("Patient-0002", "summary 2")
+
+    resumed = Journal(path)
+    assert resumed.completed() == {"Patient-0001": "summary 1", "Patient-0002": "summary 2"}
+    assert resumed.failed() == {"Patient-0003": "chunking failed"}
+
+
+def test_failure_after_success_is_not_completed(tmp_path):
+    path = str(tmp_path / "journal.jsonl")
+    journal = Journal(path)
+    journal.record_patient("Patient-0001", "summary 1")
+    journal.record_failure("Patient-0001", "summarization failed")
+
+    assert Journal(path).completed() == {}
+    assert "Patient-0001" in Journal(path).failed()
+
+
+def test_line_cut_off_by_a_crash_is_skipped(tmp_path):
+    path = str(tmp_path / "journal.jsonl")
+    journal = Journal(path)
+    journal.record_patient("Patient-0001", "summary 1")
+    with open(path, "a", encoding="utf-8") as f:
+        f.write('{"type": "patient", "patient": "Patient-0002", "summ')
+
+    assert Journal(path).completed() == {"Patient-0001": "summary 1"}
+
+
+def test_clear_starts_a_new_journal(tmp_path):
+    path = tmp_path / "journal.jsonl"
+    journal = Journal(str(path))
+    journal.record_patient("Patient-0001", "summary 1")
+    journal.clear()
+
+    assert not path.exists()
+    assert Journal(str(path)).completed() == {}
+
+
+def test_chunk_key_depends_on_the_prompt(tmp_path):
+    journal = Journal(str(tmp_path / "journal.jsonl"))
+
+    assert journal.chunk_key("prompt") == journal.chunk_key("prompt")
+    assert journal.chunk_key("prompt") != journal.chunk_key("changed prompt")
@@ -0,0 +1,164 @@
+#
+# Copyright [Aug 20, 2024] [Jacqueline Lammert, Maximilian Tschochohei]
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import asyncio
+import config
+import literature_engine
+
+from literature_engine import LiteratureEngine, is_retryable
+from response_cache import ResponseCache
+from fakes import FakeGemini
+
+PROMPTS = {"summary": config.literature_extraction_prompt, "treatment": "Which treatment fits uterine carcinosarcoma?"}
+
+
+class Quota(Exception):
+    code = 429
+
+
+class FlakyGemini(FakeGemini):
+    """
+    Fails the first requests with a quota error and counts how many requests are in flight at once
+    """
+
+    def __init__(
+        self,
+        failures: int = 0,
+        error: Exception = Quota("Resource exhausted"),
+    ):
+        super().__init__(latency=0.01)
+        self.failures = failures
+        self.error = error
+        self.running = 0
+        self.most_running = 0
+
+    async def generate_content_async(self, contents, generation_config = None, safety_settings = None):
+        self.running += 1
+        self.most_running = max(self.most_running, self.running)
+        try:
+            if self.failures:
+                self.failures -= 1
+                await asyncio.sleep(0)
+                raise self.error
+            return await super().generate_content_async(contents, generation_config, safety_settings)
+        finally:
+            self.running -= 1
+
+
+def literature(tmp_path, n=4):
+    folder = tmp_path / "literature"
+    folder.mkdir()
+    docs = [f"study{i}.pdf" for i in range(n)]
+    for i, doc in enumerate(docs):
+        (folder / doc).write_bytes(f"%PDF-1.4 study {i}".encode())
+    return str(folder), docs
+
+
+def make_engine(model, **kwargs):
+    kwargs.setdefault("rate_per_minute", 1e9)
+    kwargs.setdefault("backoff_seconds", 0)
+    return LiteratureEngine(model=model, **kwargs)
+
+
+def test_every_prompt_runs_on_every_doc(tmp_path):
+    folder, docs = literature(tmp_path)
+    engine = make_engine(FakeGemini(latency=0.01))
+
+    output = literature_engine.run(folder, docs, PROMPTS, engine)
+
+    assert set(output) == set(PROMPTS)
+    assert all(output[name][doc].startswith("```json") for name in PROMPTS for doc in docs)
+    assert output["summary"] != output["treatment"]
+    assert engine.requests == len(docs) * len(PROMPTS)
+
+
+def test_answers_do_not_depend_on_concurrency(tmp_path):
+    folder, docs = literature(tmp_path)
+
+    sequential = literature_engine.run(folder, docs, PROMPTS, make_engine(FakeGemini(latency=0.01), concurrency=1))
+    concurrent = literature_engine.run(folder, docs, PROMPTS, make_engine(FakeGemini(latency=0.01), concurrency=8))
+
+    assert sequential == concurrent
+
+
+def test_concurrency_is_limited(tmp_path):
+    folder, docs = literature(tmp_path, 8)
+    model = FlakyGemini()
+
+    literature_engine.run(folder, docs, PROMPTS, make_engine(model, concurrency=3))
+
+    assert model.most_running == 3
+
+
+def test_retryable_errors_are_retried(tmp_path):
+    folder, docs = literature(tmp_path, 1)
+    engine = make_engine(FlakyGemini(failures=2), max_retries=3)
+
+    output = literature_engine.run(folder, docs, {"summary": PROMPTS["summary"]}, engine)
+
+    assert output["summary"][docs[0]] is not None
+    assert engine.retries == 2
+    assert engine.failures == 0
+
+
+def test_other_errors_fail_the_request(tmp_path):
+    folder, docs = literature(tmp_path, 1)
+    engine = make_engine(FlakyGemini(failures=1, error=ValueError("Bad request")), max_retries=3)
+
+    output = literature_engine.run(folder, docs, {"summary": PROMPTS["summary"]}, engine)
+
+    assert output["summary"][docs[0]] is None
+    assert engine.retries == 0
+    assert engine.failures == 1
+
+
+def test_missing_doc_does_not_stop_the_others(tmp_path):
+    folder, docs = literature(tmp_path, 2)
+
+    output = literature_engine.run(folder, docs + ["missing.pdf"], PROMPTS, make_engine(FakeGemini(latency=0.01)))
+
+    assert output["summary"]["missing.pdf"] is None
+    assert all(output["summary"][doc] is not None for doc in docs)
+
+
+def test_cached_answers_need_no_requests(tmp_path):
+    folder, docs = literature(tmp_path)
+    cache = ResponseCache(str(tmp_path / "cache"))
+    first = literature_engine.run(folder, docs, PROMPTS, make_engine(FakeGemini(latency=0.01), cache=cache))
+
+    second_engine = make_engine(FakeGemini(latency=0.01), cache=cache)
+    second = literature_engine.run(folder, docs, PROMPTS, second_engine)
+
+    assert second == first
+    assert second_engine.requests == 0
+    assert second_engine.cached_answers(folder, docs, PROMPTS["summary"]) == first["summary"]
+    assert second_engine.cached_answers(folder, docs, "another prompt") == {doc: None for doc in docs}
+
+
+def test_text_prompts(tmp_path):
+    engine = make_engine(FakeGemini(latency=0.01))
+
+    output = literature_engine.run_texts({("case 1", "study0.pdf"): "prompt 1", ("case 2", "study0.pdf"): "prompt 2"},
+                                         engine)
+
+    assert all(text is not None for text in output.values())
+    assert engine.requests == 2
+
+
+def test_is_retryable():
+    assert is_retryable(Quota("Resource exhausted"))
+    assert is_retryable(TimeoutError())
+    assert not is_retryable(ValueError("Bad request"))
@@ -0,0 +1,90 @@
+#
+# Copyright [Aug 20, 2024] [Jacqueline Lammert, Maximilian Tschochohei]
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import pytest
+
+from local_model import AnswerComplete, answer_complete
+
+
+@pytest.mark.parametrize("text", [
+    "```python\n{'age': 61}\n```",
+    "```json\n{\"age\": 61}\n``` and some words after it",
+    "Here you go: {'age': 61, 'biomarkers': ['HER2 3+']}",
+    "{'diagnosis': 'carcinosarcoma {NOS}'}",
+])
+def test_complete_answers(text):
+    assert answer_complete(text)
+
+
+@pytest.mark.parametrize("text", [
+    "",
+    "```python\n{'age': 61}",
+    "{'age': 61, 'biomarkers': {'HER2': '3+'}",
+    "{'diagnosis': 'carcinosarcoma }'",
+    "The records do not mention a dictionary }",
+])
+def test_incomplete_answers(text):
+    assert not answer_complete(text)
+
+
+def test_rows_stop_once_complete_or_out_of_budget(tokenizer):
+    torch = pytest.importorskip("torch")
+    prompt = tokenizer("Summarize the records:")["input_ids"]
+    answers = [tokenizer("{'age': 61} and more words")["input_ids"], tokenizer("{'age': 61, 'race': 'N/A'")["input_ids"]]
+    length = min(len(answer) for answer in answers)
+    stopping = AnswerComplete(tokenizer, len(prompt), budgets=[100, 6])
+
+    done = []
+    for n in range(1, length + 1):
+        input_ids = torch.tensor([prompt + answer[:n] for answer in answers])
+        done.append(stopping(input_ids, None).tolist())
+
+    # The first row closes its dictionary after 3 tokens, the second row runs out of budget after 6
+    assert stopping.ends == [3, None]
+    assert done[1] == [False, False]
+    assert done[2] == [True, False]
+    assert done[5] == [True, True]
+
+
+@pytest.mark.parametrize("rows", [1, 3])
+def test_gemma2_prefix_cache_gives_the_same_answers(rows):
+    torch = pytest.importorskip("torch")
+    transformers = pytest.importorskip("transformers")
+    import benchmark
+    from local_model import ExtractionSession, prompt_prefix, prompt_suffix
+
+    tokenizer = benchmark.corpus_tokenizer()
+    torch.manual_seed(0)
+    model = transformers.Gemma2ForCausalLM(transformers.Gemma2Config(
+        vocab_size=len(tokenizer), hidden_size=64, intermediate_size=128, num_hidden_layers=2,
+        num_attention_heads=4, num_key_value_heads=2, head_dim=16, sliding_window=1024,
+        pad_token_id=tokenizer.pad_token_id, eos_token_id=tokenizer.eos_token_id,
+        bos_token_id=tokenizer.bos_token_id,
+    )).eval()
+    session = ExtractionSession(model_name="tiny", model=model, tokenizer=tokenizer)
+    session.batch_size = rows
+    prefix = prompt_prefix("Extract the age: {'age': ...}\n{RECORDS}")
+    prompts = [prompt_suffix(record) for record in benchmark.synthetic_records(rows, words=20)]
+
+    session.prefix_caching = False
+    reference = session.generate_batch(prompts, 8, prefix)
+    session.prefix_caching = True
+    answers = session.generate_batch(prompts, 8, prefix)
+
+    # The hybrid cache of gemma-2 was reused, not given up on
+    assert session.prefix_caching
+    assert len(session.prefix_caches) == 1
+    assert answers == reference
@@ -0,0 +1,118 @@
+#
+# Copyright [Aug 20, 2024] [Jacqueline Lammert, Maximilian Tschochohei]
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import os
+import pytest
+import config
+import manifest
+
+from manifest import Manifest
+
+
+def write(folder, name, text):
+    with open(folder / name, "w", encoding="utf-8") as f:
+        f.write(text)
+
+
+def extracted(tmp_path):
+    """
+    A saved manifest of one patient with two letters
+    """
+    folder = tmp_path / "ehr"
+    folder.mkdir()
+    write(folder, "Patient-0001_a.txt", "first letter")
+    write(folder, "Patient-0001_b.txt", "second letter")
+    path = str(tmp_path / "manifest.json")
+    docs = ["Patient-0001_a.txt", "Patient-0001_b.txt"]
+    first = Manifest(path)
+    first.update("Patient-0001", first.fingerprint(str(folder), "Patient-0001", docs), "summary 1")
+    first.save()
+    return folder, path, docs
+
+
+def test_unchanged_patient_is_skipped(tmp_path):
+    folder, path, docs = extracted(tmp_path)
+    second = Manifest(path)
+
+    assert second.unchanged("Patient-0001", second.fingerprint(str(folder), "Patient-0001", docs))
+    assert second.summaries() == {"Patient-0001": "summary 1"}
+
+
+def test_unchanged_files_are_not_hashed_again(tmp_path, monkeypatch):
+    folder, path, docs = extracted(tmp_path)
+    hashed = []
+    monkeypatch.setattr(manifest, "file_digest", lambda path: hashed.append(path))
+
+    Manifest(path).fingerprint(str(folder), "Patient-0001", docs)
+
+    assert hashed == []
+
+
+def test_changed_file_is_extracted_again(tmp_path):
+    folder, path, docs = extracted(tmp_path)
+    write(folder, "Patient-0001_b.txt", "second letter, corrected")
+    second = Manifest(path)
+
+    assert not second.unchanged("Patient-0001", second.fingerprint(str(folder), "Patient-0001", docs))
+
+
+def test_touched_file_with_the_same_content_is_unchanged(tmp_path):
+    folder, path, docs = extracted(tmp_path)
+    stat = os.stat(folder / "Patient-0001_a.txt")
+    os.utime(folder / "Patient-0001_a.txt", (stat.st_atime, stat.st_mtime + 60))
+    second = Manifest(path)
+
+    assert second.unchanged("Patient-0001", second.fingerprint(str(folder), "Patient-0001", docs))
+
+
+def test_new_letter_is_extracted_again(tmp_path):
+    folder, path, docs = extracted(tmp_path)
+    write(folder, "Patient-0001_c.txt", "new letter")
+    second = Manifest(path)
+
+    fingerprint = second.fingerprint(str(folder), "Patient-0001", docs + ["Patient-0001_c.txt"])
+    assert not second.unchanged("Patient-0001", fingerprint)
+    assert not second.unchanged("Patient-0002", {})
+
+
+def test_model_change_invalidates_the_manifest(tmp_path, monkeypatch):
+    folder, path, docs = extracted(tmp_path)
+    monkeypatch.setattr(config, "local_extraction_model", "google/gemma-2-9b-it")
+
+    assert Manifest(path).summaries() == {}
+
+
+@pytest.mark.parametrize("setting, value", [
+    ("dedup_threshold", None),
+    ("local_extraction_context_length", 4096),
+    ("local_extraction_overlap", 50),
+    ("local_extraction_max_new_tokens", 512),
+    ("local_extraction_constrained", True),
+    ("local_reduce_group_size", 4),
+])
+def test_setting_change_invalidates_the_manifest(tmp_path, monkeypatch, setting, value):
+    folder, path, docs = extracted(tmp_path)
+    monkeypatch.setattr(config, setting, value)
+
+    assert Manifest(path).summaries() == {}
+
+
+def test_prompt_change_invalidates_the_manifest(tmp_path, monkeypatch):
+    folder, path, docs = extracted(tmp_path)
+    monkeypatch.setattr(config, "local_summary_prompt", config.local_summary_prompt + "\n    * `ecog` (integer or \"N/A\")")
+
+    second = Manifest(path)
+    assert not second.unchanged("Patient-0001", second.fingerprint(str(folder), "Patient-0001", docs))
@@ -0,0 +1,78 @@
+#
+# Copyright [Aug 20, 2024] [Jacqueline Lammert, Maximilian Tschochohei]
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import merging
+
+from export import parse_output
+
+
+def answer(fields):
+    return merging.format_answer(fields)
+
+
+def test_lists_are_unioned():
+    merged = merging.merge([
+        answer({"biomarkers": ["HER2 3+", "PD-L1 CPS 10"]}),
+        answer({"biomarkers": ["her2  3+", "TMB 12"]}),
+    ])
+
+    assert merged == {"biomarkers": ["HER2 3+", "PD-L1 CPS 10", "TMB 12"]}
+
+
+def test_string_and_number_agree():
+    merged = merging.merge([answer({"age": "44"}), answer({"age": 44})])
+
+    assert merged is not None
+    assert str(merged["age"]) == "44"
+
+
+def test_disagreement_needs_the_model():
+    assert merging.merge([answer({"diagnosis": "Carcinosarcoma"}), answer({"diagnosis": "Leiomyosarcoma"})]) is None
+
+
+def test_missing_values_do_not_disagree():
+    merged = merging.merge([
+        answer({"diagnosis": "Carcinosarcoma", "date_of_death": "N/A"}),
+        answer({"diagnosis": "carcinosarcoma", "date_of_death": "05/2024", "biomarkers": []}),
+    ])
+
+    assert merged == {"diagnosis": "Carcinosarcoma", "date_of_death": "05/2024"}
+
+
+def test_unparsable_answer_needs_the_model():
+    assert merging.merge([answer({"age": 44}), "The records do not mention the age."]) is None
+
+
+def test_compact_drops_missing_values_and_prose():
+    compacted = merging.compact("Here is the summary:\n```python\n{'age': 44, 'race': 'N/A', 'biomarkers': ['N/A']}\n```")
+
+    assert parse_output(compacted) == {"age": 44}
+    assert merging.compact("  no dictionary  ") == "no dictionary"
+
+
+def test_groups_get_smaller_on_every_level():
+    answers = [answer({"age": n}) for n in range(10)]
+    groups = merging.group(answers, budget=10 ** 6, size=3, count_tokens=len)
+
+    assert [len(group) for group in groups] == [3, 3, 3, 1]
+    assert sum(groups, []) == answers
+
+
+def test_groups_respect_the_budget_but_take_two_answers():
+    answers = ["x" * 100] * 5
+    groups = merging.group(answers, budget=150, size=4, count_tokens=len)
+
+    assert [len(group) for group in groups] == [2, 2, 1]
@@ -0,0 +1,95 @@
+#
+# Copyright [Aug 20, 2024] [Jacqueline Lammert, Maximilian Tschochohei]
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+from study_index import StudyIndex, normalise_terms, patient_terms
+
+
+def summary(diagnosis, biomarkers, treatment="Pembrolizumab"):
+    return f"```python\n{ {'diagnosis': diagnosis, 'biomarkers': biomarkers, 'treatment': treatment} }\n```"
+
+
+SUMMARIES = {
+    "ucs_her2.pdf": summary("Uterine carcinosarcoma", ["HER2 3+"], "Trastuzumab-Deruxtecan"),
+    "ucs_pdl1.pdf": summary("Uterine carcinosarcoma", ["PD-L1 CPS 10"]),
+    "ovary_brca.pdf": summary("High-grade serous ovarian carcinoma", ["BRCA1 mutation"], "Olaparib"),
+    "cervix.pdf": summary("Cervical cancer", ["PD-L1"]),
+    "broken.pdf": "The study did not fit into a dictionary.",
+}
+
+
+def test_hyphenated_names_are_joined_and_synonyms_applied():
+    assert {"pdl1", "her2"} <= normalise_terms("PD-L1 CPS 10, ERBB2 amplified")
+    assert "brca" in normalise_terms("BRCA1 mutation")
+
+
+def test_opposite_statuses_stay_apart():
+    assert normalise_terms("MSS") == {"mss"}
+    assert "msi_high" in normalise_terms("MSI-H")
+    assert normalise_terms("pMMR") == {"mmr_proficient"}
+    assert normalise_terms("dMMR") == {"mmr_deficient"}
+
+
+def test_proficient_patient_prefers_proficient_studies():
+    index = StudyIndex({
+        "deficient.pdf": summary("Endometrial carcinoma", ["dMMR", "MSI-H"]),
+        "proficient.pdf": summary("Endometrial carcinoma", ["pMMR", "MSS"]),
+    })
+
+    scores = index.score(normalise_terms("Endometrial carcinoma, pMMR, MSS"))
+
+    assert scores["proficient.pdf"] > scores.get("deficient.pdf", 0)
+
+
+def test_stopwords_and_short_terms_are_dropped():
+    assert normalise_terms("high and positive, 3+ of 10") == set()
+
+
+def test_shortlist_ranks_matching_studies_first():
+    index = StudyIndex(SUMMARIES)
+
+    shortlist = index.shortlist(normalise_terms("Uterine carcinosarcoma, HER2 3+"), top_k=2)
+
+    assert shortlist[:2] == ["ucs_her2.pdf", "ucs_pdl1.pdf"]
+
+
+def test_studies_we_could_not_parse_are_always_kept():
+    index = StudyIndex(SUMMARIES)
+
+    assert index.unindexed == ["broken.pdf"]
+    assert index.shortlist(normalise_terms("ovarian carcinoma BRCA1"), top_k=1) == ["ovary_brca.pdf", "broken.pdf"]
+
+
+def test_patient_without_any_match_keeps_every_study():
+    index = StudyIndex(SUMMARIES)
+
+    assert sorted(index.shortlist(normalise_terms("Vulvar melanoma"), top_k=1)) == sorted(SUMMARIES)
+
+
+def test_patient_terms_come_from_diagnosis_and_biomarkers():
+    record = {"diagnosis": "Uterine carcinosarcoma", "biomarkers": "['HER2 3+']", "age": "61",
+              "description_of_previous_systemic_treatment_lines": "Carboplatin"}
+
+    assert patient_terms(record) == {"uterine", "carcinosarcoma", "her2"}
+
+
+def test_report_counts_kept_pairs_and_recall():
+    index = StudyIndex(SUMMARIES)
+    shortlists = {"Patient-0001": ["ucs_her2.pdf", "broken.pdf"]}
+
+    report = index.report(shortlists, {"Patient-0001": {"ucs_her2.pdf", "cervix.pdf"}})
+
+    assert "kept 2 of 5 patient/study pairs" in report
+    assert "recall 50.0%" in report